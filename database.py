@@ -1,9 +1,25 @@
+import re
 import sqlite3
 import time
+import json
 import random
+import secrets
+import heapq
+from array import array
+from collections import OrderedDict
+from bisect import bisect_left
 from datetime import datetime, timedelta, timezone
 
+from hotstate import HotState
+from money import Money, to_milli
+from readpool import ReadPool
+
 DATABASE_NAME = 'database.db'
+# Тяжёлые админские и аналитические запросы идут через read-only пул на своих потоках
+ANALYTICS_POOL_SIZE = 2
+ANALYTICS_TIMEOUT = 30 # сек на один вызов
+ANALYTICS_MAX_ROWS = 100000 # строк на один вызов
+ANALYTICS_EXPORT_MAX_ROWS = 10000000 # для выгрузок и рассылки по всем пользователям
 
 def connect_db():
     conn = sqlite3.connect(DATABASE_NAME)
@@ -20,10 +36,10 @@ def initialize_database():
             CREATE TABLE IF NOT EXISTS users (
                 id INTEGER PRIMARY KEY,
                 username TEXT DEFAULT NULL,
-                stars REAL DEFAULT 0.0,
+                stars INTEGER DEFAULT 0,
                 count_refs INTEGER DEFAULT 0,
                 referral_id INTEGER DEFAULT NULL,
-                withdrawn REAL DEFAULT 0.0,
+                withdrawn INTEGER DEFAULT 0,
                 registration_time REAL DEFAULT (strftime('%s','now'))
             )
         ''')
@@ -49,13 +65,25 @@ def initialize_database():
         else:
             print(f"Ошибка при добавлении поля banned: {e}")
 
+    try:
+        cursor.execute("ALTER TABLE users ADD COLUMN username_norm TEXT DEFAULT NULL")
+        # Usernames в Telegram только из латиницы, цифр и _, поэтому lower() SQLite достаточно
+        cursor.execute("UPDATE users SET username_norm = lower(username) WHERE username IS NOT NULL")
+        print('Поле username_norm добавлено в таблицу "users"')
+    except sqlite3.OperationalError as e:
+        if "duplicate column name" in str(e):
+            print('Выполнено подключение к полю username_norm в таблице "users".')
+        else:
+            print(f"Ошибка при добавлении поля username_norm: {e}")
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_username_norm ON users(username_norm)')
+
     # Создание таблицы promocodes
     if cursor.execute('SELECT name FROM sqlite_master WHERE type="table" AND name="promocodes"').fetchone() is None:
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS promocodes (
                 id INTEGER PRIMARY KEY,
                 code TEXT NOT NULL UNIQUE,
-                stars REAL NOT NULL,
+                stars INTEGER NOT NULL,
                 max_uses INTEGER NOT NULL,
                 current_uses INTEGER DEFAULT 0,
                 is_active BOOLEAN DEFAULT TRUE
@@ -155,13 +183,42 @@ def initialize_database():
                 id INTEGER PRIMARY KEY,
                 username TEXT NOT NULL,
                 user_id INTEGER NOT NULL,
-                stars REAL NOT NULL,
+                stars INTEGER NOT NULL,
                 status TEXT NOT NULL
             )
         """)
         print('Таблица "withdrawales" создана')
     else:
         print('Выполнено подключение к таблице "withdrawales".')
+
+    for column, definition in (('kind', "TEXT DEFAULT 'stars'"), ('emoji', 'TEXT DEFAULT NULL'),
+                               ('message_id', 'INTEGER DEFAULT NULL'), ('created_at', 'REAL DEFAULT NULL')):
+        try:
+            cursor.execute(f"ALTER TABLE withdrawales ADD COLUMN {column} {definition}")
+            print(f'Поле {column} добавлено в таблицу "withdrawales"')
+        except sqlite3.OperationalError as e:
+            if "duplicate column name" in str(e):
+                print(f'Выполнено подключение к полю {column} в таблице "withdrawales".')
+            else:
+                print(f"Ошибка при добавлении поля {column}: {e}")
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_withdrawales_user_status ON withdrawales(user_id, status)')
+    # Очередь на вывод листается по status и id (id входит в индекс как rowid)
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_withdrawales_status ON withdrawales(status)')
+    # Недельные рефералы считаются при каждом выводе
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_referral_time ON users(referral_id, registration_time)')
+
+    # Денормализованные счётчики рефералов за текущую неделю, см. register_user_with_referral
+    try:
+        cursor.execute("ALTER TABLE users ADD COLUMN week_refs INTEGER DEFAULT 0")
+        cursor.execute("ALTER TABLE users ADD COLUMN week_refs_start INTEGER DEFAULT 0")
+        migrate_referral_counters(cursor)
+        print('Поля week_refs, week_refs_start добавлены в таблицу "users"')
+    except sqlite3.OperationalError as e:
+        if "duplicate column name" in str(e):
+            print('Выполнено подключение к полям week_refs, week_refs_start в таблице "users".')
+        else:
+            print(f"Ошибка при добавлении полей week_refs: {e}")
+
     if cursor.execute('SELECT name FROM sqlite_master WHERE type="table" AND name="booster"').fetchone() is None:
         cursor.execute("""
             CREATE TABLE IF NOT EXISTS booster (
@@ -207,13 +264,15 @@ def initialize_database():
     else:
         print('Столбец "username" не найден в таблице "booster".')
 
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_booster_user ON booster(user_id)')
+
     if cursor.execute('SELECT name FROM sqlite_master WHERE type="table" AND name="lottery"').fetchone() is None:
         cursor.execute("""
             CREATE TABLE IF NOT EXISTS lottery (
                 id INTEGER PRIMARY KEY,
                 status TEXT NOT NULL,
-                cash REAL NOT NULL,
-                ticket_cash REAL NOT NULL,
+                cash INTEGER NOT NULL,
+                ticket_cash INTEGER NOT NULL,
                 winner_id INTEGER DEFAULT NULL
             )
         """)
@@ -235,6 +294,7 @@ def initialize_database():
         print('Таблица "lottery_data" создана')
     else:
         print('Выполнено подключение к таблице "lottery_data".')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_lottery_data_lottery ON lottery_data(lottery_id, user_id, count_tickets)')
 
     if cursor.execute('SELECT name FROM sqlite_master WHERE type="table" AND name="knb"').fetchone() is None:
         cursor.execute("""
@@ -245,7 +305,7 @@ def initialize_database():
                 choice_first TEXT DEFAULT NULL,
                 choice_second TEXT DEFAULT NULL,
                 result TEXT DEFAULT NULL,
-                bet REAL NOT NULL,
+                bet INTEGER NOT NULL,
                 FOREIGN KEY (first_player) REFERENCES users(id),
                 FOREIGN KEY (second_player) REFERENCES users(id)
             )
@@ -253,6 +313,18 @@ def initialize_database():
         print('Таблица "knb" создана')
     else:
         print('Выполнено подключение к таблице "knb".')
+
+    for column, definition in (('first_name', 'TEXT DEFAULT NULL'), ('second_name', 'TEXT DEFAULT NULL'),
+                               ('accepted_at', 'REAL DEFAULT NULL'), ('expires_at', 'REAL DEFAULT NULL')):
+        try:
+            cursor.execute(f"ALTER TABLE knb ADD COLUMN {column} {definition}")
+            print(f'Поле {column} добавлено в таблицу "knb"')
+        except sqlite3.OperationalError as e:
+            if "duplicate column name" in str(e):
+                print(f'Выполнено подключение к полю {column} в таблице "knb".')
+            else:
+                print(f"Ошибка при добавлении поля {column}: {e}")
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_knb_open ON knb(expires_at) WHERE result IS NULL')
     
     if cursor.execute('SELECT name FROM sqlite_master WHERE type="table" AND name="utm_data"').fetchone() is None:
         cursor.execute("""
@@ -265,79 +337,615 @@ def initialize_database():
         print('Таблица "utm_data" создана')
     else:
         print('Выполнено подключение к таблице "utm_data".')
+
+    # Кампании ищутся по slug (часть после ?start=), счётчики копятся в памяти, см. UtmRegistry
+    for column, definition in (('slug', 'TEXT DEFAULT NULL'), ('count_starts', 'INTEGER DEFAULT 0')):
+        try:
+            cursor.execute(f"ALTER TABLE utm_data ADD COLUMN {column} {definition}")
+            if column == 'slug':
+                cursor.execute("UPDATE utm_data SET slug = substr(url, instr(url, '=') + 1)")
+            print(f'Поле {column} добавлено в таблицу "utm_data"')
+        except sqlite3.OperationalError as e:
+            if "duplicate column name" in str(e):
+                print(f'Выполнено подключение к полю {column} в таблице "utm_data".')
+            else:
+                print(f"Ошибка при добавлении поля {column}: {e}")
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_utm_data_slug ON utm_data(slug)')
+
+    # Почасовые счётчики кампаний: статистика за период — диапазон по первичному ключу
+    if cursor.execute('SELECT name FROM sqlite_master WHERE type="table" AND name="utm_stats"').fetchone() is None:
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS utm_stats (
+                slug TEXT NOT NULL,
+                hour INTEGER NOT NULL,
+                starts INTEGER DEFAULT 0,
+                subscribed INTEGER DEFAULT 0,
+                registered INTEGER DEFAULT 0,
+                PRIMARY KEY (slug, hour)
+            ) WITHOUT ROWID
+        """)
+        print('Таблица "utm_stats" создана')
+    else:
+        print('Выполнено подключение к таблице "utm_stats".')
+
+    # Почасовые и дневные корзины событий активности для статистики, см. ActivityRollup
+    for table, bucket in (('activity_hourly', 'hour'), ('activity_daily', 'day')):
+        if cursor.execute('SELECT name FROM sqlite_master WHERE type="table" AND name = ?', (table,)).fetchone() is None:
+            cursor.execute(f"""
+                CREATE TABLE IF NOT EXISTS {table} (
+                    event TEXT NOT NULL,
+                    {bucket} INTEGER NOT NULL,
+                    count INTEGER DEFAULT 0,
+                    amount INTEGER DEFAULT 0,
+                    PRIMARY KEY (event, {bucket})
+                ) WITHOUT ROWID
+            """)
+            print(f'Таблица "{table}" создана')
+            if table == 'activity_daily':
+                backfill_activity(cursor)
+        else:
+            print(f'Выполнено подключение к таблице "{table}".')
+
+    # Контексты действий для кнопок: в callback_data уходит только короткий токен
+    if cursor.execute('SELECT name FROM sqlite_master WHERE type="table" AND name="callback_contexts"').fetchone() is None:
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS callback_contexts (
+                token TEXT PRIMARY KEY,
+                payload TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )
+        """)
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_callback_contexts_created ON callback_contexts(created_at)')
+        print('Таблица "callback_contexts" создана')
+    else:
+        print('Выполнено подключение к таблице "callback_contexts".')
+
+    # Имена и язык пользователей из входящих апдейтов, чтобы не спрашивать их у Bot API
+    if cursor.execute('SELECT name FROM sqlite_master WHERE type="table" AND name="user_profiles"').fetchone() is None:
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS user_profiles (
+                user_id INTEGER PRIMARY KEY,
+                first_name TEXT DEFAULT NULL,
+                username TEXT DEFAULT NULL,
+                language_code TEXT DEFAULT NULL,
+                is_premium INTEGER DEFAULT 0,
+                updated_at REAL NOT NULL
+            )
+        """)
+        print('Таблица "user_profiles" создана')
+    else:
+        print('Выполнено подключение к таблице "user_profiles".')
+
+    # Журнал регистраций, удалений и банов: по нему индексы членства в других процессах догоняют изменения
+    if cursor.execute('SELECT name FROM sqlite_master WHERE type="table" AND name="membership_log"').fetchone() is None:
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS membership_log (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                registered INTEGER NOT NULL,
+                banned INTEGER NOT NULL,
+                created_at REAL NOT NULL
+            )
+        """)
+        print('Таблица "membership_log" создана')
+    else:
+        print('Выполнено подключение к таблице "membership_log".')
+
+    # Журнал изменений горячих полей (баланс, клики, подарок, буст) для кеша HotState
+    if cursor.execute('SELECT name FROM sqlite_master WHERE type="table" AND name="hot_state_log"').fetchone() is None:
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS hot_state_log (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                created_at REAL NOT NULL
+            )
+        """)
+        print('Таблица "hot_state_log" создана')
+    else:
+        print('Выполнено подключение к таблице "hot_state_log".')
     
+    migrate_money_columns(cursor)
+
     conn.commit()
     conn.close()
     print('База данных успешно инициализирована.')
 
 
+# Суммы в звёздах хранятся целыми милли-звёздами (см. money.Money)
+MONEY_COLUMNS = {
+    'users': ('stars', 'withdrawn'),
+    'promocodes': ('stars',),
+    'withdrawales': ('stars',),
+    'lottery': ('cash', 'ticket_cash'),
+    'knb': ('bet',),
+}
+
+def migrate_money_columns(cursor):
+    """Переводит REAL-суммы старых баз в INTEGER милли-звёзды (PRAGMA user_version 0 -> 1).
+    Таблица пересоздаётся с тем же порядком столбцов, чтобы не сломать SELECT *."""
+    if cursor.execute('PRAGMA user_version').fetchone()[0] >= 1:
+        return
+    for table, money_columns in MONEY_COLUMNS.items():
+        info = cursor.execute(f'PRAGMA table_info({table})').fetchall()
+        real_columns = [column[1] for column in info if column[1] in money_columns and column[2].upper() == 'REAL']
+        if not real_columns:
+            continue
+        create_sql = cursor.execute('SELECT sql FROM sqlite_master WHERE type="table" AND name = ?', (table,)).fetchone()[0]
+        index_sqls = [row[0] for row in cursor.execute('SELECT sql FROM sqlite_master WHERE type="index" AND tbl_name = ? AND sql IS NOT NULL', (table,))]
+        for column in real_columns:
+            create_sql = re.sub(rf'\b{column}\s+REAL\b', f'{column} INTEGER', create_sql)
+        create_sql = re.sub(rf'(CREATE TABLE(?: IF NOT EXISTS)?\s+)"?{table}"?', rf'\g<1>{table}_milli', create_sql, count=1)
+        cursor.execute(create_sql)
+        columns = [column[1] for column in info]
+        select = ', '.join(f'CAST(ROUND({column} * 1000) AS INTEGER)' if column in real_columns else column for column in columns)
+        cursor.execute(f'INSERT INTO {table}_milli ({", ".join(columns)}) SELECT {select} FROM {table}')
+        cursor.execute(f'DROP TABLE {table}')
+        cursor.execute(f'ALTER TABLE {table}_milli RENAME TO {table}')
+        for index_sql in index_sqls:
+            cursor.execute(index_sql)
+        print(f'Суммы в таблице "{table}" переведены в милли-звёзды: {", ".join(real_columns)}')
+    cursor.execute('PRAGMA user_version = 1')
+
+
+def get_period_timestamps(period):
+    now_utc = datetime.utcnow()
+    tz_offset = timedelta(hours=3)
+    now_local = now_utc + tz_offset
+    
+    if period == 'day':
+        start = now_local.replace(hour=0, minute=0, second=0, microsecond=0)
+        end = start + timedelta(days=1, seconds=-1)
+    elif period == 'week':
+        start = now_local - timedelta(days=now_local.weekday())
+        start = start.replace(hour=0, minute=0, second=0, microsecond=0)
+        end = start + timedelta(days=7, seconds=-1)
+    elif period == 'month':
+        start = now_local.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        next_month = start.replace(day=28) + timedelta(days=4)
+        end = next_month.replace(day=1) - timedelta(seconds=1)
+    else:
+        return None, None
+    
+    return int(start.timestamp()), int(end.timestamp())
+
+def migrate_referral_counters(cursor):
+    """Сверяет count_refs с реальным числом рефералов и заполняет week_refs за текущую неделю."""
+    start_ts, end_ts = get_period_timestamps('week')
+    cursor.execute('''
+        UPDATE users SET
+            count_refs = (SELECT COUNT(*) FROM users AS refs WHERE refs.referral_id = users.id),
+            week_refs = (SELECT COUNT(*) FROM users AS refs WHERE refs.referral_id = users.id AND refs.registration_time BETWEEN ? AND ?),
+            week_refs_start = ?
+    ''', (start_ts, end_ts, start_ts))
+
+
+def backfill_activity(cursor, before=None):
+    """Заполняет корзины регистраций из users.registration_time до момента before (по умолчанию
+    сейчас) — пересчёт, повторный запуск ничего не задваивает; при повторе before стоит брать
+    на границе часа и дня, иначе живые события в последней корзине затрутся. Истории кликов нет,
+    поэтому все клики до появления корзин кладутся одной суммой в день 0."""
+    before = before or time.time()
+    for table, bucket, size in (('activity_hourly', 'hour', 3600), ('activity_daily', 'day', 86400)):
+        cursor.execute(f'''
+            INSERT INTO {table} (event, {bucket}, count)
+            SELECT 'registration', CAST(registration_time AS INTEGER) / {size} AS bucket, COUNT(*)
+            FROM users
+            WHERE registration_time < ?
+            GROUP BY bucket
+            ON CONFLICT(event, {bucket}) DO UPDATE SET count = excluded.count
+        ''', (before,))
+    cursor.execute('''
+        INSERT INTO activity_daily (event, day, count)
+        SELECT 'click', 0, COALESCE(SUM(click_count), 0) FROM click_times
+        WHERE NOT EXISTS (SELECT 1 FROM activity_daily WHERE event = 'click' AND day = 0)
+    ''')
+
+
 initialize_database()
+analytics = ReadPool(DATABASE_NAME, ANALYTICS_POOL_SIZE, ANALYTICS_TIMEOUT, ANALYTICS_MAX_ROWS)
 
-def get_banned_user(user_id):
-    with sqlite3.connect(DATABASE_NAME) as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT banned FROM users WHERE id = ?", (user_id,))
-        result = cursor.fetchone()
-        if result:
-            return result[0]
+def _read_value(cursor, sql, params=()):
+    return cursor.fetchone(sql, params)[0]
+
+def _read_rows(cursor, sql, params=()):
+    return cursor.fetchall(sql, params)
+
+
+class IdIndex:
+    """Множество id пользователей: отсортированный array('q') (8 байт на id) и небольшой
+    буфер свежих добавлений, который вливается в массив пачками."""
+
+    MERGE_THRESHOLD = 4096
+
+    def __init__(self, ids=()):
+        # ids — возрастающая последовательность без повторов (SELECT ... ORDER BY id)
+        self.ids = array('q', ids)
+        self.added = set()
+
+    def __contains__(self, user_id):
+        if user_id in self.added:
+            return True
+        i = bisect_left(self.ids, user_id)
+        return i < len(self.ids) and self.ids[i] == user_id
+
+    def __len__(self):
+        return len(self.ids) + len(self.added)
+
+    def add(self, user_id):
+        if user_id in self:
+            return
+        self.added.add(user_id)
+        if len(self.added) >= self.MERGE_THRESHOLD:
+            self.ids = array('q', sorted(self.ids + array('q', self.added)))
+            self.added.clear()
+
+    def discard(self, user_id):
+        self.added.discard(user_id)
+        i = bisect_left(self.ids, user_id)
+        if i < len(self.ids) and self.ids[i] == user_id:
+            del self.ids[i]
+
+
+class MembershipIndex:
+    """Зарегистрированные и забаненные пользователи в памяти процесса, без запросов к SQLite.
+
+    Изменения из этого процесса применяются после commit их транзакции, изменения из других процессов
+    (многопроцессный режим) подтягиваются из membership_log не чаще раза в sync_interval секунд."""
+
+    def __init__(self, sync_interval=1.0):
+        self.sync_interval = sync_interval
+        self.registered = IdIndex()
+        self.banned = IdIndex()
+        self.seq = 0
+        self.synced_at = 0.0
+
+    def load(self):
+        with sqlite3.connect(DATABASE_NAME) as conn:
+            cursor = conn.cursor()
+            self.seq = cursor.execute('SELECT COALESCE(MAX(seq), 0) FROM membership_log').fetchone()[0]
+            self.registered = IdIndex(row[0] for row in cursor.execute('SELECT id FROM users ORDER BY id'))
+            self.banned = IdIndex(row[0] for row in cursor.execute('SELECT id FROM users WHERE banned = 1 ORDER BY id'))
+        self.synced_at = time.monotonic()
+
+    def apply(self, user_id, registered, banned):
+        if registered:
+            self.registered.add(user_id)
         else:
-            return 0
+            self.registered.discard(user_id)
+        if banned:
+            self.banned.add(user_id)
+        else:
+            self.banned.discard(user_id)
+
+    def sync(self):
+        now = time.monotonic()
+        if now - self.synced_at < self.sync_interval:
+            return
+        self.synced_at = now
+        with sqlite3.connect(DATABASE_NAME) as conn:
+            cursor = conn.cursor()
+            rows = cursor.execute('SELECT seq, user_id, registered, banned FROM membership_log WHERE seq > ? ORDER BY seq', (self.seq,)).fetchall()
+        for seq, user_id, registered, banned in rows:
+            self.apply(user_id, registered, banned)
+            self.seq = seq
+
+    def log(self, cursor, user_id, registered, banned):
+        """Пишет изменение в журнал в транзакции вызывающего. Возвращает изменение, которое
+        вызывающий применяет к индексу через apply(*change) уже после commit."""
+        cursor.execute('INSERT INTO membership_log (user_id, registered, banned, created_at) VALUES (?, ?, ?, ?)', (user_id, int(registered), int(banned), time.time()))
+        return user_id, registered, banned
+
+    def is_registered(self, user_id):
+        self.sync()
+        return user_id in self.registered
+
+    def is_banned(self, user_id):
+        self.sync()
+        return user_id in self.banned
+
+
+members = MembershipIndex()
+members.load()
+
+
+def _as_user_id(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+def get_banned_user(user_id):
+    user_id = _as_user_id(user_id)
+    return 1 if user_id is not None and members.is_banned(user_id) else 0
         
 def set_banned_user(user_id, banned):
     with sqlite3.connect(DATABASE_NAME) as conn:
         cursor = conn.cursor()
         cursor.execute("UPDATE users SET banned = ? WHERE id = ?", (banned, user_id))
+        change = members.log(cursor, int(user_id), True, banned) if cursor.rowcount else None
         conn.commit()
+        if change:
+            members.apply(*change)
         return True
     
 def delete_user(user_id):
     with sqlite3.connect(DATABASE_NAME) as conn:
         cursor = conn.cursor()
         cursor.execute("DELETE FROM users WHERE id = ?", (user_id,))
+        change = members.log(cursor, int(user_id), False, False)
+        write = _hot_write(cursor, int(user_id))
         conn.commit()
+        members.apply(*change)
+        _hot_apply(cursor, write)
         return True
 
-
-def delete_utm(url):
+def prune_change_logs(max_age=24 * 60 * 60):
+    """Чистит журналы membership_log и hot_state_log: процессы догоняют их за секунды,
+    а снимок HotState старше max_age при старте просто перечитывается из базы."""
     with sqlite3.connect(DATABASE_NAME) as conn:
         cursor = conn.cursor()
-        cursor.execute("DELETE FROM utm_data WHERE url = ?", (url,))
+        cursor.execute('DELETE FROM membership_log WHERE created_at < ?', (time.time() - max_age,))
+        cursor.execute('DELETE FROM hot_state_log WHERE created_at < ?', (time.time() - max_age,))
         conn.commit()
         return True
 
-def create_utm(url, count_users=0):
-    with sqlite3.connect(DATABASE_NAME) as conn:
-        cursor = conn.cursor()
-        cursor.execute("INSERT INTO utm_data (url, count_users) VALUES (?, ?)", (url, count_users))
-        conn.commit()
-        return True
-    
-def get_urls_utm():
-    with sqlite3.connect(DATABASE_NAME) as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT url FROM utm_data")
-        return [row[0] for row in cursor.fetchall()]
-    
-def users_add_utm(url):
+
+# Горячие поля пользователей в памяти процесса (см. hotstate.HotState).
+# Запись идёт в SQLite как раньше, а строка кеша перечитывается в той же транзакции;
+# изменения из других процессов подтягиваются по hot_state_log не чаще раза в HOT_STATE_SYNC_INTERVAL.
+HOT_STATE_SNAPSHOT = 'hotstate.snapshot'
+HOT_STATE_SYNC_INTERVAL = 1.0
+HOT_COLUMNS = [name for name, _ in HotState.COLUMNS]
+HOT_STATE_QUERY = """
+    SELECT users.id, users.stars, click_times.last_click_time, click_times.click_count,
+           daily_gifts.last_claimed_time, (SELECT MAX(end_time) FROM booster WHERE booster.user_id = users.id)
+    FROM users
+    LEFT JOIN click_times ON click_times.user_id = users.id
+    LEFT JOIN daily_gifts ON daily_gifts.user_id = users.id
+"""
+
+class BoostExpiry:
+    """Мин-куча (end_time, user_id) активных бустов. При продлении буста старая запись
+    остаётся в куче и отбрасывается при извлечении: актуальный конец буста берётся из hot."""
+
+    def __init__(self):
+        self.heap = []
+
+    def load(self, pairs):
+        self.heap = list(pairs)
+        heapq.heapify(self.heap)
+
+    def push(self, end_time, user_id):
+        heapq.heappush(self.heap, (end_time, user_id))
+
+    def next_expiry(self):
+        return self.heap[0][0] if self.heap else None
+
+    def pop_expired(self, now):
+        expired = []
+        while self.heap and self.heap[0][0] <= now:
+            end_time, user_id = heapq.heappop(self.heap)
+            if hot.get(user_id, 'boost_end') == end_time:
+                expired.append(user_id)
+        return expired
+
+
+hot = HotState()
+boosts = BoostExpiry()
+_hot_own_seqs = set()
+_hot_synced_at = 0.0
+
+def _hot_refresh(cursor, user_ids):
+    user_ids = list(user_ids)
+    found = set()
+    for i in range(0, len(user_ids), 500):
+        chunk = user_ids[i:i + 500]
+        query = HOT_STATE_QUERY + f" WHERE users.id IN ({','.join('?' * len(chunk))})"
+        for row in cursor.execute(query, chunk):
+            if row[5] and row[5] != hot.get(row[0], 'boost_end'):
+                boosts.push(row[5], row[0])
+            hot.set(row[0], **dict(zip(HOT_COLUMNS, row[1:])))
+            found.add(row[0])
+    for user_id in set(user_ids) - found:
+        if hot.row(user_id) is not None:
+            hot.set(user_id, **dict.fromkeys(HOT_COLUMNS, 0))
+
+def _hot_write(cursor, user_id):
+    """Отмечает изменение горячих полей пользователя в журнале. Вызывается в транзакции записи,
+    перед commit; возвращает отложенную запись для _hot_apply, кеш до commit не трогается."""
+    cursor.execute('INSERT INTO hot_state_log (user_id, created_at) VALUES (?, ?)', (user_id, time.time()))
+    return cursor.lastrowid, user_id
+
+def _hot_apply(cursor, *writes):
+    """Перечитывает в кеш строки пользователей после commit транзакции с этими _hot_write."""
+    _hot_own_seqs.update(seq for seq, _ in writes)
+    _hot_refresh(cursor, {user_id for _, user_id in writes})
+
+def sync_hot_state(force=False):
+    global _hot_synced_at
+    now = time.monotonic()
+    if not force and now - _hot_synced_at < HOT_STATE_SYNC_INTERVAL:
+        return
+    _hot_synced_at = now
+    with sqlite3.connect(DATABASE_NAME) as conn:
+        cursor = conn.cursor()
+        rows = cursor.execute('SELECT seq, user_id FROM hot_state_log WHERE seq > ?', (hot.seq,)).fetchall()
+        changed = set()
+        for seq, user_id in rows:
+            if seq in _hot_own_seqs:
+                _hot_own_seqs.discard(seq)
+            else:
+                changed.add(user_id)
+            hot.seq = max(hot.seq, seq)
+        if changed:
+            _hot_refresh(cursor, changed)
+
+def load_hot_state():
+    """Поднимает кеш из снимка и догоняет его по журналу; если журнал уже почищен дальше снимка — читает всё из базы."""
     with sqlite3.connect(DATABASE_NAME) as conn:
         cursor = conn.cursor()
-        cursor.execute("UPDATE utm_data SET count_users = count_users + 1 WHERE url = ?", (url,))
-        conn.commit()
+        first_seq = cursor.execute('SELECT MIN(seq) FROM hot_state_log').fetchone()[0]
+        last_seq = cursor.execute('SELECT seq FROM sqlite_sequence WHERE name = "hot_state_log"').fetchone()
+        last_seq = last_seq[0] if last_seq else 0
+        if hot.restore(HOT_STATE_SNAPSHOT) and hot.seq <= last_seq and (hot.seq + 1 >= first_seq if first_seq else hot.seq == last_seq):
+            print(f'Горячие поля восстановлены из снимка ({len(hot)} пользователей).')
+        else:
+            hot.load(cursor.execute(HOT_STATE_QUERY + ' ORDER BY users.id'), last_seq)
+            print(f'Горячие поля загружены из базы ({len(hot)} пользователей).')
+    boosts.load((end_time, user_id) for user_id, end_time in zip(hot.ids, hot.columns['boost_end']) if end_time)
+    sync_hot_state(force=True)
+
+def save_hot_state():
+    sync_hot_state(force=True)
+    try:
+        hot.save(HOT_STATE_SNAPSHOT)
+    except OSError as e:
+        print(f"Ошибка при сохранении снимка горячих полей: {e}")
+
+def _hot_get(user_id, column):
+    user_id = _as_user_id(user_id)
+    if user_id is None:
+        return None
+    sync_hot_state()
+    if hot.row(user_id) is None:
+        # Пользователь мог появиться в другом процессе между синхронизациями
+        with sqlite3.connect(DATABASE_NAME) as conn:
+            _hot_refresh(conn.cursor(), (user_id,))
+    return hot.get(user_id, column)
+
+def count_active_boosters():
+    sync_hot_state()
+    return hot.active_boosters(time.time())
+
+def count_users_off_cooldown(cooldown):
+    sync_hot_state()
+    return hot.off_cooldown(time.time(), cooldown)
+
+load_hot_state()
+
+
+UTM_EVENTS = ('starts', 'subscribed', 'registered')
+# Итоги кампании в utm_data: «Все пользователи» (count_users) исторически считают регистрации
+UTM_TOTAL_COLUMNS = {'starts': 'count_starts', 'subscribed': 'count_op_users', 'registered': 'count_users'}
+
+class UtmRegistry:
+    """UTM-кампании по slug в памяти и их счётчики.
+
+    Атрибуция — поиск в словаре; словарь сбрасывается при создании/удалении ссылки и
+    перечитывается не реже чем раз в ttl секунд (ссылки могут меняться из другого процесса).
+    События копятся в памяти по (slug, час) и пишутся flush() одной транзакцией:
+    в итоги utm_data и в почасовые корзины utm_stats."""
+
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self.campaigns = None
+        self.loaded_at = 0
+        self.pending = {}
+
+    def _load(self):
+        if self.campaigns is None or time.monotonic() - self.loaded_at > self.ttl:
+            with sqlite3.connect(DATABASE_NAME) as conn:
+                cursor = conn.cursor()
+                rows = cursor.execute('SELECT slug, url FROM utm_data WHERE slug IS NOT NULL ORDER BY rowid').fetchall()
+            self.campaigns = {}
+            for slug, url in rows:
+                self.campaigns.setdefault(slug, url)
+            self.loaded_at = time.monotonic()
+        return self.campaigns
+
+    def invalidate(self):
+        self.campaigns = None
+
+    def get(self, slug):
+        """url кампании или None."""
+        if not isinstance(slug, str):
+            return None
+        return self._load().get(slug)
+
+    def slugs(self):
+        return list(self._load())
+
+    def track(self, slug, event):
+        if self.get(slug) is None:
+            return False
+        key = (slug, int(time.time() // 3600))
+        counters = self.pending.setdefault(key, dict.fromkeys(UTM_EVENTS, 0))
+        counters[event] += 1
         return True
-    
-def users_add_utm_op(url):
-    with sqlite3.connect(DATABASE_NAME) as conn:
-        cursor = conn.cursor()
-        cursor.execute("UPDATE utm_data SET count_op_users = count_op_users + 1 WHERE url = ?", (url,))
+
+    def flush(self):
+        if not self.pending:
+            return 0
+        pending, self.pending = self.pending, {}
+        totals = {}
+        for (slug, _), counters in pending.items():
+            total = totals.setdefault(slug, dict.fromkeys(UTM_EVENTS, 0))
+            for event, count in counters.items():
+                total[event] += count
+        try:
+            with sqlite3.connect(DATABASE_NAME) as conn:
+                cursor = conn.cursor()
+                cursor.executemany('''
+                    INSERT INTO utm_stats (slug, hour, starts, subscribed, registered) VALUES (?, ?, ?, ?, ?)
+                    ON CONFLICT(slug, hour) DO UPDATE SET
+                        starts = starts + excluded.starts, subscribed = subscribed + excluded.subscribed,
+                        registered = registered + excluded.registered
+                ''', [(slug, hour, *(counters[event] for event in UTM_EVENTS)) for (slug, hour), counters in pending.items()])
+                cursor.executemany(f'''
+                    UPDATE utm_data SET {', '.join(f'{UTM_TOTAL_COLUMNS[event]} = {UTM_TOTAL_COLUMNS[event]} + ?' for event in UTM_EVENTS)}
+                    WHERE slug = ?
+                ''', [(*(total[event] for event in UTM_EVENTS), slug) for slug, total in totals.items()])
+                conn.commit()
+        except Exception:
+            # Не теряем счётчики: вернутся в следующую запись
+            for key, counters in pending.items():
+                merged = self.pending.setdefault(key, dict.fromkeys(UTM_EVENTS, 0))
+                for event, count in counters.items():
+                    merged[event] += count
+            raise
+        return len(pending)
+
+    def stats(self, slug, hours=(24, 24 * 7)):
+        """{'total': {...}, 24: {...}, 168: {...}} с учётом ещё не записанных событий."""
+        now_hour = int(time.time() // 3600)
+        with sqlite3.connect(DATABASE_NAME) as conn:
+            cursor = conn.cursor()
+            row = cursor.execute(f'SELECT {", ".join(UTM_TOTAL_COLUMNS[event] for event in UTM_EVENTS)} FROM utm_data WHERE slug = ?', (slug,)).fetchone()
+            result = {'total': dict(zip(UTM_EVENTS, row or (0, 0, 0)))}
+            for period in hours:
+                sums = cursor.execute('SELECT COALESCE(SUM(starts), 0), COALESCE(SUM(subscribed), 0), COALESCE(SUM(registered), 0) FROM utm_stats WHERE slug = ? AND hour > ?',
+                                      (slug, now_hour - period)).fetchone()
+                result[period] = dict(zip(UTM_EVENTS, sums))
+        for (pending_slug, hour), counters in self.pending.items():
+            if pending_slug != slug:
+                continue
+            for key in result:
+                if key == 'total' or hour > now_hour - key:
+                    for event, count in counters.items():
+                        result[key][event] += count
+        return result
+
+utm = UtmRegistry()
+
+def create_utm(slug, url):
+    with sqlite3.connect(DATABASE_NAME) as conn:
+        cursor = conn.cursor()
+        if cursor.execute("SELECT 1 FROM utm_data WHERE slug = ?", (slug,)).fetchone():
+            return False
+        cursor.execute("INSERT INTO utm_data (url, slug) VALUES (?, ?)", (url, slug))
         conn.commit()
-        return True
-    
-def readd_username(id, username):
+    utm.invalidate()
+    return True
+
+def delete_utm(slug):
     with sqlite3.connect(DATABASE_NAME) as conn:
         cursor = conn.cursor()
-        cursor.execute("UPDATE users SET username = ? WHERE id = ?", (username, id))
+        cursor.execute("DELETE FROM utm_data WHERE slug = ?", (slug,))
+        deleted = cursor.rowcount > 0
+        cursor.execute("DELETE FROM utm_stats WHERE slug = ?", (slug,))
         conn.commit()
-        return True
+    utm.invalidate()
+    return deleted
 
 def get_username(id):
     with sqlite3.connect(DATABASE_NAME) as conn:
@@ -345,114 +953,279 @@ def get_username(id):
         result = cursor.execute("SELECT username FROM users WHERE id = ?", (id,)).fetchone()
         return result[0] if result else None
 
-def users_utm_count(url):
+def normalize_username(username):
+    if not username:
+        return None
+    return username.strip().lstrip('@').lower() or None
+
+class UsernameResolver:
+    """username -> id без учёта регистра: LRU с TTL поверх индекса users(username_norm).
+
+    Новый username пользователя попадает в кеш сразу через remember(), а старый, как и смены
+    из других процессов, перестаёт находиться не позже чем через ttl секунд."""
+
+    def __init__(self, size=10000, ttl=600):
+        self.size = size
+        self.ttl = ttl
+        self.cache = OrderedDict()
+
+    def _put(self, norm, user_id):
+        self.cache[norm] = (user_id, time.monotonic() + self.ttl)
+        self.cache.move_to_end(norm)
+        if len(self.cache) > self.size:
+            self.cache.popitem(last=False)
+
+    def resolve(self, username):
+        norm = normalize_username(username)
+        if norm is None:
+            return None
+        entry = self.cache.get(norm)
+        if entry is not None and entry[1] > time.monotonic():
+            self.cache.move_to_end(norm)
+            return entry[0]
+        with sqlite3.connect(DATABASE_NAME) as conn:
+            cursor = conn.cursor()
+            result = cursor.execute("SELECT id FROM users WHERE username_norm = ?", (norm,)).fetchone()
+        if result is None:
+            self.cache.pop(norm, None)
+            return None
+        self._put(norm, result[0])
+        return result[0]
+
+    def remember(self, user_id, username):
+        norm = normalize_username(username)
+        if norm is not None:
+            self._put(norm, user_id)
+
+usernames = UsernameResolver()
+
+def update_usernames(changes):
+    """Пачка (user_id, username) одной транзакцией. Пишутся только строки, где username
+    действительно изменился; возвращает число изменённых строк."""
     with sqlite3.connect(DATABASE_NAME) as conn:
         cursor = conn.cursor()
-        cursor.execute("SELECT count_users FROM utm_data WHERE url = ?", (url,))
-        result = cursor.fetchone()
-        if result:
-            return result[0]
-        else:
-            return 0
-        
-def users_utm_count_op(url):
+        cursor.executemany("UPDATE users SET username = ?, username_norm = ? WHERE id = ? AND username IS NOT ?",
+                           [(username, normalize_username(username), user_id, username) for user_id, username in changes])
+        conn.commit()
+    for user_id, username in changes:
+        usernames.remember(user_id, username)
+    return cursor.rowcount
+
+def readd_username(id, username):
+    return update_usernames([(id, username)]) > 0
+
+def save_profiles(profiles):
+    """Пачка (user_id, first_name, username, language_code, is_premium) одной транзакцией;
+    строки без изменений не перезаписываются."""
+    now = time.time()
+    with sqlite3.connect(DATABASE_NAME) as conn:
+        cursor = conn.cursor()
+        cursor.executemany('''
+            INSERT INTO user_profiles (user_id, first_name, username, language_code, is_premium, updated_at) VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET
+                first_name = excluded.first_name, username = excluded.username, language_code = excluded.language_code,
+                is_premium = excluded.is_premium, updated_at = excluded.updated_at
+            WHERE first_name IS NOT excluded.first_name OR username IS NOT excluded.username
+                OR language_code IS NOT excluded.language_code OR is_premium IS NOT excluded.is_premium
+        ''', [(*profile, now) for profile in profiles])
+        conn.commit()
+        return cursor.rowcount
+
+def get_profile(user_id):
+    """(first_name, username, language_code, is_premium) или None, если пользователь ещё не писал боту."""
     with sqlite3.connect(DATABASE_NAME) as conn:
         cursor = conn.cursor()
-        cursor.execute("SELECT count_op_users FROM utm_data WHERE url = ?", (url,))
-        result = cursor.fetchone()
-        if result:
-            return result[0]
-        else:
-            return 0
+        result = cursor.execute('SELECT first_name, username, language_code, is_premium FROM user_profiles WHERE user_id = ?', (user_id,)).fetchone()
+        return (result[0], result[1], result[2], bool(result[3])) if result else None
 
 def get_id_from_username(username):
-    with sqlite3.connect(DATABASE_NAME) as conn:
-        cursor = conn.cursor()
-        result = cursor.execute("SELECT id FROM users WHERE username = ?", (username,)).fetchone()
-        return result[0] if result else None
+    return usernames.resolve(username)
+
+KNB_GAME_TTL = 10 * 60 # сек на то, чтобы принять игру и сделать ходы
+
+KNB_BEATS = {'stone': 'scissors', 'scissors': 'paper', 'paper': 'stone'}
+KNB_DRAW = "Ничья"
+KNB_FIRST_WON = "Первый игрок победил!"
+KNB_SECOND_WON = "Второй игрок победил!"
+KNB_REFUNDED = "Возврат по таймауту"
+
+def knb_outcome(choice_first, choice_second):
+    if choice_first == choice_second:
+        return KNB_DRAW
+    return KNB_FIRST_WON if KNB_BEATS[choice_first] == choice_second else KNB_SECOND_WON
+
+class KnbEngine:
+    """Живые игры КНБ: кеш в памяти с TTL на игру поверх таблицы knb.
+
+    Ставки обоих игроков списываются одной транзакцией при принятии игры (эскроу),
+    итог с выплатой пишется одной транзакцией по второму ходу. Каждый шаг — условный
+    UPDATE по result IS NULL, поэтому повторные нажатия и гонки с другими процессами
+    (второй игрок может обслуживаться другим воркером) ничего не задваивают.
+    Игры, не доигранные за ttl секунд, снимает expire(): принятые — с возвратом ставок."""
+
+    COLUMNS = 'id_game, first_player, second_player, choice_first, choice_second, result, bet, first_name, second_name, accepted_at, expires_at'
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.games = {}
+
+    @staticmethod
+    def _game(row):
+        game_id, first, second, choice_first, choice_second, result, bet, first_name, second_name, accepted_at, expires_at = row
+        return {'id': game_id, 'first': first, 'second': second, 'choice_first': choice_first, 'choice_second': choice_second,
+                'result': result, 'bet': Money(bet), 'first_name': first_name, 'second_name': second_name,
+                'accepted_at': accepted_at, 'expires_at': expires_at or 0}
+
+    def get(self, game_id):
+        """Открытая игра или None, если её нет, она завершена или истекла."""
+        game = self.games.get(game_id)
+        if game is None:
+            with sqlite3.connect(DATABASE_NAME) as conn:
+                cursor = conn.cursor()
+                row = cursor.execute(f'SELECT {self.COLUMNS} FROM knb WHERE id_game = ? AND result IS NULL', (game_id,)).fetchone()
+            if row is None:
+                return None
+            game = self.games[game_id] = self._game(row)
+        if game['expires_at'] < time.time():
+            self.games.pop(game_id, None)
+            return None
+        return game
 
-def set_result(id_game, choice_first, choice_second):
-    with sqlite3.connect(DATABASE_NAME) as conn:
-        cursor = conn.cursor()
-        
-        if choice_first == choice_second:
-            result = "Ничья"
-        elif choice_first == "stone" and choice_second == "scissors":
-            # print(1)
-            result = "Первый игрок победил!"
-        elif choice_first == "scissors" and choice_second == "paper":
-            result = "Первый игрок победил!"
-        elif choice_first == "paper" and choice_second == "stone":
-            result = "Первый игрок победил!"
-        elif choice_first == "scissors" and choice_second == "stone":
-            result = "Второй игрок победил!"
-        elif choice_first == "paper" and choice_second == "scissors":
-            result = "Второй игрок победил!"
-        elif choice_first == "stone" and choice_second == "paper":
-            result = "Второй игрок победил!"
-        
-        try:
+    def create(self, first, second, bet, first_name=None, second_name=None):
+        expires_at = time.time() + self.ttl
+        with sqlite3.connect(DATABASE_NAME) as conn:
+            cursor = conn.cursor()
+            cursor.execute('INSERT INTO knb (first_player, second_player, bet, first_name, second_name, expires_at) VALUES (?, ?, ?, ?, ?, ?)',
+                           (first, second, to_milli(bet), first_name, second_name, expires_at))
+            game_id = cursor.lastrowid
+            conn.commit()
+        game = self.games[game_id] = self._game((game_id, first, second, None, None, None, to_milli(bet), first_name, second_name, None, expires_at))
+        return game
+
+    def decline(self, game_id, user_id):
+        with sqlite3.connect(DATABASE_NAME) as conn:
+            cursor = conn.cursor()
+            cursor.execute('DELETE FROM knb WHERE id_game = ? AND second_player = ? AND accepted_at IS NULL AND result IS NULL', (game_id, user_id))
+            conn.commit()
+            declined = cursor.rowcount > 0
+        if declined:
+            self.games.pop(game_id, None)
+        return declined
+
+    def accept(self, game_id, user_id, second_name=None):
+        """Эскроу: проверка балансов и списание ставки с обоих игроков одной транзакцией."""
+        game = self.get(game_id)
+        if game is None or game['second'] != user_id or game['accepted_at']:
+            return False, "⚠️ Игра не найдена или уже началась."
+        bet = game['bet'].milli
+        now = time.time()
+        with sqlite3.connect(DATABASE_NAME) as conn:
+            cursor = conn.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            balances = dict(cursor.execute('SELECT id, stars FROM users WHERE id IN (?, ?)', (game['first'], game['second'])))
+            if balances.get(game['second'], 0) < bet:
+                conn.rollback()
+                return False, "🚫 У вас недостаточно звёзд."
+            if balances.get(game['first'], 0) < bet:
+                conn.rollback()
+                return False, "🚫 У соперника недостаточно звёзд."
+            cursor.execute('UPDATE knb SET accepted_at = ?, expires_at = ?, second_name = COALESCE(?, second_name) WHERE id_game = ? AND accepted_at IS NULL AND result IS NULL',
+                           (now, now + self.ttl, second_name, game_id))
+            if cursor.rowcount == 0:
+                conn.rollback()
+                self.games.pop(game_id, None)
+                return False, "⚠️ Игра не найдена или уже началась."
+            cursor.execute('UPDATE users SET stars = stars - ? WHERE id IN (?, ?)', (bet, game['first'], game['second']))
+            writes = _hot_write(cursor, game['first']), _hot_write(cursor, game['second'])
+            conn.commit()
+            _hot_apply(cursor, *writes)
+        activity.track('bet', bet * 2, count=2)
+        game.update(accepted_at=now, expires_at=now + self.ttl, second_name=second_name or game['second_name'])
+        return True, game
+
+    def move_first(self, game_id, user_id, choice):
+        # Кэш другого воркера мог не увидеть accept, поэтому решение принимает строка в базе
+        if choice not in KNB_BEATS:
+            return False, "⚠️ Ход уже сделан или игра завершена."
+        with sqlite3.connect(DATABASE_NAME) as conn:
+            cursor = conn.cursor()
             cursor.execute(
-                "UPDATE knb SET result = ? WHERE id_game = ?",
-                (result, id_game)
+                'UPDATE knb SET choice_first = ? WHERE id_game = ? AND first_player = ? AND accepted_at IS NOT NULL '
+                'AND choice_first IS NULL AND result IS NULL AND expires_at > ?',
+                (choice, game_id, user_id, time.time())
             )
-            
-            if result != "Ничья":
-                bet = get_bet(id_game)
-                winner = "first_player" if result.startswith("Первый") else "second_player"
-                # print(winner)
-                cursor.execute(
-                    "SELECT first_player, second_player FROM knb WHERE id_game = ?",
-                    (id_game,)
-                )
-                first_id, second_id = cursor.fetchone()
-                winner_id = first_id if winner == "first_player" else second_id
-            
+            if cursor.rowcount == 0:
+                conn.rollback()
+                self.games.pop(game_id, None)
+                return False, "⚠️ Ход уже сделан или игра завершена."
+            cursor.execute(f'SELECT {self.COLUMNS} FROM knb WHERE id_game = ?', (game_id,))
+            row = cursor.fetchone()
             conn.commit()
-            return result
-        
-        except Exception as e:
-            conn.rollback()
-            raise e
+        game = self.games[game_id] = self._game(row)
+        return True, game
 
-def get_bet(game_id):
-    with sqlite3.connect(DATABASE_NAME) as conn:
-        cursor = conn.cursor()
-        return cursor.execute("SELECT bet FROM knb WHERE id_game = ?", (game_id,)).fetchone()[0]
+    def settle(self, game_id, user_id, choice):
+        """Ход второго игрока: итог, выплата и запись результата одной транзакцией."""
+        if choice not in KNB_BEATS:
+            return False, "⚠️ Неизвестный ход."
+        with sqlite3.connect(DATABASE_NAME) as conn:
+            cursor = conn.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            # Первый ход мог прийти в другой процесс, поэтому строка читается внутри транзакции
+            row = cursor.execute(f'SELECT {self.COLUMNS} FROM knb WHERE id_game = ? AND result IS NULL', (game_id,)).fetchone()
+            game = self._game(row) if row else None
+            if game is None or game['second'] != user_id or not game['accepted_at'] or not game['choice_first'] or game['expires_at'] < time.time():
+                conn.rollback()
+                return False, "⚠️ Ход уже сделан или игра завершена."
+            result = knb_outcome(game['choice_first'], choice)
+            bet = game['bet'].milli
+            if result == KNB_DRAW:
+                payouts = [(bet, game['first']), (bet, game['second'])]
+                winner_id = None
+            else:
+                winner_id = game['first'] if result == KNB_FIRST_WON else game['second']
+                payouts = [(bet * 2, winner_id)]
+            cursor.execute('UPDATE knb SET choice_second = ?, result = ? WHERE id_game = ?', (choice, result, game_id))
+            cursor.executemany('UPDATE users SET stars = stars + ? WHERE id = ?', payouts)
+            writes = [_hot_write(cursor, player_id) for _, player_id in payouts]
+            conn.commit()
+            _hot_apply(cursor, *writes)
+        self.games.pop(game_id, None)
+        game.update(choice_second=choice, result=result, winner_id=winner_id)
+        return True, game
+
+    def expire(self):
+        """Снимает игры с истёкшим TTL: приглашения удаляются, по принятым ставки возвращаются.
+        Возвращает игры, по которым был возврат, чтобы предупредить игроков."""
+        now = time.time()
+        for game_id in [game_id for game_id, game in self.games.items() if game['expires_at'] < now]:
+            del self.games[game_id]
+        with sqlite3.connect(DATABASE_NAME) as conn:
+            cursor = conn.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            rows = cursor.execute(f'SELECT {self.COLUMNS} FROM knb WHERE result IS NULL AND expires_at < ?', (now,)).fetchall()
+            if not rows:
+                conn.rollback()
+                return []
+            games = [self._game(row) for row in rows]
+            refunded = [game for game in games if game['accepted_at']]
+            cursor.executemany('DELETE FROM knb WHERE id_game = ?', [(game['id'],) for game in games if not game['accepted_at']])
+            cursor.executemany('UPDATE knb SET result = ? WHERE id_game = ?', [(KNB_REFUNDED, game['id']) for game in refunded])
+            refunds = [(game['bet'].milli, player_id) for game in refunded for player_id in (game['first'], game['second'])]
+            cursor.executemany('UPDATE users SET stars = stars + ? WHERE id = ?', refunds)
+            writes = [_hot_write(cursor, player_id) for _, player_id in refunds]
+            conn.commit()
+            _hot_apply(cursor, *writes)
+        return refunded
 
-def get_choice(player_id):
-    with sqlite3.connect(DATABASE_NAME) as conn:
-        cursor = conn.cursor()
-        if player_id == "first_player":
-            return cursor.execute("SELECT choice_first FROM knb WHERE first_player = ?", (player_id,)).fetchone()[0]
-        elif player_id == "second_player":
-            return cursor.execute("SELECT choice_second FROM knb WHERE second_player = ?", (player_id,)).fetchone()[0]
-        else:
-            return None
-
-def change_choice(game_id, player_id, choice):
-    with sqlite3.connect(DATABASE_NAME) as conn:
-        cursor = conn.cursor()
-        if player_id == "first_player":
-            cursor.execute("UPDATE knb SET choice_first = ? WHERE id_game = ?", (choice, game_id))
-        elif player_id == "second_player":
-            cursor.execute("UPDATE knb SET choice_second = ? WHERE id_game = ?", (choice, game_id))
-        conn.commit()
-        return True
+knb = KnbEngine(KNB_GAME_TTL)
 
 def get_knb_game(game_id):
     with sqlite3.connect(DATABASE_NAME) as conn:
         cursor = conn.cursor()
-        return cursor.execute("SELECT * FROM knb WHERE id_game = ?", (game_id,)).fetchone()
+        game = cursor.execute("SELECT * FROM knb WHERE id_game = ?", (game_id,)).fetchone()
+        return game[:6] + (Money(game[6]),) + game[7:] if game else None
 
-def create_knb(first_player, second_player, choice_first=None, choice_second=None, result=None, bet=0):
-    with sqlite3.connect(DATABASE_NAME) as conn:
-        cursor = conn.cursor()
-        cursor.execute("INSERT INTO knb (first_player, second_player, choice_first, choice_second, result, bet) VALUES (?, ?, ?, ?, ?, ?)", (first_player, second_player, choice_first, choice_second, result, bet))
-        game_id = cursor.lastrowid
-        conn.commit()
-        return game_id
-    
 def delete_knb(game_id):
     with sqlite3.connect(DATABASE_NAME) as conn:
         cursor = conn.cursor()
@@ -463,51 +1236,61 @@ def delete_knb(game_id):
 def create_lottery(cash, ticket_cash):
     with sqlite3.connect(DATABASE_NAME) as conn:
         cursor = conn.cursor()
-        cursor.execute("INSERT INTO lottery (status, cash, ticket_cash) VALUES ('enabled', ?, ?)", (cash, ticket_cash))
+        cursor.execute("INSERT INTO lottery (status, cash, ticket_cash) VALUES ('enabled', ?, ?)", (to_milli(cash), to_milli(ticket_cash)))
         conn.commit()
         return True
     
-def finish_and_update_winner():
+def finish_and_update_winner(share=0.6):
+    """Розыгрыш активной лотереи одной транзакцией: закрывает её, выбирает победителя
+    с весом по числу билетов и начисляет ему share от банка.
+    Участники читаются потоком: случайный номер билета из SUM(count_tickets), затем
+    накопленная сумма до этого номера — память не зависит от числа билетов.
+    Возвращает (False, None), если лотереи или билетов нет, иначе (True, итог розыгрыша)."""
     with sqlite3.connect(DATABASE_NAME) as conn:
-        conn.execute("PRAGMA foreign_keys = ON")
         cursor = conn.cursor()
-
+        cursor.execute('BEGIN IMMEDIATE')
         active_lottery = cursor.execute("""
-            SELECT id
-            FROM lottery 
+            SELECT id, cash
+            FROM lottery
             WHERE status = 'enabled'
         """).fetchone()
-
         if not active_lottery:
-            raise ValueError("Нет активной лотереи")
-
-        lottery_id = active_lottery[0]
-
-
-        participants = cursor.execute("""
-            SELECT user_id, count_tickets 
-            FROM lottery_data 
-            WHERE count_tickets > 0 
-            AND lottery_id = ?
-        """, (lottery_id,)).fetchall()
-
-        if not participants:
-            raise ValueError("Нет участников с билетами")
-
-        weighted_users = []
-        for user_id, tickets in participants:
-            weighted_users.extend([user_id] * tickets)
-
-        winner_id = random.choice(weighted_users)
-
+            conn.rollback()
+            return False, None
+        lottery_id, cash = active_lottery
+
+        total_tickets = cursor.execute("""
+            SELECT COALESCE(SUM(count_tickets), 0)
+            FROM lottery_data
+            WHERE lottery_id = ? AND count_tickets > 0
+        """, (lottery_id,)).fetchone()[0]
+        if not total_tickets:
+            conn.rollback()
+            return False, None
+
+        ticket = random.randrange(total_tickets)
+        winner_id = None
+        for user_id, tickets in cursor.execute("""
+            SELECT user_id, count_tickets
+            FROM lottery_data
+            WHERE lottery_id = ? AND count_tickets > 0
+        """, (lottery_id,)):
+            if ticket < tickets:
+                winner_id = user_id
+                break
+            ticket -= tickets
+
+        prize = Money(cash) * share
         cursor.execute("""
-            UPDATE lottery 
+            UPDATE lottery
             SET status = 'disabled', winner_id = ?
             WHERE id = ?
         """, (winner_id, lottery_id))
-
+        cursor.execute('UPDATE users SET stars = stars + ? WHERE id = ?', (prize.milli, winner_id))
+        write = _hot_write(cursor, winner_id)
         conn.commit()
-        return True, winner_id
+        _hot_apply(cursor, write)
+        return True, {'lottery_id': lottery_id, 'winner_id': winner_id, 'prize': prize, 'tickets': total_tickets}
 
 def get_cash_in_lottery():
     with sqlite3.connect(DATABASE_NAME) as conn:
@@ -515,7 +1298,7 @@ def get_cash_in_lottery():
         cursor.execute("SELECT cash FROM lottery WHERE status = 'enabled'")
         result = cursor.fetchone()
         if result:
-            return result[0]
+            return Money(result[0])
         else:
             return "Нет."
         
@@ -525,7 +1308,7 @@ def get_ticket_cash_in_lottery():
         cursor.execute("SELECT ticket_cash FROM lottery WHERE status = 'enabled'")
         result = cursor.fetchone()
         if result:
-            return result[0]
+            return Money(result[0])
         else:
             return "Нет."
     
@@ -565,8 +1348,9 @@ def add_lottery_entry(lottery_id, user_id, username, cash, count_tickets=1):
             UPDATE lottery 
             SET cash = cash + ?
             WHERE id = ?
-        """, (cash, lottery_id))
+        """, (to_milli(cash), lottery_id))
         conn.commit()
+        activity.track('bet', to_milli(cash), count=count_tickets)
         return True
     
 def get_active_lottery_id():
@@ -586,146 +1370,149 @@ def add_or_update_user_boost(user_id, end_time):
             cursor.execute("UPDATE booster SET end_time = ? WHERE user_id = ?", (end_time, user_id))
         else:
             cursor.execute("INSERT INTO booster (user_id, end_time) VALUES (?, ?)", (user_id, end_time))
-        
+        write = _hot_write(cursor, user_id)
         conn.commit()
+        _hot_apply(cursor, write)
         return True
 
 def remove_user_boost(user_id):
     with sqlite3.connect(DATABASE_NAME) as conn:
         cursor = conn.cursor()
         cursor.execute("DELETE FROM booster WHERE user_id = ?", (user_id,))
+        write = _hot_write(cursor, user_id)
         conn.commit()
+        _hot_apply(cursor, write)
         return True
 
 def check_expired_boosts():
-    current_time = datetime.datetime.now().timestamp()
+    """Снимает истёкшие бусты из кучи одной транзакцией. Возвращает число снятых бустов."""
+    current_time = time.time()
+    sync_hot_state()
+    expired_users = boosts.pop_expired(current_time)
+    if not expired_users:
+        return 0
     with sqlite3.connect(DATABASE_NAME) as conn:
         cursor = conn.cursor()
-        cursor.execute("SELECT user_id, end_time FROM booster WHERE end_time < ?", (current_time,))
-        expired_users = cursor.fetchall()
-        
-        for user_id, _ in expired_users:
-            remove_user_boost(user_id)
-            print(f"Удален буст для пользователя с ID: {user_id}")
+        cursor.executemany("DELETE FROM booster WHERE user_id = ? AND end_time <= ?", [(user_id, current_time) for user_id in expired_users])
+        writes = [_hot_write(cursor, user_id) for user_id in expired_users]
+        conn.commit()
+        _hot_apply(cursor, *writes)
+    print(f"Удалено истёкших бустов: {len(expired_users)}")
+    return len(expired_users)
+
+def next_boost_expiry():
+    sync_hot_state()
+    return boosts.next_expiry()
 
 def user_in_booster(user_id):
-    with sqlite3.connect(DATABASE_NAME) as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM booster WHERE user_id = ?", (user_id,))
-        result = cursor.fetchone()
-        return True if result else False
+    end_time = _hot_get(user_id, 'boost_end')
+    return bool(end_time) and end_time > time.time()
 
 def get_time_until_boost(user_id):
-    with sqlite3.connect(DATABASE_NAME) as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT end_time FROM booster WHERE user_id = ?", (user_id,))
-        result = cursor.fetchone()
-        if result:
-            end_time = result[0]
-            current_time = time.time()
-            time_until_boost = end_time - current_time
-            return time_until_boost
-        else:
-            return None
+    end_time = _hot_get(user_id, 'boost_end')
+    if end_time and end_time > time.time():
+        return end_time - time.time()
+    return None
 
-def get_clicks_by_period(period):
-    if period not in ['day', 'week', 'month']:
-        raise ValueError("Неизвестный период. Допустимые значения: 'day', 'week', 'month'")
+ACTIVITY_EVENTS = ('registration', 'click', 'gift', 'withdrawal', 'bet')
 
-    try:
-        with sqlite3.connect(DATABASE_NAME) as conn:
-            cursor = conn.cursor()
-            now_timestamp = time.time()
-            now = datetime.fromtimestamp(now_timestamp, timezone.utc)
-
-            if period == 'day':
-                start_of_period = datetime(now.year, now.month, now.day, tzinfo=timezone.utc)
-                time_threshold = start_of_period.timestamp()
-                query = '''
-                    SELECT SUM(click_count)
-                    FROM click_times
-                    WHERE last_click_time >= ?
-                '''
-                params = (time_threshold,)
-            elif period == 'week':
-                start_of_week = now - timedelta(days=now.weekday())
-                start_of_period = datetime(start_of_week.year, start_of_week.month, start_of_week.day, tzinfo=timezone.utc)
-                time_threshold = start_of_period.timestamp()
-                query = '''
-                    SELECT SUM(click_count)
-                    FROM click_times
-                    WHERE last_click_time >= ?
-                '''
-                params = (time_threshold,)
-            elif period == 'month':
-                query = '''
-                    SELECT SUM(click_count)
-                    FROM click_times
-                '''
-                params = ()
-
-            cursor.execute(query, params)
-            result = cursor.fetchone()
-            return result[0] if result and result[0] is not None else 0
+class ActivityRollup:
+    """Поток событий активности, свёрнутый в почасовые и дневные корзины (UTC).
 
-    except sqlite3.Error as e:
-        print(f"Database error: {e}")
-        return 0
-    except Exception as e:
-        print(f"An error occurred: {e}")
-        return 0
+    track() только увеличивает счётчик в памяти процесса; flush() фоном пишет накопленное
+    в activity_hourly и activity_daily одной транзакцией. Статистика и графики читают
+    готовые корзины — O(число корзин), без сканирования users и click_times."""
 
+    def __init__(self):
+        self.pending = {}
 
-def get_users_by_period(period):
-    if period not in ['day', 'week', 'month']:
-        raise ValueError("Недопустимый период. Ожидается 'day', 'week' или 'month'.")
+    def track(self, event, amount=0, count=1, at=None):
+        hour = int((at or time.time()) // 3600)
+        counters = self.pending.setdefault((event, hour), [0, 0])
+        counters[0] += count
+        counters[1] += amount
 
-    try:
+    def flush(self):
+        if not self.pending:
+            return 0
+        pending, self.pending = self.pending, {}
+        daily = {}
+        for (event, hour), (count, amount) in pending.items():
+            counters = daily.setdefault((event, hour // 24), [0, 0])
+            counters[0] += count
+            counters[1] += amount
+        try:
+            with sqlite3.connect(DATABASE_NAME) as conn:
+                cursor = conn.cursor()
+                for table, bucket, rows in (('activity_hourly', 'hour', pending), ('activity_daily', 'day', daily)):
+                    cursor.executemany(f'''
+                        INSERT INTO {table} (event, {bucket}, count, amount) VALUES (?, ?, ?, ?)
+                        ON CONFLICT(event, {bucket}) DO UPDATE SET count = count + excluded.count, amount = amount + excluded.amount
+                    ''', [(event, key, count, amount) for (event, key), (count, amount) in rows.items()])
+                conn.commit()
+        except Exception:
+            # Не теряем события: вернутся в следующую запись
+            for key, (count, amount) in pending.items():
+                counters = self.pending.setdefault(key, [0, 0])
+                counters[0] += count
+                counters[1] += amount
+            raise
+        return len(pending)
+
+    def total(self, event, since=None):
+        """(число событий, сумма в Money) с начала дня, в который попадает since; без since — за всё время."""
+        day = int(since // 86400) if since is not None else 0
         with sqlite3.connect(DATABASE_NAME) as conn:
             cursor = conn.cursor()
+            count, amount = cursor.execute('SELECT COALESCE(SUM(count), 0), COALESCE(SUM(amount), 0) FROM activity_daily WHERE event = ? AND day >= ?',
+                                           (event, day)).fetchone()
+        for (pending_event, hour), (pending_count, pending_amount) in self.pending.items():
+            if pending_event == event and hour // 24 >= day:
+                count += pending_count
+                amount += pending_amount
+        return count, Money(amount)
+
+    def series(self, event, buckets=24, bucket='hour'):
+        """Последние buckets корзин ('hour' или 'day') для графика: [(начало корзины, число, Money)]."""
+        table, size = ('activity_hourly', 3600) if bucket == 'hour' else ('activity_daily', 86400)
+        last = int(time.time() // size)
+        with sqlite3.connect(DATABASE_NAME) as conn:
+            cursor = conn.cursor()
+            rows = dict((key, [count, amount]) for key, count, amount in cursor.execute(
+                f'SELECT {bucket}, count, amount FROM {table} WHERE event = ? AND {bucket} > ?', (event, last - buckets)))
+        for (pending_event, hour), (count, amount) in self.pending.items():
+            key = hour if bucket == 'hour' else hour // 24
+            if pending_event == event and key > last - buckets:
+                counters = rows.setdefault(key, [0, 0])
+                counters[0] += count
+                counters[1] += amount
+        result = []
+        for key in range(last - buckets + 1, last + 1):
+            count, amount = rows.get(key, (0, 0))
+            result.append((key * size, count, Money(amount)))
+        return result
+
+activity = ActivityRollup()
+
+def activity_period_start(period):
+    """Начало периода статистики (UTC): 'day' — полночь, 'week' — понедельник, 'month' — всё время."""
+    now = datetime.now(timezone.utc)
+    if period == 'day':
+        return datetime(now.year, now.month, now.day, tzinfo=timezone.utc).timestamp()
+    if period == 'week':
+        start_of_week = now - timedelta(days=now.weekday())
+        return datetime(start_of_week.year, start_of_week.month, start_of_week.day, tzinfo=timezone.utc).timestamp()
+    return None
 
-            if cursor.execute('SELECT name FROM sqlite_master WHERE type="table" AND name="users"').fetchone() is None:
-                print('Таблица "users" не существует.')
-                return 0
-
-            if period == 'day':
-                now = datetime.now(timezone.utc)
-                start_of_period = datetime(now.year, now.month, now.day, tzinfo=timezone.utc)
-                time_threshold = start_of_period.timestamp()
-                query = '''
-                    SELECT COUNT(*)
-                    FROM users
-                    WHERE registration_time >= ?
-                '''
-                params = (time_threshold,)
-            elif period == 'week':
-                now = datetime.now(timezone.utc)
-                start_of_week = now - timedelta(days=now.weekday())
-                start_of_period = datetime(start_of_week.year, start_of_week.month, start_of_week.day, tzinfo=timezone.utc)
-                time_threshold = start_of_period.timestamp()
-                query = '''
-                    SELECT COUNT(*)
-                    FROM users
-                    WHERE registration_time >= ?
-                '''
-                params = (time_threshold,)
-            elif period == 'month':
-                query = '''
-                    SELECT COUNT(*)
-                    FROM users
-                '''
-                params = ()
-
-            cursor.execute(query, params)
-            result = cursor.fetchone()
-            return result[0] if result else 0
+def get_clicks_by_period(period):
+    if period not in ['day', 'week', 'month']:
+        raise ValueError("Неизвестный период. Допустимые значения: 'day', 'week', 'month'")
+    return activity.total('click', activity_period_start(period))[0]
 
-    except sqlite3.Error as e:
-        print(f"Ошибка базы данных: {e}")
-        return 0
-    except Exception as e:
-        print(f"Произошла ошибка: {e}")
-        return 0
+def get_users_by_period(period):
+    if period not in ['day', 'week', 'month']:
+        raise ValueError("Недопустимый период. Ожидается 'day', 'week' или 'month'.")
+    return activity.total('registration', activity_period_start(period))[0]
 
 def change_status(id, status):
     with sqlite3.connect(DATABASE_NAME) as conn:
@@ -748,11 +1535,7 @@ def get_user_referrals_count(referrer_id):
     try:
         with sqlite3.connect(DATABASE_NAME) as conn:
             cursor = conn.cursor()
-            cursor.execute('''
-                SELECT COUNT(*)
-                FROM users
-                WHERE referral_id = ?;
-            ''', (referrer_id,))
+            cursor.execute('SELECT count_refs FROM users WHERE id = ?', (referrer_id,))
             result = cursor.fetchone()
             if result and result[0] is not None:
                 return result[0]
@@ -771,104 +1554,296 @@ def get_id_refferer(user_id):
 def get_withdrawn(user_id):
     with sqlite3.connect(DATABASE_NAME) as conn:
         cursor = conn.cursor()
-        return cursor.execute('SELECT withdrawn FROM users WHERE id = ?', (user_id,)).fetchone()[0]
+        return Money(cursor.execute('SELECT withdrawn FROM users WHERE id = ?', (user_id,)).fetchone()[0])
     
-def get_top_balance():
-    with sqlite3.connect(DATABASE_NAME) as conn:
-        cursor = conn.cursor()
-        return cursor.execute('SELECT username, stars FROM users ORDER BY stars DESC LIMIT 50').fetchall()
+async def get_top_balance():
+    rows = await analytics.run(_read_rows, 'SELECT username, stars FROM users ORDER BY stars DESC LIMIT 50')
+    return [(username, Money(stars)) for username, stars in rows]
 
 def add_withdrawale(username, user_id, stars, status='Ожидает обработки ⚙️'):
     with sqlite3.connect(DATABASE_NAME) as conn:
         cursor = conn.cursor()
-        cursor.execute('INSERT INTO withdrawales (username, user_id, stars, status) VALUES (?, ?, ?, ?)', (username, user_id, stars, status))
+        cursor.execute('INSERT INTO withdrawales (username, user_id, stars, status) VALUES (?, ?, ?, ?)', (username, user_id, to_milli(stars), status))
         conn.commit()
         return True, cursor.lastrowid
 
-def get_status_withdrawal(user_id):
+def create_callback_context(payload):
+    """Сохраняет контекст действия и возвращает короткий токен для callback_data."""
     with sqlite3.connect(DATABASE_NAME) as conn:
         cursor = conn.cursor()
-        return cursor.execute('SELECT status FROM withdrawales WHERE user_id = ?', (user_id,)).fetchone()[0]
+        while True:
+            token = secrets.token_urlsafe(8)
+            try:
+                cursor.execute('INSERT INTO callback_contexts (token, payload, created_at) VALUES (?, ?, ?)', (token, json.dumps(payload, ensure_ascii=False), time.time()))
+                conn.commit()
+                return token
+            except sqlite3.IntegrityError:
+                continue
 
-def get_withdrawals(user_id):
+def get_callback_context(token):
     with sqlite3.connect(DATABASE_NAME) as conn:
         cursor = conn.cursor()
-        return cursor.execute('SELECT * FROM withdrawales WHERE user_id = ?', (user_id,)).fetchall()
+        result = cursor.execute('SELECT payload FROM callback_contexts WHERE token = ?', (token,)).fetchone()
+        return json.loads(result[0]) if result else None
 
-def get_count_clicks(user_id):
+def delete_callback_context(token):
     with sqlite3.connect(DATABASE_NAME) as conn:
         cursor = conn.cursor()
-        cursor.execute('SELECT click_count FROM click_times WHERE user_id = ?', (user_id,))
-        result = cursor.fetchone()
-        if result:
-            return result[0]
-        else:
-            return 0
+        cursor.execute('DELETE FROM callback_contexts WHERE token = ?', (token,))
+        conn.commit()
+        return True
+
+def delete_stale_callback_contexts(max_age):
+    """Удаляет контексты кнопок, по которым так и не нажали за max_age секунд."""
+    with sqlite3.connect(DATABASE_NAME) as conn:
+        cursor = conn.cursor()
+        cursor.execute('DELETE FROM callback_contexts WHERE created_at < ?', (time.time() - max_age,))
+        conn.commit()
+        return cursor.rowcount
+
+WITHDRAWAL_PENDING = 'Ожидает обработки ⚙️'
+WITHDRAWAL_PAID = 'Подарок отправлен 🎁'
+WITHDRAWAL_DENIED = 'Отказано 🚫'
+
+# Сумма списания за подарки Telegram Premium
+WITHDRAWAL_KIND_PRICES = {'premium1': 400, 'premium2': 1100}
+
+def request_withdrawal(user_id, amount, kind='stars', username=None, emoji=None):
+    """Заявка на вывод одной транзакцией: проверка баланса и недельных рефералов, списание и запись в withdrawales.
+    Возвращает (True, заявка) или (False, текст ошибки для пользователя)."""
+    milli = to_milli(amount)
+    need_refs = 10 if user_in_booster(user_id) else 15
+    start_ts, _ = get_period_timestamps('week')
+    with sqlite3.connect(DATABASE_NAME) as conn:
+        cursor = conn.cursor()
+        # IMMEDIATE сразу берёт блокировку записи: между проверкой баланса и списанием никто не вклинится
+        cursor.execute('BEGIN IMMEDIATE')
+        row = cursor.execute('SELECT stars, username, CASE WHEN week_refs_start = ? THEN week_refs ELSE 0 END FROM users WHERE id = ?',
+                             (start_ts, user_id)).fetchone()
+        if row is None or row[0] < milli:
+            conn.rollback()
+            return False, "❌ У вас недостаточно звезд для вывода!"
+        count_refs = row[2]
+        if count_refs < need_refs:
+            conn.rollback()
+            return False, f"❌ Для вывода надо минимум {need_refs} рефералов за текущую неделю! У тебя {count_refs}"
+        username = username or row[1]
+        cursor.execute('UPDATE users SET stars = stars - ?, withdrawn = withdrawn + ? WHERE id = ?', (milli, milli, user_id))
+        cursor.execute('INSERT INTO withdrawales (username, user_id, stars, status, kind, emoji, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                       (username, user_id, milli, WITHDRAWAL_PENDING, kind, emoji, time.time()))
+        withdrawal_id = cursor.lastrowid
+        write = _hot_write(cursor, user_id)
+        conn.commit()
+        _hot_apply(cursor, write)
+    activity.track('withdrawal', milli)
+    return True, {'id': withdrawal_id, 'user_id': user_id, 'username': username, 'stars': Money(milli),
+                  'kind': kind, 'emoji': emoji, 'status': WITHDRAWAL_PENDING}
+
+def set_withdrawal_message(withdrawal_id, message_id):
+    with sqlite3.connect(DATABASE_NAME) as conn:
+        cursor = conn.cursor()
+        cursor.execute('UPDATE withdrawales SET message_id = ? WHERE id = ?', (message_id, withdrawal_id))
+        conn.commit()
+        return True
+
+def set_withdrawal_status(withdrawal_id, status):
+    """Переводит заявку из ожидания в status. False, если её уже обработали (например, пачкой)."""
+    with sqlite3.connect(DATABASE_NAME) as conn:
+        cursor = conn.cursor()
+        cursor.execute('UPDATE withdrawales SET status = ? WHERE id = ? AND status = ?', (status, withdrawal_id, WITHDRAWAL_PENDING))
+        conn.commit()
+        return cursor.rowcount > 0
+
+def get_status_withdrawal(withdrawal_id):
+    with sqlite3.connect(DATABASE_NAME) as conn:
+        cursor = conn.cursor()
+        result = cursor.execute('SELECT status FROM withdrawales WHERE id = ?', (withdrawal_id,)).fetchone()
+        return result[0] if result else None
+
+WITHDRAWAL_COLUMNS = 'id, username, user_id, stars, status, kind, emoji, message_id, created_at'
+
+def _withdrawal_row(row):
+    return row[:3] + (Money(row[3]),) + row[4:]
+
+def get_pending_withdrawals(after_id=0, limit=10):
+    """Страница очереди на вывод: заявки в ожидании с id больше after_id (keyset, без OFFSET)."""
+    with sqlite3.connect(DATABASE_NAME) as conn:
+        cursor = conn.cursor()
+        cursor.execute(f'SELECT {WITHDRAWAL_COLUMNS} FROM withdrawales WHERE status = ? AND id > ? ORDER BY id LIMIT ?',
+                       (WITHDRAWAL_PENDING, after_id, limit))
+        return [_withdrawal_row(row) for row in cursor.fetchall()]
+
+def count_pending_withdrawals():
+    with sqlite3.connect(DATABASE_NAME) as conn:
+        cursor = conn.cursor()
+        return cursor.execute('SELECT COUNT(*) FROM withdrawales WHERE status = ?', (WITHDRAWAL_PENDING,)).fetchone()[0]
+
+def set_withdrawals_status(withdrawal_ids, status):
+    """Переводит пачку заявок из ожидания в status одной транзакцией.
+    Возвращает строки, которые действительно сменили статус (уже обработанные пропускаются).
+    Токены кнопок их постов удаляются сразу, не дожидаясь правки поста в канале."""
+    ids = list(withdrawal_ids)
+    if not ids:
+        return []
+    with sqlite3.connect(DATABASE_NAME) as conn:
+        cursor = conn.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        rows = []
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            placeholders = ', '.join('?' * len(chunk))
+            rows += cursor.execute(f'SELECT {WITHDRAWAL_COLUMNS} FROM withdrawales WHERE status = ? AND id IN ({placeholders}) ORDER BY id',
+                                   (WITHDRAWAL_PENDING, *chunk)).fetchall()
+        cursor.executemany('UPDATE withdrawales SET status = ? WHERE id = ?', [(status, row[0]) for row in rows])
+        for i in range(0, len(rows), 500):
+            chunk = [row[0] for row in rows[i:i + 500]]
+            placeholders = ', '.join('?' * len(chunk))
+            cursor.execute(f"DELETE FROM callback_contexts WHERE json_extract(payload, '$.id_v') IN ({placeholders})", chunk)
+        conn.commit()
+    return [_withdrawal_row(row[:4] + (status,) + row[5:]) for row in rows]
+
+def iter_withdrawals(status=None, batch_size=1000):
+    """Все заявки (или только со статусом status) по возрастанию id. Читается пачками,
+    каждая своим коротким запросом, поэтому выгрузка не держит базу и не грузит таблицу в память."""
+    last_id = 0
+    while True:
+        with sqlite3.connect(DATABASE_NAME) as conn:
+            cursor = conn.cursor()
+            if status is None:
+                cursor.execute(f'SELECT {WITHDRAWAL_COLUMNS} FROM withdrawales WHERE id > ? ORDER BY id LIMIT ?', (last_id, batch_size))
+            else:
+                cursor.execute(f'SELECT {WITHDRAWAL_COLUMNS} FROM withdrawales WHERE status = ? AND id > ? ORDER BY id LIMIT ?', (status, last_id, batch_size))
+            rows = cursor.fetchall()
+        if not rows:
+            return
+        for row in rows:
+            yield _withdrawal_row(row)
+        last_id = rows[-1][0]
+
+def get_withdrawals(user_id):
+    with sqlite3.connect(DATABASE_NAME) as conn:
+        cursor = conn.cursor()
+        return [row[:3] + (Money(row[3]),) + row[4:] for row in cursor.execute('SELECT * FROM withdrawales WHERE user_id = ?', (user_id,))]
+
+def get_count_clicks(user_id):
+    return _hot_get(user_id, 'click_count') or 0
 def add_promocode(code, stars, max_uses):
     with sqlite3.connect(DATABASE_NAME) as conn:
         cursor = conn.cursor()
         try:
             cursor.execute('INSERT INTO promocodes (code, stars, max_uses) VALUES (?, ?, ?)',
-                          (code, stars, max_uses))
+                          (code, to_milli(stars), max_uses))
             conn.commit()
+            promos.forget(code)
             return True
         except sqlite3.IntegrityError:
             return False
 
-def use_promocode(code, user_id):
-    with sqlite3.connect(DATABASE_NAME) as conn:
-        cursor = conn.cursor()
-        try:
-            promo = cursor.execute('''
-                SELECT * FROM promocodes
-                WHERE code = ? AND is_active = TRUE
-                AND current_uses < max_uses
-            ''', (code,)).fetchone()
+PROMO_INVALID = "Промокод недействителен или закончились использования"
+PROMO_USED = "Вы уже использовали этот промокод"
 
-            if not promo:
-                return False, "Промокод недействителен или закончились использования"
+class PromoEngine:
+    """Активация промокодов под нагрузкой: остаток использований и множество активировавших
+    по каждому коду в памяти, поэтому закончившиеся коды и повторы отсекаются без SQLite.
 
-            used = cursor.execute('''
-                SELECT 1 FROM promocode_uses
-                WHERE promocode_id = ? AND user_id = ?
-            ''', (promo[0], user_id)).fetchone()
+    reserve() только бронирует активацию в памяти, в базу брони уходят пачкой через commit()
+    одной транзакцией. Остаток в памяти может быть только больше настоящего (другие процессы
+    тоже тратят код), поэтому commit() ещё раз проверяет лимит условным UPDATE, а повтор
+    из другого процесса ловит UNIQUE(promocode_id, user_id). Неизвестные коды помнятся miss_ttl секунд."""
 
-            if used:
-                return False, "Вы уже использовали этот промокод"
-
-            cursor.execute('''
-                UPDATE promocodes
-                SET current_uses = current_uses + 1
-                WHERE code = ?
-            ''', (code,))
+    def __init__(self, miss_ttl=30):
+        self.miss_ttl = miss_ttl
+        self.codes = {}
+        self.misses = {}
 
-            cursor.execute('''
-                INSERT INTO promocode_uses (promocode_id, user_id)
-                VALUES (?, ?)
-            ''', (promo[0], user_id))
+    def _load(self, code):
+        promo = self.codes.get(code)
+        if promo is not None:
+            return promo
+        if self.misses.get(code, 0) > time.monotonic():
+            return None
+        with sqlite3.connect(DATABASE_NAME) as conn:
+            cursor = conn.cursor()
+            row = cursor.execute('SELECT id, stars, max_uses - current_uses FROM promocodes WHERE code = ? AND is_active = TRUE', (code,)).fetchone()
+            if row is None:
+                self.misses[code] = time.monotonic() + self.miss_ttl
+                return None
+            used = {user_id for (user_id,) in cursor.execute('SELECT user_id FROM promocode_uses WHERE promocode_id = ?', (row[0],))}
+        promo = self.codes[code] = {'id': row[0], 'stars': row[1], 'remaining': row[2], 'used': used}
+        return promo
+
+    def forget(self, code):
+        self.codes.pop(code, None)
+        self.misses.pop(code, None)
+
+    def reserve(self, code, user_id):
+        """Бронь активации в памяти: (True, (promocode_id, stars)) или (False, сообщение)."""
+        promo = self._load(code)
+        if promo is None or promo['remaining'] <= 0:
+            return False, PROMO_INVALID
+        if user_id in promo['used']:
+            return False, PROMO_USED
+        promo['remaining'] -= 1
+        promo['used'].add(user_id)
+        return True, (promo['id'], promo['stars'])
+
+    def release(self, code, user_id, exhausted=False):
+        """Снимает бронь, которая не записалась в базу."""
+        promo = self.codes.get(code)
+        if promo is None:
+            return
+        promo['used'].discard(user_id)
+        promo['remaining'] = 0 if exhausted else promo['remaining'] + 1
+
+    def commit(self, redemptions):
+        """Пачка броней (code, user_id, promocode_id, stars) одной транзакцией.
+        Возвращает по каждой (True, Money) или (False, сообщение); неудачные брони снимаются."""
+        results, writes = [], []
+        with sqlite3.connect(DATABASE_NAME) as conn:
+            cursor = conn.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            for code, user_id, promo_id, stars in redemptions:
+                cursor.execute('UPDATE promocodes SET current_uses = current_uses + 1 WHERE id = ? AND is_active = TRUE AND current_uses < max_uses', (promo_id,))
+                if cursor.rowcount == 0:
+                    results.append((False, PROMO_INVALID))
+                    continue
+                cursor.execute('INSERT OR IGNORE INTO promocode_uses (promocode_id, user_id) VALUES (?, ?)', (promo_id, user_id))
+                if cursor.rowcount == 0:
+                    cursor.execute('UPDATE promocodes SET current_uses = current_uses - 1 WHERE id = ?', (promo_id,))
+                    results.append((False, PROMO_USED))
+                    continue
+                cursor.execute('UPDATE users SET stars = stars + ? WHERE id = ?', (stars, user_id))
+                writes.append(_hot_write(cursor, user_id))
+                results.append((True, Money(stars)))
+            conn.commit()
+            _hot_apply(cursor, *writes)
+        for (code, user_id, _, _), (success, message) in zip(redemptions, results):
+            if not success and message == PROMO_INVALID:
+                self.release(code, user_id, exhausted=True)
+        return results
 
-            cursor.execute('''
-                UPDATE users
-                SET stars = stars + ?
-                WHERE id = ?
-            ''', (promo[2], user_id))
+promos = PromoEngine()
 
-            conn.commit()
-            return True, promo[2]
-        except Exception as e:
-            conn.rollback()
-            return False, f"❌ {str(e)}"
+def use_promocode(code, user_id):
+    """Активация одного промокода без пачки (админские и служебные вызовы)."""
+    success, reserved = promos.reserve(code, user_id)
+    if not success:
+        return False, reserved
+    try:
+        return promos.commit([(code, user_id, *reserved)])[0]
+    except Exception as e:
+        promos.release(code, user_id)
+        return False, f"❌ {str(e)}"
 
-def get_user_refferals_list_and_username(user_id) -> list:
-    with sqlite3.connect(DATABASE_NAME) as conn:
-        cursor = conn.cursor()
-        return cursor.execute('SELECT id, username FROM users WHERE referral_id = ?', (user_id,)).fetchall()
+async def get_user_refferals_list_and_username(user_id) -> list:
+    return await analytics.run(_read_rows, 'SELECT id, username FROM users WHERE referral_id = ?', (user_id,))
 
 def deactivate_promocode(code):
     with sqlite3.connect(DATABASE_NAME) as conn:
         cursor = conn.cursor()
         cursor.execute('UPDATE promocodes SET is_active = FALSE WHERE code = ?', (code,))
         conn.commit()
+    promos.forget(code)
 
 def add_tasker(description, reward, link=None, boter=None, max_uses=0, channelprivate_id=0):
     with sqlite3.connect(DATABASE_NAME) as conn:
@@ -876,12 +1851,7 @@ def add_tasker(description, reward, link=None, boter=None, max_uses=0, channelpr
         cursor.execute('INSERT INTO new_tasks (description, reward, link, bot, max_completed, id_channel_private) VALUES (?, ?, ?, ?, ?, ?)',
                        (description, reward, link, boter, max_uses, channelprivate_id))
         conn.commit()
-
-def increment_current_completed(task_id):
-    with sqlite3.connect(DATABASE_NAME) as conn:
-        cursor = conn.cursor()
-        cursor.execute('UPDATE new_tasks SET current_completed = current_completed + 1 WHERE id = ?', (task_id,))
-        conn.commit()
+    task_catalog.invalidate()
 
 def get_current_completed(task_id):
     with sqlite3.connect(DATABASE_NAME) as conn:
@@ -898,17 +1868,17 @@ def deactivate_task(task_id):
         cursor = conn.cursor()
         cursor.execute('UPDATE new_tasks SET is_active = FALSE WHERE id = ?', (task_id,))
         conn.commit()
+    task_catalog.invalidate()
 
 def delete_task(task_id):
     with sqlite3.connect(DATABASE_NAME) as conn:
         cursor = conn.cursor()
         cursor.execute('DELETE FROM new_tasks WHERE id = ?', (task_id,))
         conn.commit()
+    task_catalog.invalidate()
 
 def get_active_tasks():
-    with sqlite3.connect(DATABASE_NAME) as conn:
-        cursor = conn.cursor()
-        return cursor.execute('SELECT * FROM new_tasks WHERE is_active = TRUE').fetchall()
+    return list(task_catalog.active().values())
 
 def get_completed_tasks_for_user(user_id):
     with sqlite3.connect(DATABASE_NAME) as conn:
@@ -916,33 +1886,113 @@ def get_completed_tasks_for_user(user_id):
         cursor.execute('SELECT task_id FROM completed_tasks WHERE user_id = ?', (user_id,))
         return [row[0] for row in cursor.fetchall()]
 
-def complete_task_for_user(user_id, task_id):
-    with sqlite3.connect(DATABASE_NAME) as conn:
-        cursor = conn.cursor()
-        try:
-            cursor.execute('INSERT INTO completed_tasks (user_id, task_id) VALUES (?, ?)', (user_id, task_id))
-            conn.commit()
-            return True
-        except sqlite3.IntegrityError:
-            return False, "Вы уже выполняли это задание."
-        except Exception as e:
-            conn.rollback()
-            return False
-
 def get_task(task_id):
     with sqlite3.connect(DATABASE_NAME) as conn:
         cursor = conn.cursor()
         return cursor.execute('SELECT * FROM new_tasks WHERE id = ?', (task_id,)).fetchone()
 
-def get_user_count():
-    with sqlite3.connect(DATABASE_NAME) as conn:
-        cursor = conn.cursor()
-        return cursor.execute('SELECT COUNT(*) FROM users').fetchone()[0]
+class TaskCatalog:
+    """Локальные задания: каталог активных заданий в памяти и выполненные задания пользователей
+    битсетами (бит task_id в int), LRU на size пользователей.
+
+    Каталог сбрасывается при изменении заданий админом и перечитывается не реже чем раз в ttl
+    секунд (задания могут меняться из другого процесса). Выполнение — одна транзакция: проверка
+    лимита, отметка, счётчик и награда; на max_completed задание выключается само."""
+
+    COLUMNS = 'id, description, reward, link, bot, max_completed, current_completed, id_channel_private'
+
+    def __init__(self, ttl=60, size=50000):
+        self.ttl = ttl
+        self.size = size
+        self.tasks = None
+        self.loaded_at = 0
+        self.completed = OrderedDict()
+
+    @staticmethod
+    def _task(row):
+        task_id, description, reward, link, bot, max_completed, current_completed, channel_private = row
+        return {'id': task_id, 'description': description, 'reward': Money(to_milli(reward)), 'link': link, 'bot': bot,
+                'max_completed': max_completed, 'current_completed': current_completed, 'id_channel_private': channel_private}
+
+    def invalidate(self):
+        self.tasks = None
+
+    def active(self):
+        """{task_id: задание} активных заданий."""
+        if self.tasks is None or time.monotonic() - self.loaded_at > self.ttl:
+            with sqlite3.connect(DATABASE_NAME) as conn:
+                cursor = conn.cursor()
+                rows = cursor.execute(f'SELECT {self.COLUMNS} FROM new_tasks WHERE is_active = TRUE ORDER BY id').fetchall()
+            self.tasks = {row[0]: self._task(row) for row in rows}
+            self.loaded_at = time.monotonic()
+        return self.tasks
+
+    def completed_mask(self, user_id):
+        mask = self.completed.get(user_id)
+        if mask is None:
+            mask = 0
+            with sqlite3.connect(DATABASE_NAME) as conn:
+                cursor = conn.cursor()
+                for (task_id,) in cursor.execute('SELECT task_id FROM completed_tasks WHERE user_id = ?', (user_id,)):
+                    mask |= 1 << task_id
+            self.completed[user_id] = mask
+            if len(self.completed) > self.size:
+                self.completed.popitem(last=False)
+        self.completed.move_to_end(user_id)
+        return mask
+
+    def is_completed(self, user_id, task_id):
+        return bool(self.completed_mask(user_id) >> task_id & 1)
+
+    def available(self, user_id):
+        """Активные задания, которые пользователь ещё не выполнял."""
+        mask = self.completed_mask(user_id)
+        return [task for task_id, task in self.active().items() if not mask >> task_id & 1]
+
+    def complete(self, user_id, task_id):
+        """Отмечает задание и начисляет награду. (True, задание) или (False, сообщение)."""
+        if self.is_completed(user_id, task_id):
+            return False, "❌ Задание уже выполнено."
+        with sqlite3.connect(DATABASE_NAME) as conn:
+            cursor = conn.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            row = cursor.execute(f'SELECT {self.COLUMNS} FROM new_tasks WHERE id = ? AND is_active = TRUE', (task_id,)).fetchone()
+            if row is None:
+                conn.rollback()
+                self.invalidate()
+                return False, "❌ Задание больше недоступно."
+            task = self._task(row)
+            if task['max_completed'] and task['current_completed'] >= task['max_completed']:
+                cursor.execute('UPDATE new_tasks SET is_active = FALSE WHERE id = ?', (task_id,))
+                conn.commit()
+                self.invalidate()
+                return False, "❌ Задание больше недоступно."
+            cursor.execute('INSERT OR IGNORE INTO completed_tasks (user_id, task_id) VALUES (?, ?)', (user_id, task_id))
+            if cursor.rowcount == 0:
+                conn.rollback()
+                self.completed[user_id] = self.completed_mask(user_id) | 1 << task_id
+                return False, "❌ Задание уже выполнено."
+            task['current_completed'] += 1
+            exhausted = bool(task['max_completed']) and task['current_completed'] >= task['max_completed']
+            cursor.execute('UPDATE new_tasks SET current_completed = current_completed + 1, is_active = ? WHERE id = ?', (not exhausted, task_id))
+            cursor.execute('UPDATE users SET stars = stars + ? WHERE id = ?', (task['reward'].milli, user_id))
+            write = _hot_write(cursor, user_id)
+            conn.commit()
+            _hot_apply(cursor, write)
+        self.completed[user_id] = self.completed_mask(user_id) | 1 << task_id
+        if exhausted:
+            self.invalidate()
+        elif self.tasks is not None and task_id in self.tasks:
+            self.tasks[task_id]['current_completed'] = task['current_completed']
+        return True, task
 
-def get_total_withdrawn():
-    with sqlite3.connect(DATABASE_NAME) as conn:
-        cursor = conn.cursor()
-        return cursor.execute('SELECT COALESCE(SUM(withdrawn), 0.0) FROM users').fetchone()[0]
+task_catalog = TaskCatalog()
+
+async def get_user_count():
+    return await analytics.run(_read_value, 'SELECT COUNT(*) FROM users')
+
+async def get_total_withdrawn():
+    return Money(await analytics.run(_read_value, 'SELECT COALESCE(SUM(withdrawn), 0) FROM users'))
 
 def get_normal_time_registration(user_id):
     with sqlite3.connect(DATABASE_NAME) as conn:
@@ -953,7 +2003,10 @@ def update_click_count(user_id):
     with sqlite3.connect(DATABASE_NAME) as conn:
         cursor = conn.cursor()
         cursor.execute('UPDATE click_times SET click_count = click_count + 1 WHERE user_id = ?', (user_id,))
+        write = _hot_write(cursor, user_id)
         conn.commit()
+        _hot_apply(cursor, write)
+    activity.track('click')
 
 def get_top_clicked():
     with sqlite3.connect(DATABASE_NAME) as conn:
@@ -968,11 +2021,7 @@ def get_top_clicked():
         return cursor.fetchall()
 
 def get_last_daily_gift_time(user_id):
-    with sqlite3.connect(DATABASE_NAME) as conn:
-        cursor = conn.cursor()
-        cursor.execute('SELECT last_claimed_time FROM daily_gifts WHERE user_id = ?', (user_id,))
-        result = cursor.fetchone()
-        return result[0] if result else None
+    return _hot_get(user_id, 'last_gift') or None
 
 def update_last_daily_gift_time(user_id):
     with sqlite3.connect(DATABASE_NAME) as conn:
@@ -982,14 +2031,13 @@ def update_last_daily_gift_time(user_id):
             VALUES (?, ?)
             ON CONFLICT(user_id) DO UPDATE SET last_claimed_time = ?
         ''', (user_id, time.time(), time.time()))
+        write = _hot_write(cursor, user_id)
         conn.commit()
+        _hot_apply(cursor, write)
+    activity.track('gift')
 
 def get_last_click_time(user_id):
-    with sqlite3.connect(DATABASE_NAME) as conn:
-        cursor = conn.cursor()
-        cursor.execute('SELECT last_click_time FROM click_times WHERE user_id = ?', (user_id,))
-        result = cursor.fetchone()
-        return result[0] if result else None
+    return _hot_get(user_id, 'last_click') or None
 
 def update_last_click_time(user_id):
     with sqlite3.connect(DATABASE_NAME) as conn:
@@ -999,47 +2047,93 @@ def update_last_click_time(user_id):
             VALUES (?, ?)
             ON CONFLICT(user_id) DO UPDATE SET last_click_time = ?
         ''', (user_id, time.time(), time.time()))
+        write = _hot_write(cursor, user_id)
         conn.commit()
+        _hot_apply(cursor, write)
 
 def get_users():
     with sqlite3.connect(DATABASE_NAME) as conn:
         cursor = conn.cursor()
         return cursor.execute('SELECT id, username FROM users').fetchall()
     
-def get_users_ids():
-    try:
-        with sqlite3.connect(DATABASE_NAME) as conn:
-            cursor = conn.cursor()
-            cursor.execute('SELECT id FROM users')
-            return [str(row[0]) for row in cursor.fetchall()]
-            
-    except sqlite3.Error as e:
-        print(f"Database error: {e}")
-        return []
-def get_users_ids():
-    with sqlite3.connect(DATABASE_NAME) as conn:
-        cursor = conn.cursor()
-        return cursor.execute('SELECT id FROM users').fetchall()
+async def get_users_ids():
+    return await analytics.run(_read_rows, 'SELECT id FROM users', max_rows=ANALYTICS_EXPORT_MAX_ROWS)
+
+def _users_ids_text(cursor):
+    return '\n'.join(str(user_id) for (user_id,) in cursor.iterate('SELECT id FROM users')).encode('utf-8')
+
+async def dump_users_ids():
+    """id всех пользователей по строке на id, файл собирается на потоке пула."""
+    return await analytics.run(_users_ids_text, max_rows=ANALYTICS_EXPORT_MAX_ROWS)
 
 
 def add_user(user_id, username, referral_id=None):
     with sqlite3.connect(DATABASE_NAME) as conn:
         cursor = conn.cursor()
-        cursor.execute('INSERT INTO users (id, username, stars, count_refs, referral_id) VALUES (?, ?, ?, ?, ?)',
-                       (user_id, username, 0.0, 0, referral_id))
+        cursor.execute('INSERT INTO users (id, username, username_norm, stars, count_refs, referral_id) VALUES (?, ?, ?, ?, ?, ?)',
+                       (user_id, username, normalize_username(username), 0, 0, referral_id))
+        change = members.log(cursor, user_id, True, False)
+        write = _hot_write(cursor, user_id)
+        conn.commit()
+        members.apply(*change)
+        _hot_apply(cursor, write)
+    activity.track('registration')
+
+# Награда пригласившему: (с какого числа рефералов, звёзд); с бустером вдвое больше
+REFERRAL_TIERS = ((250, 1.5), (50, 1), (0, 0.7))
+
+def referral_reward(count_refs, boosted):
+    reward = next(stars for threshold, stars in REFERRAL_TIERS if count_refs >= threshold)
+    return Money.of(reward) * 2 if boosted else Money.of(reward)
+
+def register_user_with_referral(user_id, username, ref_id=None, now=None):
+    """Регистрация пользователя и награда пригласившему одной транзакцией: вставка, счётчики
+    count_refs и week_refs пригласившего, уровень награды по числу его рефералов вместе с новым
+    (50-й реферал уже платит по второму уровню) и начисление.
+    Возвращает (False, None), если пользователь уже есть, иначе (True, начисленная награда или None)."""
+    now = now or time.time()
+    week_start, _ = get_period_timestamps('week')
+    with sqlite3.connect(DATABASE_NAME) as conn:
+        cursor = conn.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        referrer = None
+        if ref_id is not None and ref_id != user_id:
+            referrer = cursor.execute('SELECT count_refs FROM users WHERE id = ?', (ref_id,)).fetchone()
+        cursor.execute('INSERT OR IGNORE INTO users (id, username, username_norm, stars, count_refs, referral_id, registration_time) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                       (user_id, username, normalize_username(username), 0, 0, ref_id if referrer else None, now))
+        if cursor.rowcount == 0:
+            conn.rollback()
+            return False, None
+        change = members.log(cursor, user_id, True, False)
+        writes = [_hot_write(cursor, user_id)]
+        reward = None
+        if referrer:
+            boost_end = _hot_get(ref_id, 'boost_end')
+            reward = referral_reward(referrer[0] + 1, bool(boost_end) and boost_end > now)
+            cursor.execute('''
+                UPDATE users SET
+                    count_refs = count_refs + 1,
+                    week_refs = CASE WHEN week_refs_start = ? THEN week_refs + 1 ELSE 1 END,
+                    week_refs_start = ?,
+                    stars = stars + ?
+                WHERE id = ?
+            ''', (week_start, week_start, reward.milli, ref_id))
+            writes.append(_hot_write(cursor, ref_id))
         conn.commit()
+        members.apply(*change)
+        _hot_apply(cursor, *writes)
+    activity.track('registration', at=now)
+    return True, reward
 
 def add_withdrawal(user_id, amount):
     with sqlite3.connect(DATABASE_NAME) as conn:
         cursor = conn.cursor()
-        cursor.execute('UPDATE users SET withdrawn = withdrawn + ? WHERE id = ?', (amount, user_id))
+        cursor.execute('UPDATE users SET withdrawn = withdrawn + ? WHERE id = ?', (to_milli(amount), user_id))
         conn.commit()
 
 def get_balance_user(user_id):
-    with sqlite3.connect(DATABASE_NAME) as conn:
-        cursor = conn.cursor()
-        result = cursor.execute('SELECT stars FROM users WHERE id = ?', (user_id,)).fetchone()
-        return result[0]
+    stars = _hot_get(user_id, 'stars')
+    return None if stars is None else Money(stars)
 
 def get_count_refs(user_id):
     with sqlite3.connect(DATABASE_NAME) as conn:
@@ -1048,28 +2142,24 @@ def get_count_refs(user_id):
         return result[0]
 
 def user_exists(user_id):
-    with sqlite3.connect(DATABASE_NAME) as conn:
-        cursor = conn.cursor()
-        result = cursor.execute('SELECT * FROM users WHERE id = ?', (user_id,)).fetchone()
-        return bool(result)
-
-def increment_referrals(referrer_id):
-    with sqlite3.connect(DATABASE_NAME) as conn:
-        cursor = conn.cursor()
-        cursor.execute('UPDATE users SET count_refs = count_refs + 1 WHERE id = ?', (referrer_id,))
-        conn.commit()
+    user_id = _as_user_id(user_id)
+    return user_id is not None and members.is_registered(user_id)
 
 def increment_stars(user_id, stars):
     with sqlite3.connect(DATABASE_NAME) as conn:
         cursor = conn.cursor()
-        cursor.execute('UPDATE users SET stars = stars + ? WHERE id = ?', (stars, user_id))
+        cursor.execute('UPDATE users SET stars = stars + ? WHERE id = ?', (to_milli(stars), user_id))
+        write = _hot_write(cursor, user_id)
         conn.commit()
+        _hot_apply(cursor, write)
 
 def deincrement_stars(user_id, stars):
     with sqlite3.connect(DATABASE_NAME) as conn:
         cursor = conn.cursor()
-        cursor.execute('UPDATE users SET stars = stars - ? WHERE id = ?', (stars, user_id))
+        cursor.execute('UPDATE users SET stars = stars - ? WHERE id = ?', (to_milli(stars), user_id))
+        write = _hot_write(cursor, user_id)
         conn.commit()
+        _hot_apply(cursor, write)
 
 def get_top_referrals():
     with sqlite3.connect(DATABASE_NAME) as conn:
@@ -1077,112 +2167,80 @@ def get_top_referrals():
         return cursor.execute('SELECT id, count_refs, username FROM users ORDER BY count_refs DESC LIMIT 10').fetchall()
 
 def sum_all_stars():
-    with sqlite3.connect(DATABASE_NAME) as conn:
-        cursor = conn.cursor()
-        return cursor.execute('SELECT COALESCE(SUM(stars), 0.0) FROM users').fetchone()[0]
+    sync_hot_state()
+    return Money(hot.total_stars())
 
 def sum_all_withdrawn():
     with sqlite3.connect(DATABASE_NAME) as conn:
         cursor = conn.cursor()
-        return cursor.execute('SELECT COALESCE(SUM(withdrawn), 0.0) FROM users').fetchone()[0]
+        return Money(cursor.execute('SELECT COALESCE(SUM(withdrawn), 0) FROM users').fetchone()[0])
 
-def get_period_timestamps(period):
-    now_utc = datetime.utcnow()
-    tz_offset = timedelta(hours=3)
-    now_local = now_utc + tz_offset
-    
-    if period == 'day':
-        start = now_local.replace(hour=0, minute=0, second=0, microsecond=0)
-        end = start + timedelta(days=1, seconds=-1)
-    elif period == 'week':
-        start = now_local - timedelta(days=now_local.weekday())
-        start = start.replace(hour=0, minute=0, second=0, microsecond=0)
-        end = start + timedelta(days=7, seconds=-1)
-    elif period == 'month':
-        start = now_local.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-        next_month = start.replace(day=28) + timedelta(days=4)
-        end = next_month.replace(day=1) - timedelta(seconds=1)
-    else:
-        return None, None
-    
-    return int(start.timestamp()), int(end.timestamp())
-
-def get_top_referrals_formatted(period):
+async def get_top_referrals_formatted(period):
     start_ts, end_ts = get_period_timestamps(period)
     if start_ts is None:
         return ["Неверный период времени"]
-    
-    with sqlite3.connect(DATABASE_NAME) as conn:
-        cursor = conn.cursor()
-        try:
-            cursor.execute('''
-                SELECT u2.id, u2.username, COUNT(u1.id) as referral_count
-                FROM users u1
-                JOIN users u2 ON u1.referral_id = u2.id
-                WHERE u1.referral_id IS NOT NULL
-                AND u1.registration_time BETWEEN ? AND ?
-                GROUP BY u2.id
-                HAVING COUNT(u1.id) > 0
-                ORDER BY referral_count DESC
-                LIMIT 5;
-            ''', (start_ts, end_ts))
-            top_referrals = cursor.fetchall()
-            
-            if not top_referrals:
-                return ["Нет данных о рефералах за выбранный период."]
-            
-            places = ["🥇", "🥈", "🥉"]
-            formatted_referrals = [
-                f"{places[i] if i < 3 else '✨'} <b>{username or f'Пользователь {user_id}'}</b> | Рефералов: <code>{count}</code>"
-                for i, (user_id, username, count) in enumerate(top_referrals)
-            ]
-            return formatted_referrals
-        except Exception as e:
-            return [f"Ошибка при получении топа рефералов: {e}"]
+
+    try:
+        top_referrals = await analytics.run(_read_rows, '''
+            SELECT u2.id, u2.username, COUNT(u1.id) as referral_count
+            FROM users u1
+            JOIN users u2 ON u1.referral_id = u2.id
+            WHERE u1.referral_id IS NOT NULL
+            AND u1.registration_time BETWEEN ? AND ?
+            GROUP BY u2.id
+            HAVING COUNT(u1.id) > 0
+            ORDER BY referral_count DESC
+            LIMIT 5;
+        ''', (start_ts, end_ts))
+
+        if not top_referrals:
+            return ["Нет данных о рефералах за выбранный период."]
+
+        places = ["🥇", "🥈", "🥉"]
+        formatted_referrals = [
+            f"{places[i] if i < 3 else '✨'} <b>{username or f'Пользователь {user_id}'}</b> | Рефералов: <code>{count}</code>"
+            for i, (user_id, username, count) in enumerate(top_referrals)
+        ]
+        return formatted_referrals
+    except Exception as e:
+        return [f"Ошибка при получении топа рефералов: {e}"]
 
 def get_weekly_referrals(user_id):
-    start_ts, end_ts = get_period_timestamps('week')
+    start_ts, _ = get_period_timestamps('week')
     with sqlite3.connect(DATABASE_NAME) as conn:
         cursor = conn.cursor()
-        cursor.execute('''
-            SELECT COUNT(*)
-            FROM users
-            WHERE referral_id = ?
-            AND registration_time BETWEEN ? AND ?
-        ''', (user_id, start_ts, end_ts))
+        cursor.execute('SELECT CASE WHEN week_refs_start = ? THEN week_refs ELSE 0 END FROM users WHERE id = ?', (start_ts, user_id))
         result = cursor.fetchone()
         return result[0] if result else 0
 
-def get_user_referral_rank_formatted(user_id, period):
+def _referral_rank(cursor, user_id, start_ts, end_ts):
+    user_referral_count = cursor.fetchone('''
+        SELECT COUNT(id)
+        FROM users
+        WHERE referral_id = ? AND registration_time BETWEEN ? AND ?
+    ''', (user_id, start_ts, end_ts))[0]
+
+    result = cursor.fetchone('''
+        SELECT COUNT(DISTINCT referral_count) + 1
+        FROM (
+            SELECT referral_id, COUNT(id) AS referral_count
+            FROM users
+            WHERE registration_time BETWEEN ? AND ?
+            GROUP BY referral_id
+            HAVING referral_count > 0
+        ) AS referral_counts
+        WHERE referral_count > ?
+    ''', (start_ts, end_ts, user_referral_count))
+    return user_referral_count, result[0] if result else 1
+
+async def get_user_referral_rank_formatted(user_id, period):
     start_ts, end_ts = get_period_timestamps(period)
     if start_ts is None:
         return "Неверный период времени"
-    
-    with sqlite3.connect(DATABASE_NAME) as conn:
-        cursor = conn.cursor()
-        try:
-            cursor.execute('''
-                SELECT COUNT(id)
-                FROM users
-                WHERE referral_id = ? AND registration_time BETWEEN ? AND ?
-            ''', (user_id, start_ts, end_ts))
-            user_referral_count = cursor.fetchone()[0]
-            
-            cursor.execute('''
-                SELECT COUNT(DISTINCT referral_count) + 1
-                FROM (
-                    SELECT referral_id, COUNT(id) AS referral_count
-                    FROM users
-                    WHERE registration_time BETWEEN ? AND ?
-                    GROUP BY referral_id
-                    HAVING referral_count > 0
-                ) AS referral_counts
-                WHERE referral_count > ?
-            ''', (start_ts, end_ts, user_referral_count))
-            result = cursor.fetchone()
-            rank_value = result[0] if result else 1
-            
-            return (f"<b>🏅 Ты на {rank_value - 1} месте</b> | <code>{user_referral_count}</code> рефералов."
-                    if user_referral_count > 0 else f"<b>🚫 Ты не попал в топ!</b> | <code>{user_referral_count}</code> рефералов.")
-        except Exception as e:
-            return f"Ошибка при получении вашего места в топе: {e}"
\ No newline at end of file
+
+    try:
+        user_referral_count, rank_value = await analytics.run(_referral_rank, user_id, start_ts, end_ts)
+        return (f"<b>🏅 Ты на {rank_value - 1} месте</b> | <code>{user_referral_count}</code> рефералов."
+                if user_referral_count > 0 else f"<b>🚫 Ты не попал в топ!</b> | <code>{user_referral_count}</code> рефералов.")
+    except Exception as e:
+        return f"Ошибка при получении вашего места в топе: {e}"
\ No newline at end of file
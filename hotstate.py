@@ -0,0 +1,126 @@
+import logging
+import os
+import struct
+from array import array
+from bisect import bisect_left
+from typing import Dict, Iterable, Optional, Tuple
+
+
+class HotState:
+    """Горячие поля пользователей (баланс в милли-звёздах, кулдауны клика и подарка, конец буста) в колонках array.
+
+    Плотный индекс по id: id из базы лежат отсортированными в начале ids, номер позиции —
+    номер строки во всех колонках. Новые пользователи дописываются в конец и ищутся через
+    словарь tail, пока compact() не пересортирует таблицу. 0 во временных колонках — «нет значения».
+    Колонки — непрерывные массивы, поэтому сводная статистика считается одним проходом без SQL."""
+
+    COLUMNS = (('stars', 'q'), ('last_click', 'd'), ('click_count', 'I'), ('last_gift', 'd'), ('boost_end', 'd'))
+    COMPACT_THRESHOLD = 4096
+    MAGIC = b'HOTSTATE2'
+    HEADER = struct.Struct('<9sqq')
+
+    def __init__(self):
+        self.ids = array('q')
+        self.base = 0
+        self.tail: Dict[int, int] = {}
+        self.columns = {name: array(code) for name, code in self.COLUMNS}
+        # Последняя применённая запись журнала hot_state_log
+        self.seq = 0
+
+    def __len__(self):
+        return len(self.ids)
+
+    def load(self, rows: Iterable[Tuple], seq: int):
+        """rows — (id, stars, last_click, click_count, last_gift, boost_end) по возрастанию id."""
+        self.__init__()
+        columns = [self.columns[name] for name, _ in self.COLUMNS]
+        for user_id, *values in rows:
+            self.ids.append(user_id)
+            for column, value in zip(columns, values):
+                column.append(value or 0)
+        self.base = len(self.ids)
+        self.seq = seq
+
+    def row(self, user_id: int) -> Optional[int]:
+        row = self.tail.get(user_id)
+        if row is not None:
+            return row
+        i = bisect_left(self.ids, user_id, 0, self.base)
+        if i < self.base and self.ids[i] == user_id:
+            return i
+        return None
+
+    def get(self, user_id: int, column: str):
+        row = self.row(user_id)
+        return None if row is None else self.columns[column][row]
+
+    def set(self, user_id: int, **values):
+        row = self.row(user_id)
+        if row is None:
+            row = self._append(user_id)
+        for column, value in values.items():
+            self.columns[column][row] = value or 0
+
+    def _append(self, user_id: int) -> int:
+        row = len(self.ids)
+        self.ids.append(user_id)
+        for column in self.columns.values():
+            column.append(0)
+        self.tail[user_id] = row
+        if len(self.tail) >= self.COMPACT_THRESHOLD:
+            self.compact()
+            return self.row(user_id)
+        return row
+
+    def compact(self):
+        order = sorted(range(len(self.ids)), key=self.ids.__getitem__)
+        self.ids = array('q', (self.ids[i] for i in order))
+        for name, code in self.COLUMNS:
+            column = self.columns[name]
+            self.columns[name] = array(code, (column[i] for i in order))
+        self.base = len(self.ids)
+        self.tail.clear()
+
+    # Сводная статистика одним проходом по колонке
+    def total_stars(self) -> int:
+        return sum(self.columns['stars'])
+
+    def active_boosters(self, now: float) -> int:
+        return sum(1 for end_time in self.columns['boost_end'] if end_time > now)
+
+    def off_cooldown(self, now: float, cooldown: float) -> int:
+        threshold = now - cooldown
+        return sum(1 for last_click in self.columns['last_click'] if last_click <= threshold)
+
+    def save(self, path: str):
+        """Снимок на диск: заголовок и колонки как есть. Пишется во временный файл и подменяется атомарно."""
+        if self.tail:
+            self.compact()
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(self.HEADER.pack(self.MAGIC, self.seq, len(self.ids)))
+            self.ids.tofile(f)
+            for name, _ in self.COLUMNS:
+                self.columns[name].tofile(f)
+        os.replace(tmp_path, path)
+
+    def restore(self, path: str) -> bool:
+        if not os.path.exists(path):
+            return False
+        try:
+            with open(path, 'rb') as f:
+                magic, seq, count = self.HEADER.unpack(f.read(self.HEADER.size))
+                if magic != self.MAGIC:
+                    return False
+                ids = array('q')
+                ids.fromfile(f, count)
+                columns = {}
+                for name, code in self.COLUMNS:
+                    columns[name] = array(code)
+                    columns[name].fromfile(f, count)
+        except (OSError, EOFError, struct.error) as e:
+            logging.warning(f"Снимок горячих полей не прочитан: {e}")
+            return False
+        self.__init__()
+        self.ids, self.columns, self.base, self.seq = ids, columns, count, seq
+        return True
@@ -1,4 +1,5 @@
 import asyncio
+import math
 import random
 import time
 import logging
@@ -6,12 +7,15 @@ import re
 import html
 import aiohttp
 import string
+import csv
+import io
 
-from collections import deque
+from collections import OrderedDict, deque
 from typing import List, Tuple
 from typing import Optional, Callable, Dict, Any, Awaitable
 from aiogram import Bot, Dispatcher, Router, types, F, BaseMiddleware
 from aiogram.filters import CommandStart, StateFilter
+from aiogram.filters.callback_data import CallbackData
 from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton, InputFile, LabeledPrice, PreCheckoutQuery, BufferedInputFile
 from aiogram.types.input_file import FSInputFile
 from aiogram.exceptions import (
@@ -34,6 +38,9 @@ except ImportError as e:
     print(f"Ошибка импорта: {e}. Пожалуйста, убедитесь, что файлы database.py и settings.py существуют и находятся в правильном месте.")
     exit()
 
+from storage import SQLiteStorage
+from money import Money
+
 logging.basicConfig(level=logging.ERROR)
 
 router = Router()
@@ -55,9 +62,60 @@ admin_msg = {}
 message_ids = {}
 
 class AntiFloodMiddleware(BaseMiddleware):
-    def __init__(self, limit: int = 1):
-        self.limit = limit
-        self.last_time: Dict[int, float] = {}
+    """Антифлуд с ограниченной памятью.
+
+    Время последнего действия хранится в двух сменяющихся поколениях словарей: раз в period
+    текущее поколение становится предыдущим, а старое выбрасывается целиком. В памяти остаются
+    только пользователи, активные за последние 2 * period секунд. Лимиты задаются по типу действия
+    (FLOOD_LIMITS), 0 — без ограничения. Регистрируется как outer-middleware, поэтому флуд
+    отсекается до фильтров, хендлеров и запросов к базе."""
+
+    def __init__(self, limits: Dict[str, float]):
+        self.limits = limits
+        self.period = max(limits.values(), default=0) or 1
+        self.current: Dict[str, Dict[int, float]] = {action: {} for action in limits}
+        self.previous: Dict[str, Dict[int, float]] = {action: {} for action in limits}
+        self.generation_start = time.monotonic()
+        self.rejected = 0
+
+    def _rotate(self, now: float):
+        elapsed = now - self.generation_start
+        if elapsed < self.period:
+            return
+        if elapsed >= 2 * self.period:
+            self.previous = {action: {} for action in self.limits}
+        else:
+            self.previous = self.current
+        self.current = {action: {} for action in self.limits}
+        self.generation_start = now
+
+    @staticmethod
+    def action_of(event: types.Message | types.CallbackQuery) -> str:
+        if event.from_user.id in admins_id:
+            return 'admin'
+        if isinstance(event, types.Message):
+            return 'message'
+        if event.data == 'click_star':
+            return 'click'
+        return 'navigation'
+
+    def hit(self, user_id: int, action: str, now: float) -> float:
+        """Отмечает действие. Возвращает 0, если оно разрешено, иначе сколько секунд ещё ждать."""
+        limit = self.limits.get(action, 0)
+        if limit <= 0:
+            return 0
+        self._rotate(now)
+        last = self.current[action].get(user_id)
+        if last is None:
+            last = self.previous[action].get(user_id)
+        if last is not None and now - last < limit:
+            return limit - (now - last)
+        self.current[action][user_id] = now
+        return 0
+
+    @property
+    def tracked(self) -> int:
+        return sum(len(users) for users in self.current.values()) + sum(len(users) for users in self.previous.values())
 
     async def __call__(
         self,
@@ -65,34 +123,704 @@ class AntiFloodMiddleware(BaseMiddleware):
         event: types.Message | types.CallbackQuery,
         data: Dict[str, Any]
     ) -> Any:
-        if isinstance(event, types.Message):
-            if event.text and event.text.startswith('/start'):
-                return await handler(event, data)
+        if event.from_user is None:
+            return await handler(event, data)
+        if isinstance(event, types.Message) and (event.successful_payment or (event.text and event.text.startswith('/start'))):
+            return await handler(event, data)
 
-            user_id = event.from_user.id
-            current_time = time.time()
+        wait = self.hit(event.from_user.id, self.action_of(event), time.monotonic())
+        if not wait:
+            return await handler(event, data)
 
-            if user_id in self.last_time:
-                last_time = self.last_time[user_id]
-                if (current_time - last_time) < self.limit:
-                    await event.answer("⚠️ Пожалуйста, не флудите! Ожидайте {:.0f} сек.".format(self.limit))
-                    return
+        self.rejected += 1
+        try:
+            if isinstance(event, types.CallbackQuery):
+                await event.answer("⚠️ Пожалуйста, не флудите! Ожидайте {:.0f} сек.".format(max(wait, 1)), show_alert=True)
+            else:
+                await event.answer("⚠️ Пожалуйста, не флудите! Ожидайте {:.0f} сек.".format(max(wait, 1)))
+        except TelegramAPIError as e:
+            logging.warning(f"Антифлуд: не удалось ответить пользователю {event.from_user.id}: {e}")
 
-            self.last_time[user_id] = current_time
+antiflood = AntiFloodMiddleware(FLOOD_LIMITS)
+
+class UserLanesMiddleware(BaseMiddleware):
+    """Апдейты одного пользователя выполняются строго по очереди, разные пользователи — параллельно.
+
+    У каждого пользователя своя «полоса» (asyncio.Lock + счётчик ожидающих), она живёт только
+    пока есть необработанные апдейты. Если в полосе уже max_pending апдейтов, новый отбрасывается:
+    двойные нажатия не успевают прочитать один и тот же баланс. Админы идут мимо очереди,
+    чтобы долгая рассылка не блокировала остальные их действия."""
+
+    def __init__(self, max_pending: int):
+        self.max_pending = max_pending
+        self.lanes: Dict[int, list] = {}
+        self.dropped = 0
+
+    async def __call__(
+        self,
+        handler: Callable[[types.Message | types.CallbackQuery, Dict[str, Any]], Awaitable[Any]],
+        event: types.Message | types.CallbackQuery,
+        data: Dict[str, Any]
+    ) -> Any:
+        user = event.from_user
+        if user is None or user.id in admins_id:
             return await handler(event, data)
 
-        elif isinstance(event, types.CallbackQuery):
-            user_id = event.from_user.id
-            current_time = time.time()
+        lane = self.lanes.get(user.id)
+        if lane is None:
+            lane = self.lanes[user.id] = [asyncio.Lock(), 0]
+        if lane[1] >= self.max_pending:
+            self.dropped += 1
+            if isinstance(event, types.CallbackQuery):
+                try:
+                    await event.answer("⏳ Предыдущее действие ещё выполняется, подождите.")
+                except TelegramAPIError:
+                    pass
+            return
 
-            if user_id in self.last_time:
-                last_time = self.last_time[user_id]
-                if (current_time - last_time) < self.limit:
-                    await event.answer("⚠️ Пожалуйста, не флудите! Ожидайте {:.0f} сек.".format(self.limit), show_alert=True)
-                    return
+        lane[1] += 1
+        try:
+            async with lane[0]:
+                return await handler(event, data)
+        finally:
+            lane[1] -= 1
+            if lane[1] == 0:
+                self.lanes.pop(user.id, None)
+
+user_lanes = UserLanesMiddleware(USER_LANE_LIMIT)
+
+class ProfileCacheMiddleware(BaseMiddleware):
+    """Профили пользователей (first_name, username, language_code, is_premium) из входящих апдейтов.
+
+    Каждый Message/CallbackQuery обновляет LRU на size пользователей с TTL ttl секунд, поэтому
+    имена для игр и уведомлений берутся отсюда, а не через bot.get_chat. Изменившиеся профили
+    копятся и раз в flush_interval секунд уходят в базу пачкой (save_profiles, update_usernames);
+    промах кеша читается из user_profiles."""
+
+    def __init__(self, flush_interval: float, size: int = 100000, ttl: float = 3600):
+        self.flush_interval = flush_interval
+        self.size = size
+        self.ttl = ttl
+        self.profiles: OrderedDict = OrderedDict()
+        self.pending: Dict[int, tuple] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+
+    async def __call__(
+        self,
+        handler: Callable[[types.Message | types.CallbackQuery, Dict[str, Any]], Awaitable[Any]],
+        event: types.Message | types.CallbackQuery,
+        data: Dict[str, Any]
+    ) -> Any:
+        user = event.from_user
+        if user is not None and not user.is_bot:
+            self.seen(user)
+        return await handler(event, data)
+
+    def _put(self, user_id: int, profile: tuple):
+        self.profiles[user_id] = (profile, time.monotonic() + self.ttl)
+        self.profiles.move_to_end(user_id)
+        if len(self.profiles) > self.size:
+            self.profiles.popitem(last=False)
+
+    def seen(self, user: types.User):
+        profile = (user.first_name, user.username, user.language_code, bool(user.is_premium))
+        entry = self.profiles.get(user.id)
+        self._put(user.id, profile)
+        if entry is not None and entry[0] == profile:
+            return
+        self.pending[user.id] = profile
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    def get(self, user_id: int) -> Optional[tuple]:
+        """(first_name, username, language_code, is_premium) без обращений к Bot API."""
+        entry = self.profiles.get(user_id)
+        if entry is not None and entry[1] > time.monotonic():
+            self.profiles.move_to_end(user_id)
+            return entry[0]
+        profile = self.pending.get(user_id) or get_profile(user_id)
+        if profile is None:
+            self.profiles.pop(user_id, None)
+            return None
+        self._put(user_id, profile)
+        return profile
+
+    def first_name(self, user_id: int) -> str:
+        profile = self.get(user_id)
+        return profile[0] if profile and profile[0] else str(user_id)
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_interval)
+        self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        changes = [(user_id, *profile) for user_id, profile in self.pending.items()]
+        self.pending.clear()
+        try:
+            saved = save_profiles(changes)
+            renamed = update_usernames([(user_id, username) for user_id, _, username, _, _ in changes])
+            if saved or renamed:
+                logging.info(f"Обновлены профили: {saved}, username: {renamed} из {len(changes)}")
+        except Exception as e:
+            logging.error(f"Ошибка при сохранении профилей: {e}")
+
+profiles = ProfileCacheMiddleware(PROFILE_FLUSH_INTERVAL, PROFILE_CACHE_SIZE, PROFILE_CACHE_TTL)
+
+class NotificationAggregator:
+    """
+    Склеивает однотипные уведомления для одного чата в одно сообщение.
+    Сводка уходит после window секунд тишины, но не позже max_latency с первого события.
+    """
+    headers = {
+        'referral': "🎉 <b>{period_name} по вашей ссылке запустили бота: +{count} рефералов, +{stars:.1f}⭐️</b>",
+        'win': "<b>🎉 {period_name}: {count} выигрышей на {stars:.2f}⭐️ 🏆</b>",
+        'theft': "<b>🥷🏻 {period_name}: {count} краж на {stars:.2f}💰</b>",
+        'knb': "<b>✊✌️✋ {period_name}: завершено {count} игр КНБ</b>",
+    }
+
+    def __init__(self, window: float = 5, max_latency: float = 60, max_lines: int = 10):
+        self.window = window
+        self.max_latency = max_latency
+        self.max_lines = max_lines
+        self.buckets: Dict[Tuple[int, str], Dict[str, Any]] = {}
+        self.events_total = 0
+        self.messages_sent = 0
+        self.events_failed = 0
+
+    @property
+    def calls_saved(self) -> int:
+        pending = sum(bucket['count'] for bucket in self.buckets.values())
+        return self.events_total - pending - self.events_failed - self.messages_sent
+
+    async def push(self, bot: Bot, chat_id: int, kind: str, text: str, line: str, stars: float = 0, footer: str = None):
+        """
+        text — полное сообщение, если событие в окне окажется единственным,
+        line — строка события для сводки, footer — подвал сводки (ссылка и т.п.)
+        """
+        key = (chat_id, kind)
+        now = time.monotonic()
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = {'bot': bot, 'first': now, 'count': 0, 'stars': 0.0, 'lines': []}
+            self.buckets[key] = bucket
+            bucket['task'] = asyncio.create_task(self._flush_later(key))
+        bucket['last'] = now
+        bucket['count'] += 1
+        bucket['stars'] += stars
+        bucket['text'] = text
+        bucket['footer'] = footer
+        if len(bucket['lines']) < self.max_lines:
+            bucket['lines'].append(line)
+        self.events_total += 1
+
+    async def _flush_later(self, key: Tuple[int, str]):
+        bucket = self.buckets[key]
+        while True:
+            deadline = min(bucket['last'] + self.window, bucket['first'] + self.max_latency)
+            delay = deadline - time.monotonic()
+            if delay <= 0:
+                break
+            await asyncio.sleep(delay)
+        await self._send(key, self.buckets.pop(key))
+
+    def _render(self, kind: str, bucket: Dict[str, Any]) -> str:
+        if bucket['count'] == 1:
+            return bucket['text']
+        seconds = bucket['last'] - bucket['first']
+        period_name = "За последнюю минуту" if seconds <= 60 else f"За последние {round(seconds / 60)} мин."
+        parts = [self.headers[kind].format(period_name=period_name, count=bucket['count'], stars=bucket['stars'])]
+        lines = "\n".join(bucket['lines'])
+        hidden = bucket['count'] - len(bucket['lines'])
+        if hidden > 0:
+            lines += f"\n…и ещё {hidden}"
+        parts.append(f"<blockquote>{lines}</blockquote>")
+        if bucket['footer']:
+            parts.append(bucket['footer'])
+        return "\n\n".join(parts)
+
+    async def _send(self, key: Tuple[int, str], bucket: Dict[str, Any]):
+        chat_id, kind = key
+        text = self._render(kind, bucket)
+        try:
+            try:
+                await bucket['bot'].send_message(chat_id, text, parse_mode='HTML', disable_web_page_preview=True)
+            except TelegramRetryAfter as e:
+                await asyncio.sleep(e.retry_after)
+                await bucket['bot'].send_message(chat_id, text, parse_mode='HTML', disable_web_page_preview=True)
+        except Exception as e:
+            logging.error(f"[DIGEST] Ошибка при отправке сводки в {chat_id}: {e}")
+            self.events_failed += bucket['count']
+        else:
+            self.messages_sent += 1
+        if bucket['count'] > 1:
+            logging.info(f"[DIGEST] {kind} -> {chat_id}: {bucket['count']} событий в одном сообщении, всего сэкономлено запросов: {self.calls_saved}")
+
+    async def flush_all(self):
+        for key in list(self.buckets):
+            bucket = self.buckets.pop(key)
+            bucket['task'].cancel()
+            await self._send(key, bucket)
 
-            self.last_time[user_id] = current_time
+notifier = NotificationAggregator(window=DIGEST_WINDOW, max_latency=DIGEST_MAX_LATENCY)
+
+class ChannelEditQueue:
+    """
+    Правки постов в канале по одной раз в interval секунд.
+    Telegram режет частые правки в одном чате, а пачка решений из очереди заявок даёт сотни правок разом.
+    """
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.queue: deque = deque()
+        self.task: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return len(self.queue)
+
+    @property
+    def eta(self) -> float:
+        return len(self.queue) * self.interval
+
+    def push(self, bot: Bot, chat_id: int, message_id: int, text: str, reply_markup=None):
+        self.queue.append((bot, chat_id, message_id, text, reply_markup))
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._drain())
+
+    async def _drain(self):
+        while self.queue:
+            bot, chat_id, message_id, text, reply_markup = self.queue[0]
+            try:
+                await safe_edit_message(bot, chat_id, message_id, text, reply_markup)
+            except TelegramRetryAfter as e:
+                await asyncio.sleep(e.retry_after)
+                continue
+            except Exception as e:
+                logging.error(f"[EDITS] Не удалось обновить пост {message_id} в {chat_id}: {e}")
+            self.queue.popleft()
+            await asyncio.sleep(self.interval)
+
+    def close(self):
+        if self.queue:
+            logging.warning(f"[EDITS] Остановка: не применено правок постов: {len(self.queue)}")
+
+channel_edits = ChannelEditQueue(CHANNEL_EDIT_INTERVAL)
+
+class PromoRedeemQueue:
+    """
+    Групповой коммит активаций промокодов: бронь в памяти (promos.reserve) отвечает сразу,
+    успешные брони копятся interval секунд или до batch_size и пишутся одной транзакцией.
+    Пользователь получает ответ после записи пачки, так что «успешно» всегда уже в базе.
+    """
+    def __init__(self, interval: float, batch_size: int):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.pending: List[Tuple[tuple, asyncio.Future]] = []
+        self.task: Optional[asyncio.Task] = None
+
+    async def redeem(self, code: str, user_id: int):
+        success, reserved = promos.reserve(code, user_id)
+        if not success:
+            return False, reserved
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append(((code, user_id, *reserved), future))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+        elif self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._flush_later())
+        return await future
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.interval)
+        self.flush()
+
+    def flush(self):
+        batch, self.pending = self.pending, []
+        if not batch:
+            return
+        redemptions = [redemption for redemption, _ in batch]
+        try:
+            results = promos.commit(redemptions)
+        except Exception as e:
+            logging.error(f"[PROMO] Не удалось записать {len(batch)} активаций: {e}")
+            for code, user_id, _, _ in redemptions:
+                promos.release(code, user_id)
+            results = [(False, "Не удалось активировать промокод, попробуйте ещё раз")] * len(batch)
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+promo_redeems = PromoRedeemQueue(PROMO_BATCH_INTERVAL, PROMO_BATCH_SIZE)
+
+_utm_flush_task: Optional[asyncio.Task] = None
+
+def parse_start_ref(value: Optional[str]):
+    """Параметр ?start=: id пригласившего, slug UTM-кампании или None."""
+    if not value or value == "None":
+        return None
+    if value.isdigit():
+        return int(value)
+    return value if utm.get(value) else None
+
+def track_utm(slug, event: str):
+    """Событие кампании в счётчик в памяти; запись в базу — пачкой раз в UTM_FLUSH_INTERVAL."""
+    global _utm_flush_task
+    if not utm.track(slug, event):
+        return False
+    if _utm_flush_task is None or _utm_flush_task.done():
+        _utm_flush_task = asyncio.create_task(_flush_utm_later())
+    return True
+
+async def _flush_utm_later():
+    await asyncio.sleep(UTM_FLUSH_INTERVAL)
+    flush_utm()
+
+def flush_utm():
+    try:
+        utm.flush()
+    except Exception as e:
+        logging.error(f"[UTM] Ошибка при записи счётчиков: {e}")
+
+async def notify_referral(bot: Bot, ref_id: int, new_user_id: int, nac: float):
+    new_ref_link = f"https://t.me/{(await bot.me()).username}?start={ref_id}"
+    await notifier.push(
+        bot,
+        ref_id,
+        'referral',
+        text=(
+            f"🎉 Пользователь <code>{new_user_id}</code> запустил бота по вашей ссылке!\n"
+            f"Вы получили +{nac}⭐️ за реферала.\n"
+            f"Поделитесь ссылкой ещё раз:\n<code>{new_ref_link}</code>"
+        ),
+        line=f"👤 <code>{new_user_id}</code> +{nac}⭐️",
+        stars=nac,
+        footer=f"Поделитесь ссылкой ещё раз:\n<code>{new_ref_link}</code>"
+    )
+
+# ============================================
+# CALLBACK DATA И ТАБЛИЦА МАРШРУТИЗАЦИИ КОЛБЭКОВ
+# ============================================
+class WithdrawCallback(CallbackData, prefix='withdraw'):
+    amount: str
+    emoji: Optional[str] = None
+
+class PayoutCallback(CallbackData, prefix='wd'):
+    """Решение по заявке на вывод: данные заявки лежат в callback_contexts под token."""
+    action: str
+    token: str
+    reason: str = ''
+
+class ReviewCallback(CallbackData, prefix='review'):
+    """Очередь заявок на вывод в админке: after — id, после которого начинается страница."""
+    action: str
+    after: int = 0
+    wid: int = 0
+    reason: str = ''
+
+# Старый формат кнопок заявок: всё в callback_data (упирается в лимит 64 байта)
+class PaidCallback(CallbackData, prefix='paid'):
+    id_v: int
+    message_id: int
+    user_id: int
+    username: str
+    stars: int
+    emoji: str
+
+class DeniedCallback(PaidCallback, prefix='denied'):
+    pass
+
+class BalkCallback(PaidCallback, prefix='balk'):
+    reason: str
+
+class PremiumPaidCallback(CallbackData, prefix='premium_paid'):
+    id_v: int
+    message_id: int
+    user_id: int
+    username: str
+    level: int
+
+class PremiumDeniedCallback(PremiumPaidCallback, prefix='premium_denied'):
+    pass
+
+class KnbFirstMoveCallback(CallbackData, prefix='knb1'):
+    move: str
+    game_id: int
+
+class KnbSecondMoveCallback(KnbFirstMoveCallback, prefix='knb2'):
+    pass
+
+class BuyTicketCallback(CallbackData, prefix='buy_ticket'):
+    lot_id: int
+    price: str
+
+class TaskCheckCallback(CallbackData, prefix='task_check'):
+    reward: float
+    task_id: int
+    chat_id: str
+
+class UtmLinkCallback(CallbackData, prefix='utm_link'):
+    action: str
+    slug: str
+
+class CaptchaCallback(CallbackData, prefix='captcha'):
+    answer: int
+    ref_id: int
+
+class CallbackTable(BaseMiddleware):
+    """Колбэки разрешаются поиском в словаре по части callback_data до первого ':', а не
+    перебором фильтров роутера по порядку.
+
+    Хендлер регистрируется декоратором route(): он попадает и в таблицу, и в роутер с
+    эквивалентным фильтром, поэтому при промахе таблицы (неизвестные или старые данные,
+    состояния из state()) работает обычный путь aiogram. Для CallbackData-фабрик хендлер
+    получает распакованный callback_data, как при фильтре Factory.filter()."""
+
+    def __init__(self, router: Router):
+        self.router = router
+        self.routes: Dict[str, Tuple[Any, Optional[type]]] = {}
+        self.stateful: set = set()
+
+    def route(self, *keys: str, factory: Optional[type] = None, legacy: Tuple[str, ...] = ()):
+        def decorator(func):
+            if factory is not None:
+                route_keys = (factory.__prefix__,)
+                self.router.callback_query.register(func, factory.filter())
+            else:
+                route_keys = keys
+                prefixes = tuple(f"{key}:" for key in keys) + legacy
+                self.router.callback_query.register(func, F.data.in_(keys) | F.data.startswith(prefixes))
+            # register() возвращает саму функцию, а HandlerObject — последний в списке
+            handler = self.router.callback_query.handlers[-1]
+            for key in route_keys:
+                if key in self.routes:
+                    raise ValueError(f"Колбэк {key!r} уже зарегистрирован")
+                self.routes[key] = (handler, factory)
+            return func
+        return decorator
+
+    def state(self, state: State):
+        """Хендлер, который в этом состоянии ловит все колбэки пользователя (минуя таблицу)."""
+        def decorator(func):
+            self.router.callback_query.register(func, state)
+            self.stateful.add(state.state)
+            return func
+        return decorator
+
+    @staticmethod
+    def unpack(factory, data: str):
+        # Старые кнопки могли не содержать необязательных полей в конце
+        missing = len(factory.model_fields) + 1 - len(data.split(factory.__separator__))
+        if missing > 0:
+            data += factory.__separator__ * missing
+        return factory.unpack(data)
+
+    async def __call__(
+        self,
+        handler: Callable[[types.CallbackQuery, Dict[str, Any]], Awaitable[Any]],
+        event: types.CallbackQuery,
+        data: Dict[str, Any]
+    ) -> Any:
+        if not event.data or data.get('raw_state') in self.stateful:
             return await handler(event, data)
+        route = self.routes.get(event.data.split(':', 1)[0])
+        if route is None:
+            return await handler(event, data)
+
+        target, factory = route
+        if factory is not None:
+            try:
+                data = {**data, 'callback_data': self.unpack(factory, event.data)}
+            except (TypeError, ValueError) as e:
+                logging.warning(f"Некорректные данные колбэка {event.data!r}: {e}")
+                return await handler(event, data)
+        return await target.call(event, **data)
+
+callbacks = CallbackTable(router)
+
+# Навигация по меню: вместо delete_message + send_photo редактируем текущее сообщение.
+# file_id картинок запоминаем после первой загрузки, чтобы не слать файл повторно.
+photo_cache: Dict[str, Tuple[str, str]] = {}
+
+def _cached_photo(path: str):
+    cached = photo_cache.get(path)
+    return cached[0] if cached else FSInputFile(path)
+
+def _remember_photo(path: str, message: Message):
+    if message and message.photo:
+        photo_cache[path] = (message.photo[-1].file_id, message.photo[-1].file_unique_id)
+
+def short_stars(value) -> str:
+    """Звёзды с одним знаком после точки (как в меню); строки вроде «Ошибка» выводятся как есть."""
+    if isinstance(value, str):
+        return value
+    return Money.of(value).format(1)
+
+class UIRegistry:
+    """Статичные клавиатуры и шаблоны подписей: собираются один раз при старте, а не на каждый тап.
+    После изменения настроек (beta-кнопка, ссылки) достаточно вызвать build()."""
+
+    def __init__(self):
+        self.build()
+
+    @staticmethod
+    def _markup(buttons, *sizes) -> InlineKeyboardMarkup:
+        builder = InlineKeyboardBuilder()
+        for text, data in buttons:
+            # Не-колбэк кнопки передаются явно словарём параметров, например {'url': ...}
+            if isinstance(data, dict):
+                builder.button(text=text, **data)
+            else:
+                builder.button(text=text, callback_data=data)
+        return builder.adjust(*sizes).as_markup()
+
+    def build(self):
+        main_buttons = [
+            ('✨ Фармить звёзды', 'click_star'),
+            ('🎮 Мини-игры', 'mini_games'),
+            ('🔗 Получить ссылку', 'earn_stars'),
+            ('🔄 Обменять звёзды', 'withdraw_stars_menu'),
+            ('👤 Профиль', 'my_balance'),
+            ('📝 Задания', 'tasks'),
+            ('📘 Гайды | FAQ', 'faq'),
+            ('🚀 Буст', 'donate'),
+            ('🏆 Топ', 'leaders')
+        ]
+        if beta_url and beta_name:
+            main_buttons.append((beta_name, {'url': beta_url}))
+        self.main_menu = self._markup(main_buttons, 1, 1, 2, 2, 2, 2, 1)
+
+        bet_buttons = [(f"Ставка {bet}⭐️", f"play_game_with_bet:{bet}") for bet in ('0.5', '1', '2', '3', '4', '5')]
+        self.bet_menu = self._markup(bet_buttons + [("Назад в меню мини-игр", "mini_games")], 3, 3, 1)
+
+        self.mini_games = self._markup([
+            ("[🔥] Кража звезд 💰", "theft_game"),
+            ("[🔥] КНБ ✊✌️🖐", "knb_game"),
+            ("Лотерея 🎰", "lottery_game"),
+            ("Все или ничего 🎲", "play_game"),
+            ("⬅️ В главное меню", "back_main")
+        ], 1, 1, 2, 1)
+
+        self.withdraw_menu = self._markup([
+            ("15 ⭐️(🧸)", WithdrawCallback(amount="15", emoji="🧸").pack()),
+            ("15 ⭐️(💝)", WithdrawCallback(amount="15", emoji="💝").pack()),
+            ("25 ⭐️(🌹)", WithdrawCallback(amount="25", emoji="🌹").pack()),
+            ("25 ⭐️(🎁)", WithdrawCallback(amount="25", emoji="🎁").pack()),
+            ("50 ⭐️(🍾)", WithdrawCallback(amount="50", emoji="🍾").pack()),
+            ("50 ⭐️(🚀)", WithdrawCallback(amount="50", emoji="🚀").pack()),
+            ("50 ⭐️(💐)", WithdrawCallback(amount="50", emoji="💐").pack()),
+            ("50 ⭐️(🎂)", WithdrawCallback(amount="50", emoji="🎂").pack()),
+            ("100 ⭐️(🏆)", WithdrawCallback(amount="100", emoji="🏆").pack()),
+            ("100 ⭐️(💍)", WithdrawCallback(amount="100", emoji="💍").pack()),
+            ("100 ⭐️(💎)", WithdrawCallback(amount="100", emoji="💎").pack()),
+            ("Telegram Premium 1мес. (400 ⭐️)", WithdrawCallback(amount="premium1").pack()),
+            ("Telegram Premium 3мес. (1100 ⭐️)", WithdrawCallback(amount="premium2").pack()),
+            ("⬅️ В главное меню", "back_main")
+        ], 2, 2, 2, 2, 2, 1, 1, 1)
+
+        admin_buttons = [
+            ('🌐 UTM-Ссылки', 'utm'),
+            ('🎰 Лотерея', 'admin_lotery'),
+            ('📊 Статистика', 'stats'),
+            ("🔎 Информация о пользователе", "users_check"),
+            ("⭐️ Выдать звезды", "add_stars"),
+            ("⭐️ Снять звезды", "remove_stars"),
+            ("📨 Рассылка", "mailing"),
+            ("🎁 Добавить промокод", 'add_promo_code'),
+            ("🚫 Удалить промокод", 'remove_promo_code'),
+            ("📝 Добавить канал", 'add_channel'),
+            ("🚫 Удалить канал", 'remove_channel'),
+            ("📝 Добавленные каналы", 'info_added_channels'),
+            ("🏆 Топ-50 Баланс", 'top_balance'),
+            ("🌠 Выдать буст", "give_boost"),
+            ("📋 Заявки на вывод", ReviewCallback(action='page').pack())
+        ]
+        # /adminpanel дополнительно показывает дамп базы, возврат из разделов — без него
+        self.admin_panel = self._markup([('💾 Дамп базы', 'dump')] + admin_buttons, 1, 1, 1, 1, 1, 2, 1, 2, 2, 1, 1, 1, 1)
+        self.admin_panel_back = self._markup(admin_buttons, 1, 1, 1, 1, 2, 1, 2, 2, 1, 1, 1, 1)
+
+        self.profile = self._markup([('🎁 Ежедневка', 'giftday'), ("🎫 Промокод", "promocode"), ("⬅️ В главное меню", "back_main")], 2, 1)
+        self.back_main = self._markup([("⬅️ В главное меню", "back_main")], 1)
+        self.back_mini_games = self._markup([("Назад в меню мини-игр", "mini_games")], 1)
+
+        # Неизменяемые части подписей склеиваются один раз, при рендере подставляются только числа
+        self._main_head = "<b>✨ Добро пожаловать в главное меню ✨</b>\n\n<b>🌟 Всего заработано: <code>"
+        self._main_mid = "</code>⭐️</b>\n<b>♻️ Всего обменяли: <code>"
+        self._main_tail = (
+            "</code>⭐️</b>\n\n"
+            "<b>Как заработать звёзды?</b>\n"
+            "<blockquote>🔸 <i>Кликай, собирай ежедневные награды и вводи промокоды</i>\n"
+            "— всё это доступно в разделе «Профиль».\n"
+            "🔸 <i>Выполняй задания и приглашай друзей</i>\n"
+            "🔸 <i>Испытай удачу в увлекательных мини-играх</i>\n"
+            "— всё это доступно в главном меню.</blockquote>"
+        )
+        self._bet_head = "<b>💰 У тебя на счету:</b> "
+        self._bet_tail = (
+            "⭐️\n\n🔔 Ты выбрал игру 'Испытать удачу'. Выбери ставку и попытайся победить! 🍀\n\n"
+            "📊 Онлайн статистика выигрышей: " + channel_link
+        )
+        self._withdraw_head = "<b>🔸 У тебя на счету: "
+        self._withdraw_tail = (
+            "⭐️</b>\n\n<b>❗️ Важно!</b> Для получения выплаты (подарка) нужно быть подписанным на:\n"
+            f'<a href="{channel_osn}">Основной канал</a> | <a href="{chater}">Чат</a> | <a href="{channel_viplat}">Канал выплат</a>\n\n'
+            "<blockquote>‼️ Если не будет подписки в момент отправки подарка - выплата будет удалена, звёзды не возвращаются!</blockquote>\n\n"
+            "<b>Выбери количество звёзд, которое хочешь обменять, из доступных вариантов ниже:</b>"
+        )
+
+    def main_caption(self, all_stars, withdrawn) -> str:
+        return self._main_head + short_stars(all_stars) + self._main_mid + short_stars(withdrawn) + self._main_tail
+
+    def bet_caption(self, balance) -> str:
+        return self._bet_head + str(balance) + self._bet_tail
+
+    def withdraw_caption(self, balance) -> str:
+        return self._withdraw_head + short_stars(balance) + self._withdraw_tail
+
+ui = UIRegistry()
+
+async def show_screen(bot: Bot, call: CallbackQuery, photo: Optional[str], caption: str, reply_markup=None, disable_web_page_preview: bool = False):
+    """Показывает экран на месте текущего сообщения, при неудаче — новым сообщением.
+    photo=None — текстовый экран."""
+    chat_id = call.from_user.id
+    message = call.message
+    try:
+        if photo and message is not None and message.photo:
+            cached = photo_cache.get(photo)
+            if cached and cached[1] == message.photo[-1].file_unique_id:
+                await bot.edit_message_caption(
+                    chat_id=chat_id, message_id=message.message_id,
+                    caption=caption, parse_mode='HTML', reply_markup=reply_markup
+                )
+            else:
+                edited = await bot.edit_message_media(
+                    chat_id=chat_id, message_id=message.message_id,
+                    media=types.InputMediaPhoto(media=_cached_photo(photo), caption=caption, parse_mode='HTML'),
+                    reply_markup=reply_markup
+                )
+                if isinstance(edited, Message):
+                    _remember_photo(photo, edited)
+            return
+        if not photo and message is not None and message.text:
+            await bot.edit_message_text(
+                chat_id=chat_id, message_id=message.message_id, text=caption, parse_mode='HTML',
+                reply_markup=reply_markup, disable_web_page_preview=disable_web_page_preview
+            )
+            return
+    except TelegramBadRequest as e:
+        if "message is not modified" in str(e):
+            return
+        logging.warning(f"Не удалось отредактировать сообщение {message.message_id}: {e}")
+
+    if message is not None:
+        try:
+            await bot.delete_message(chat_id=chat_id, message_id=message.message_id)
+        except Exception as e:
+            logging.error(f"Ошибка при удалении сообщения: {e}")
+    if photo:
+        sent = await bot.send_photo(chat_id, photo=_cached_photo(photo), caption=caption, parse_mode='HTML', reply_markup=reply_markup)
+        _remember_photo(photo, sent)
+    else:
+        await bot.send_message(chat_id, caption, parse_mode='HTML', reply_markup=reply_markup, disable_web_page_preview=disable_web_page_preview)
 
 class KNBGame(StatesGroup):
     waiting_username = State()
@@ -288,11 +1016,11 @@ async def show_gender(chat_id, bot: Bot, ref_id=None):
         reply_markup=markup, 
         parse_mode='HTML'
     )
-@router.callback_query(F.data.startswith('gendergram_'))
+@callbacks.route('gendergram_male', 'gendergram_female')
 async def gendergram(call: types.CallbackQuery, state: FSMContext, bot: Bot):
     data = call.data.split(':')
     gender = data[0].split('gendergram_')[1]
-    ref_id = int(data[1]) if len(data) > 1 and data[1] != "None" else None
+    ref_id = parse_start_ref(data[1]) if len(data) > 1 else None
     
     user_id = call.from_user.id
     chat_id = call.message.chat.id
@@ -309,11 +1037,10 @@ async def gendergram(call: types.CallbackQuery, state: FSMContext, bot: Bot):
 
     if response == 'ok':
         if not user_exists(user_id):
-            if ref_id is not None:
-                await handle_referral_bonus(ref_id, user_id, bot)
-                add_user(user_id, call.from_user.username, ref_id)
-            else:
-                add_user(user_id, call.from_user.username)
+            if isinstance(ref_id, str):
+                track_utm(ref_id, 'registered')
+                ref_id = None
+            await register_user(user_id, call.from_user.username, ref_id, bot)
         
         await bot.answer_callback_query(call.id, 'Спасибо за подписку 👍')
         await state.clear()
@@ -321,7 +1048,7 @@ async def gendergram(call: types.CallbackQuery, state: FSMContext, bot: Bot):
     else:
         await bot.answer_callback_query(call.id, '❌ Вы всё ещё не подписаны на все каналы!', show_alert=True)
 
-async def request_task(user_id, chat_id, first_name, language_code, bot: Bot):
+async def request_task(user_id, chat_id, first_name, language_code, bot: Bot, call: Optional[CallbackQuery] = None):
     headers = {
         'Content-Type': 'application/json',
         'Auth': f'{SUBGRAM_TOKEN}',
@@ -337,10 +1064,10 @@ async def request_task(user_id, chat_id, first_name, language_code, bot: Bot):
             response_json = await response.json()
 
             if response_json.get('status') == 'warning':
-                await show_task(chat_id, response_json.get("links",[]), bot)
+                await show_task(chat_id, response_json.get("links",[]), bot, call)
             return response_json.get("status")
 
-async def show_task(chat_id, links, bot: Bot):
+async def show_task(chat_id, links, bot: Bot, call: Optional[CallbackQuery] = None):
     markup = InlineKeyboardBuilder()
     temp_row = []
     sponsor_count = 0
@@ -360,8 +1087,12 @@ async def show_task(chat_id, links, bot: Bot):
     back_to_main = types.InlineKeyboardButton(text='⬅️ В главное меню', callback_data='back_main')
     markup.row(item1)
     markup.row(back_to_main)
+    caption = "<b>✨ Новое задание! ✨!\n\n• Подпишитесь на каналы, которые указаны ниже.\n\nНаграда: 0.7 ⭐️</b>\n\n📌 Чтобы получить награду полностью, подпишитесь и не ОТПИСЫВАЙТЕСЬ от канала/группы в течение 3-х дней \"Проверить подписку\" 👇"
+    if call is not None:
+        await show_screen(bot, call, "photos/check_subs.jpg", caption, markup.as_markup())
+        return
     photo = FSInputFile("photos/check_subs.jpg")
-    await bot.send_photo(chat_id=chat_id, photo=photo, caption="<b>✨ Новое задание! ✨!\n\n• Подпишитесь на каналы, которые указаны ниже.\n\nНаграда: 0.7 ⭐️</b>\n\n📌 Чтобы получить награду полностью, подпишитесь и не ОТПИСЫВАЙТЕСЬ от канала/группы в течение 3-х дней \"Проверить подписку\" 👇", parse_mode='HTML',reply_markup=markup.as_markup())
+    await bot.send_photo(chat_id=chat_id, photo=photo, caption=caption, parse_mode='HTML',reply_markup=markup.as_markup())
 
 async def show_op(chat_id,links, bot: Bot, ref_id=None):
     markup = InlineKeyboardBuilder()
@@ -459,7 +1190,7 @@ def create_captcha_keyboard(correct_answer, ref_id):
     random.shuffle(answers)
     builder = InlineKeyboardBuilder()
     for answer in answers:
-        builder.button(text=str(answer), callback_data=f"captcha_{answer}_{ref_id}")
+        builder.button(text=str(answer), callback_data=CaptchaCallback(answer=answer, ref_id=ref_id).pack())
     builder.adjust(3)
     return builder.as_markup()
 
@@ -475,30 +1206,13 @@ async def start_command(message: Message, bot: Bot, state: FSMContext):
         return
 
     try:
-        all_stars = str(sum_all_stars())
-        withdrawed = str(sum_all_withdrawn())
+        all_stars = sum_all_stars()
+        withdrawed = sum_all_withdrawn()
     except Exception as e:
         logging.error(f"Ошибка при получении статистики: {e}")
         all_stars, withdrawed = "Ошибка", "Ошибка"
 
-    builder_start = InlineKeyboardBuilder()
-    buttons = [
-        ('✨ Фармить звёзды', 'click_star'),
-        ('🎮 Мини-игры', 'mini_games'),
-        ('🔗 Получить ссылку', 'earn_stars'),
-        ('🔄 Обменять звёзды', 'withdraw_stars_menu'),
-        ('👤 Профиль', 'my_balance'),
-        ('📝 Задания', 'tasks'),
-        ('📘 Гайды | FAQ', 'faq'),
-        ('🚀 Буст', 'donate'),
-        ('🏆 Топ', 'leaders')
-    ]
-    for text, callback_data in buttons:
-        builder_start.button(text=text, callback_data=callback_data)
-    if beta_url and beta_name:
-        builder_start.button(text=beta_name, url=beta_url)
-    builder_start.adjust(1, 1, 2, 2, 2, 2, 1)
-    markup_start = builder_start.as_markup()
+    markup_start = ui.main_menu
 
 
     referral_id = None
@@ -506,6 +1220,7 @@ async def start_command(message: Message, bot: Bot, state: FSMContext):
         referral_id = int(args[1])
     elif len(args) > 1:
         referral_id = args[1]
+        track_utm(referral_id, 'starts')
 
     is_premium = getattr(user, 'is_premium', None)
     if message.chat.id != id_chat:
@@ -539,17 +1254,10 @@ async def start_command(message: Message, bot: Bot, state: FSMContext):
             )
             return
         else:
-            urls_utm = get_urls_utm()
-            for url in urls_utm:
-                url_title = url.split('=')[1]
-                if referral_id == url_title:
-                    users_add_utm(url)
-                    referral_id = None
-                    break
-            add_user(user_id, user.username, referral_id)
-    cur_username = get_username(user_id)
-    if cur_username != username:
-        readd_username(user_id, username)
+            if isinstance(referral_id, str):
+                track_utm(referral_id, 'registered')
+                referral_id = None
+            await register_user(user_id, user.username, referral_id, bot)
     if message.chat.id != id_chat:
         await send_hi_views(
             user_id=message.from_user.id,
@@ -560,68 +1268,35 @@ async def start_command(message: Message, bot: Bot, state: FSMContext):
         )
         await asyncio.sleep(1.2)
     await bot.send_message(user_id, "⭐")
-    photo = FSInputFile("photos/start.jpg")
-    await bot.send_photo(
+    sent = await bot.send_photo(
         chat_id=user_id,
-        photo=photo,
-        caption=(
-            f"<b>✨ Добро пожаловать в главное меню ✨</b>\n\n"
-            f"<b>🌟 Всего заработано: <code>{all_stars[:all_stars.find('.') + 2] if '.' in all_stars else all_stars}</code>⭐️</b>\n"
-            f"<b>♻️ Всего обменяли: <code>{withdrawed[:withdrawed.find('.') + 2] if '.' in withdrawed else withdrawed}</code>⭐️</b>\n\n"
-            "<b>Как заработать звёзды?</b>\n"
-            "<blockquote>🔸 <i>Кликай, собирай ежедневные награды и вводи промокоды</i>\n"
-            "— всё это доступно в разделе «Профиль».\n"
-            "🔸 <i>Выполняй задания и приглашай друзей</i>\n"
-            "🔸 <i>Испытай удачу в увлекательных мини-играх</i>\n"
-            "— всё это доступно в главном меню.</blockquote>"
-        ),
+        photo=_cached_photo("photos/start.jpg"),
+        caption=ui.main_caption(all_stars, withdrawed),
         parse_mode='HTML',
         reply_markup=markup_start
     )
+    _remember_photo("photos/start.jpg", sent)
 
-@router.callback_query(CaptchaState.waiting_for_answer)
+@callbacks.state(CaptchaState.waiting_for_answer)
 async def process_captcha(callback_query: CallbackQuery, state: FSMContext, bot: Bot):
     user_id = callback_query.from_user.id
     username = callback_query.from_user.username if callback_query.from_user.username else None
     try:
-        if not callback_query.data.startswith("captcha_"):
+        try:
+            captcha = CaptchaCallback.unpack(callback_query.data)
+        except (TypeError, ValueError):
             await bot.answer_callback_query(callback_query.id, "❌ Неизвестный формат данных.")
             return
 
-        parts = callback_query.data.split('_')
-        if len(parts) != 3:
-            await bot.answer_callback_query(callback_query.id, "❌ Неверный формат данных.")
-            return
-
-        user_answer = int(parts[1])
-        referal = int(parts[2])
+        user_answer = captcha.answer
+        referal = captcha.ref_id
 
         data = await state.get_data()
         capthca_answer = data['capthca_answer']
 
         if user_answer == capthca_answer:
-            add_user(user_id, username, referal)
             await bot.answer_callback_query(callback_query.id, "✅ Вы ответили верно!")
-            c_refs = get_user_referrals_count(referal)
-            increment_referrals(referal)
-            if c_refs < 50:
-                nac = 0.7 * 2 if user_in_booster(referal) else 0.7
-                increment_stars(referal, nac)
-            elif 50 <= c_refs < 250:
-                nac = 1 * 2 if user_in_booster(referal) else 1
-                increment_stars(referal, nac)
-            else:
-                nac = 1.5 * 2 if user_in_booster(referal) else 1.5
-                increment_stars(referal, nac)
-
-            new_ref_link = f"https://t.me/{(await bot.me()).username}?start={referal}"
-            await bot.send_message(
-                referal,
-                f"🎉 Пользователь <code>{user_id}</code> запустил бота по вашей ссылке!\n"
-                f"Вы получили +{nac}⭐️ за реферала.\n"
-                f"Поделитесь ссылкой ещё раз:\n<code>{new_ref_link}</code>",
-                parse_mode='HTML'
-            )
+            await register_user(user_id, username, referal, bot)
 
             await bot.delete_message(user_id, callback_query.message.message_id)
             await send_main_menu(user_id, bot)
@@ -636,28 +1311,12 @@ async def process_captcha(callback_query: CallbackQuery, state: FSMContext, bot:
 async def adminpanel_command(message: Message, bot: Bot):
     if message.from_user.id in admins_id:
         
-        builder_admin = InlineKeyboardBuilder()
-        builder_admin.button(text='💾 Дамп базы', callback_data='dump')
-        builder_admin.button(text='🌐 UTM-Ссылки', callback_data='utm')
-        builder_admin.button(text='🎰 Лотерея', callback_data='admin_lotery')
-        builder_admin.button(text='📊 Статистика', callback_data='stats')
-        builder_admin.button(text="🔎 Информация о пользователе", callback_data="users_check")
-        builder_admin.button(text="⭐️ Выдать звезды", callback_data="add_stars")
-        builder_admin.button(text="⭐️ Снять звезды", callback_data="remove_stars")
-        builder_admin.button(text="📨 Рассылка", callback_data="mailing")
-        builder_admin.button(text="🎁 Добавить промокод", callback_data='add_promo_code')
-        builder_admin.button(text="🚫 Удалить промокод", callback_data='remove_promo_code')
-        builder_admin.button(text="📝 Добавить канал", callback_data='add_channel')
-        builder_admin.button(text="🚫 Удалить канал", callback_data='remove_channel')
-        builder_admin.button(text="📝 Добавленные каналы", callback_data='info_added_channels')
-        builder_admin.button(text="🏆 Топ-50 Баланс", callback_data='top_balance')
-        builder_admin.button(text="🌠 Выдать буст", callback_data="give_boost")
-        markup_admin = builder_admin.adjust(1, 1, 1, 1, 1, 2, 1, 2, 2, 1, 1, 1).as_markup()
+        markup_admin = ui.admin_panel
 
         try:
             headers = {'Content-Type': 'application/json', 'Auth': f'{SUBGRAM_TOKEN}', 'Accept': 'application/json'}
-            user_count = get_user_count()
-            total_withdrawn = get_total_withdrawn()
+            user_count = await get_user_count()
+            total_withdrawn = await get_total_withdrawn()
             try:
                 async with aiohttp.ClientSession() as session:
                     async with session.post('https://api.subgram.ru/get-balance/', headers=headers) as response:
@@ -672,19 +1331,19 @@ async def adminpanel_command(message: Message, bot: Bot):
     else:
         await bot.send_message(message.from_user.id, "<b>🚫 У вас нет доступа к панели администратора</b>", parse_mode='HTML')
 
-@router.callback_query(F.data == 'dump')
+@callbacks.route('dump')
 async def dump_callback(call: CallbackQuery, bot: Bot):
     try:
         if call.message.chat.id in admins_id:
-            user_ids = get_users_ids()
+            # Выгрузка собирается на потоке read-only пула и не держит event loop
+            dump = await dump_users_ids()
             
-            if not user_ids:
+            if not dump:
                 await bot.send_message(call.from_user.id, "❌ База данных пользователей пуста")
                 return
             
-            text = '\n'.join(str(user_id[0]) for user_id in user_ids)
             document = BufferedInputFile(
-                text.encode('utf-8'),
+                dump,
                 filename='dumped.txt'
             )
             await bot.send_document(
@@ -698,7 +1357,7 @@ async def dump_callback(call: CallbackQuery, bot: Bot):
         await bot.send_message(call.from_user.id, f"⚠️ Ошибка при создании дампа: {str(e)}")
         
 
-@router.callback_query(F.data == "utm")
+@callbacks.route("utm")
 async def utm_callback(call: CallbackQuery, bot: Bot):
     if call.message.chat.id in admins_id:
         await bot.delete_message(call.message.chat.id, call.message.message_id)
@@ -709,29 +1368,38 @@ async def utm_callback(call: CallbackQuery, bot: Bot):
         markup_utm = builder_utm.adjust(2, 1).as_markup()
         await bot.send_message(call.from_user.id, f"<b>🪅 Вы вошли в UTM-панель</b>", parse_mode='HTML', reply_markup=markup_utm)
 
-@router.callback_query(F.data.startswith('utm_'))
-async def utm_callback(call: CallbackQuery, bot: Bot):
+@callbacks.route(factory=UtmLinkCallback)
+async def utm_link_callback(call: CallbackQuery, bot: Bot, callback_data: UtmLinkCallback):
     if call.message.chat.id in admins_id:
+        url_title = callback_data.slug
+        url = utm.get(url_title)
+        if url is None:
+            await bot.answer_callback_query(call.id, "❌ Ссылка не найдена.")
+            return
         await bot.delete_message(call.message.chat.id, call.message.message_id)
-        url1 = call.data.split('_')[1]
-        url2 = call.data.split('_')[2]
-        url_title = url2.split('=')[1]
-        url = url1 + "_" + url2
-        count_users = users_utm_count(url)
-        count_op_users = users_utm_count_op(url)
+        if callback_data.action == 'delete':
+            delete_utm(url_title)
+            await bot.send_message(call.from_user.id, f"✅ UTM-ссылка успешно удалена.\n\n<blockquote>👉 Ссылка: <code>{url}</code></blockquote>", parse_mode='HTML', reply_markup=InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="⬅️ Назад", callback_data="list_utm")]]))
+            return
+        flush_utm()
+        stats = utm.stats(url_title)
+        periods = "\n".join(
+            f"{title}: старты {stats[key]['starts']} | ОП {stats[key]['subscribed']} | регистрации {stats[key]['registered']}"
+            for key, title in ((24, '🕐 За 24 часа'), (24 * 7, '📅 За 7 дней'))
+        )
         utm_link_use = InlineKeyboardBuilder()
-        utm_link_use.button(text="❌ Удалить ссылку", callback_data=f"delete_utm_{url}")
+        utm_link_use.button(text="❌ Удалить ссылку", callback_data=UtmLinkCallback(action='delete', slug=url_title).pack())
         utm_link_use.button(text="⬅️ Назад", callback_data="list_utm")
         markup_utm_use = utm_link_use.adjust(1, 1).as_markup()
-        await bot.send_message(call.from_user.id, f"<b>🍀 Вы выбрали ссылку <code>#{url_title}</code></b>\n\n<blockquote>👤 Все пользователи: {count_users}\n👤 Прошли ОП: {count_op_users}</blockquote>", parse_mode='HTML', reply_markup=markup_utm_use)
+        await bot.send_message(call.from_user.id, f"<b>🍀 Вы выбрали ссылку <code>#{url_title}</code></b>\n\n<blockquote>🔗 Переходы: {stats['total']['starts']}\n👤 Все пользователи: {stats['total']['registered']}\n👤 Прошли ОП: {stats['total']['subscribed']}</blockquote>\n<blockquote>{periods}</blockquote>", parse_mode='HTML', reply_markup=markup_utm_use)
 
-@router.callback_query(F.data == "delete_utm")
-async def delete_utm(call: CallbackQuery, bot: Bot, state: FSMContext):
-    if call.mesasge.chat.id in admins_id:
+@callbacks.route("delete_utm")
+async def delete_utm_callback(call: CallbackQuery, bot: Bot, state: FSMContext):
+    if call.message.chat.id in admins_id:
         await state.set_state(AddUtmState.waiting_for_delete)
         await bot.send_message(call.from_user.id, "🌐 Введите название UTM-ссылки:", parse_mode='HTML')
 
-@router.callback_query(F.data == "add_utm")
+@callbacks.route("add_utm")
 async def add_utm(message: Message, bot: Bot, state: FSMContext):
     if message.from_user.id in admins_id:
         await state.set_state(AddUtmState.waiting_for_url)
@@ -739,10 +1407,10 @@ async def add_utm(message: Message, bot: Bot, state: FSMContext):
 
 @router.message(AddUtmState.waiting_for_delete)
 async def process_delete_utm(message: Message, state: FSMContext, bot: Bot):
-    url = message.text
-    url = f"https://t.me/{(await bot.me()).username}?start={url}"
+    slug = message.text
+    url = f"https://t.me/{(await bot.me()).username}?start={slug}"
     try:
-        delete_utm(url)
+        delete_utm(slug)
         await bot.send_message(message.from_user.id, f"✅ UTM-ссылка успешно удалена.\n\n<blockquote>👉 Ссылка: <code>{url}</code></blockquote>", parse_mode='HTML')
     except Exception as e:
         await bot.send_message(message.from_user.id, f"❌ Ошибка при удалении UTM-ссылки", parse_mode='HTML')
@@ -750,29 +1418,31 @@ async def process_delete_utm(message: Message, state: FSMContext, bot: Bot):
 
 @router.message(AddUtmState.waiting_for_url)
 async def process_utm(message: Message, state: FSMContext, bot: Bot):
-    url = message.text
-    url = f"https://t.me/{(await bot.me()).username}?start={url}"
+    slug = message.text
+    url = f"https://t.me/{(await bot.me()).username}?start={slug}"
     try:
-        create_utm(url)
+        if not create_utm(slug, url):
+            await bot.send_message(message.from_user.id, f"❌ UTM-ссылка <code>{html.escape(slug)}</code> уже есть", parse_mode='HTML')
+            await state.clear()
+            return
         await bot.send_message(message.from_user.id, f"✅ UTM-ссылка успешно добавлена.\n\n<blockquote>👉 Ссылка: <code>{url}</code></blockquote>", parse_mode='HTML')
     except Exception as e:
         await bot.send_message(message.from_user.id, f"❌ Ошибка при добавлении UTM-ссылки", parse_mode='HTML')
     await state.clear()
 
 
-@router.callback_query(F.data == "list_utm")
+@callbacks.route("list_utm")
 async def list_utm(call: CallbackQuery, bot: Bot):
     if call.message.chat.id in admins_id:
         await bot.delete_message(call.message.chat.id, call.message.message_id)
-        utm_links = get_urls_utm()
+        utm_links = utm.slugs()
         temp_links = []
         count_links = 0
         builder_utm_links = InlineKeyboardBuilder()
-        for url in utm_links:
+        for name in utm_links:
             count_links += 1
-            name = url.split('=')[1]
             # print(url)
-            button = types.InlineKeyboardButton(text=f"{name}", callback_data=f"utm_{url}")
+            button = types.InlineKeyboardButton(text=f"{name}", callback_data=UtmLinkCallback(action='show', slug=name).pack())
             temp_links.append(button)
 
             if count_links % 2 == 0:
@@ -786,7 +1456,7 @@ async def list_utm(call: CallbackQuery, bot: Bot):
 
         await bot.send_message(call.from_user.id, f"<b>📦 Список UTM-ссылок:</b>", parse_mode='HTML', reply_markup=builder_utm_links.as_markup())
 
-@router.callback_query(F.data == "admin_lotery")
+@callbacks.route("admin_lotery")
 async def adminka_lottery(call: CallbackQuery, bot: Bot):
     await bot.delete_message(call.message.chat.id, call.message.message_id)
     if call.message.chat.id in admins_id:
@@ -806,7 +1476,7 @@ async def adminka_lottery(call: CallbackQuery, bot: Bot):
     else:
         await bot.send_message(call.message.chat.id, "<b>🚫 У вас нет доступа к панели администратора</b>", parse_mode='HTML')
 
-@router.callback_query(F.data == "finish_lotery")
+@callbacks.route("finish_lotery")
 async def finish_lotery_callback(call: CallbackQuery, bot: Bot, state: FSMContext):
     await bot.delete_message(call.message.chat.id, call.message.message_id)
     if call.message.chat.id in admins_id:
@@ -814,18 +1484,17 @@ async def finish_lotery_callback(call: CallbackQuery, bot: Bot, state: FSMContex
         if not active_lottery:
             await bot.send_message(call.message.chat.id, "❌ Нет активной лотереи")
             return
-        cash = get_cash_in_lottery()
-        cash = float(cash) * 0.6
         markup_exit_to_admin = InlineKeyboardBuilder()
         markup_exit_to_admin.button(text="⭐️ Админ-Панель", callback_data="adminpanelka")
         markup_exit_to_admin.adjust(1)
         keyboard = markup_exit_to_admin.as_markup()
-        status, win_id = finish_and_update_winner()
+        # Закрытие, выбор победителя и начисление 60% банка — одна транзакция
+        status, draw = finish_and_update_winner(0.6)
         if status:
+            win_id, cash = draw['winner_id'], draw['prize']
             try:
                 await bot.send_message(call.message.chat.id, f"<b>🎉 Лотерея завершена</b>\n\n<b>🎁 Выиграл <code>{win_id}</code>\n💰 Сумма: {cash:.2f}</b>", parse_mode='HTML', reply_markup=keyboard)
                 await bot.send_message(win_id, f"<b>🎉 Вы выиграли лотерею!\n\n💰 Вы забираете 60% со всех звезд в лотерее: {cash:.2f}</b>", parse_mode='HTML')
-                increment_stars(win_id, cash)
             except Exception as e:
                 logging.error(f"[LOTTERY] Ошибка при отправке сообщения: {e}")
         else:
@@ -833,7 +1502,7 @@ async def finish_lotery_callback(call: CallbackQuery, bot: Bot, state: FSMContex
     else:
         await bot.send_message(call.message.chat.id, "<b>🚫 У вас нет доступа к панели администратора</b>", parse_mode='HTML')
 
-@router.callback_query(F.data == "start_lotery")
+@callbacks.route("start_lotery")
 async def start_lotery_callback(call: CallbackQuery, bot: Bot, state: FSMContext):
     await bot.delete_message(call.message.chat.id, call.message.message_id)
     if call.message.chat.id in admins_id:
@@ -846,6 +1515,8 @@ async def start_lotery_callback(call: CallbackQuery, bot: Bot, state: FSMContext
 async def handle_ticket_cash(message: Message, bot: Bot, state: FSMContext):
     try:
         ticket_cash = float(message.text)
+        if not math.isfinite(ticket_cash):
+            raise ValueError(message.text)
     except ValueError:
         await message.reply("❌ Введите число!")
         return
@@ -877,7 +1548,7 @@ async def handle_ticket_cash(message: Message, bot: Bot, state: FSMContext):
     
     await state.clear()
 
-@router.callback_query(F.data == "give_boost")
+@callbacks.route("give_boost")
 async def giveboost(call: CallbackQuery, bot: Bot, state: FSMContext):
     if call.from_user.id in admins_id:
         await bot.send_message(call.from_user.id, "Ввдеите ID человека:")
@@ -910,30 +1581,15 @@ async def handle_give(message: Message, bot: Bot, state: FSMContext):
 
 
 
-@router.callback_query(F.data == "adminpanelka")
+@callbacks.route("adminpanelka")
 async def adminpanelka_callback(call: CallbackQuery, bot: Bot):
     await bot.delete_message(call.message.chat.id, call.message.message_id)
     if call.message.chat.id in admins_id:
-        builder_admin = InlineKeyboardBuilder()
-        builder_admin.button(text='🌐 UTM-Ссылки', callback_data='utm')
-        builder_admin.button(text='🎰 Лотерея', callback_data='admin_lotery')
-        builder_admin.button(text='📊 Статистика', callback_data='stats')
-        builder_admin.button(text="🔎 Информация о пользователе", callback_data="users_check")
-        builder_admin.button(text="⭐️ Выдать звезды", callback_data="add_stars")
-        builder_admin.button(text="⭐️ Снять звезды", callback_data="remove_stars")
-        builder_admin.button(text="📨 Рассылка", callback_data="mailing")
-        builder_admin.button(text="🎁 Добавить промокод", callback_data='add_promo_code')
-        builder_admin.button(text="🚫 Удалить промокод", callback_data='remove_promo_code')
-        builder_admin.button(text="📝 Добавить канал", callback_data='add_channel')
-        builder_admin.button(text="🚫 Удалить канал", callback_data='remove_channel')
-        builder_admin.button(text="📝 Добавленные каналы", callback_data='info_added_channels')
-        builder_admin.button(text="🏆 Топ-50 Баланс", callback_data='top_balance')
-        builder_admin.button(text="🌠 Выдать буст", callback_data="give_boost")
-        markup_admin = builder_admin.adjust(1, 1, 1, 1, 2, 1, 2, 2, 1, 1, 1).as_markup()
+        markup_admin = ui.admin_panel_back
 
         try:
-            user_count = get_user_count()
-            total_withdrawn = get_total_withdrawn()
+            user_count = await get_user_count()
+            total_withdrawn = await get_total_withdrawn()
             await bot.send_message(call.message.chat.id, f"<b>🎉 Вы вошли в панель администратора</b>\n\n👥 Пользователей: {user_count}\n💸 Выплачено: {total_withdrawn} ⭐️", parse_mode='HTML', reply_markup=markup_admin)
         except Exception as e:
             logging.error(f"Ошибка при получении статистики для админ-панели: {e}")
@@ -941,7 +1597,7 @@ async def adminpanelka_callback(call: CallbackQuery, bot: Bot):
     else:
         await bot.send_message(call.message.chat.id, "<b>🚫 У вас нет доступа к панели администратора</b>", parse_mode='HTML')
 
-@router.callback_query(F.data == "stats")
+@callbacks.route("stats")
 async def stats_callback(call: CallbackQuery, bot: Bot):
     await bot.delete_message(call.message.chat.id, call.message.message_id)
     day_clicker = get_clicks_by_period('day')
@@ -952,6 +1608,11 @@ async def stats_callback(call: CallbackQuery, bot: Bot):
     week_users = get_users_by_period('week')
     month_users = get_users_by_period('month')
 
+    today = activity_period_start('day')
+    day_gifts, _ = activity.total('gift', today)
+    day_withdrawals, day_withdrawn = activity.total('withdrawal', today)
+    day_bets, day_bet_stars = activity.total('bet', today)
+
     markup_stats = InlineKeyboardBuilder()
     markup_stats.button(text="⭐️ Админ-Панель", callback_data="adminpanelka")
     markup_stats.adjust(1)
@@ -967,7 +1628,19 @@ async def stats_callback(call: CallbackQuery, bot: Bot):
 👤 Пользователи:
 • За день: {day_users}
 • За неделю: {week_users}
-• За всё время: {month_users}</b>
+• За всё время: {month_users}
+• Активных бустов: {count_active_boosters()}
+• Могут кликнуть сейчас: {count_users_off_cooldown(DELAY_TIME)}
+
+📅 Сегодня:
+• Ежедневных подарков: {day_gifts}
+• Заявок на вывод: {day_withdrawals} на {day_withdrawn}⭐️
+• Ставок: {day_bets} на {day_bet_stars}⭐️
+
+📨 Сводные уведомления:
+• Событий: {notifier.events_total}
+• Отправлено сообщений: {notifier.messages_sent}
+• Сэкономлено запросов: {notifier.calls_saved}</b>
 """, parse_mode='HTML', reply_markup=markup_stats)
 
 
@@ -999,102 +1672,64 @@ async def why_command(message: Message, bot: Bot):
 """, parse_mode='HTML')
 
 
-@router.callback_query(F.data.startswith('withdraw:'))
-async def handle_withdraw_callback(call: CallbackQuery, bot: Bot):
+@callbacks.route(factory=WithdrawCallback)
+async def handle_withdraw_callback(call: CallbackQuery, bot: Bot, callback_data: WithdrawCallback):
     user_id = call.from_user.id
     username = call.from_user.username
     if username is None:
         await bot.answer_callback_query(call.id, "⚠️ Для вывода необходимо установить username.", show_alert=True)
         return
-    builder_back = InlineKeyboardBuilder()
-    builder_back.button(text="⬅️ В главное меню", callback_data="back_main")
-    markup_back = builder_back.as_markup()
-
-    stars = call.data.split(':')[1]
-    if stars != "premium1" and stars != "premium2":
-        emoji = call.data.split(':')[2]
-    count_refs = get_weekly_referrals(call.from_user.id)
+    markup_back = ui.back_main
+
+    kind = callback_data.amount
+    emoji = callback_data.emoji
     try:
-        if stars != "premium1" and stars != "premium2":
-            stars = int(stars)
-        elif stars == "premium1":
-            stars = 400
-        elif stars == "premium2":
-            stars = 1100
-        if get_balance_user(call.from_user.id) < stars:
-            await bot.answer_callback_query(call.id, "❌ У вас недостаточно звезд для вывода!", show_alert=True)
+        if kind in WITHDRAWAL_KIND_PRICES:
+            amount = WITHDRAWAL_KIND_PRICES[kind]
+        else:
+            amount, kind = int(kind), 'stars'
+        success, request = request_withdrawal(user_id, amount, kind, username, emoji)
+        if not success:
+            await bot.answer_callback_query(call.id, request, show_alert=True)
             return
-        elif count_refs < 10 if user_in_booster(user_id) else count_refs < 15 :
-            if user_in_booster(user_id):
-                await bot.answer_callback_query(call.id, f"❌ Для вывода надо минимум 10 рефералов за текущую неделю! У тебя {count_refs}", show_alert=True)
-                return
-            else:
-                await bot.answer_callback_query(call.id, f"❌ Для вывода надо минимум 15 рефералов за текущую неделю! У тебя {count_refs}", show_alert=True)
-                return
+        await bot.delete_message(chat_id=call.from_user.id, message_id=call.message.message_id)
+        id_v, stars = request['id'], request['stars']
+        if kind == 'stars':
+            admin_text = f"<b>⚠️ Пользователь {user_id} | @{username} запросил вывод {stars}⭐️</b>"
+            amount_line = f"💫 Количество: <code>{stars}</code>⭐️ [{emoji}]"
+            user_text = f"<b>✅ Вы успешно отправили заявку на вывод {stars}⭐️</b>"
+            context = {'stars': str(stars), 'emoji': emoji}
         else:
-            await bot.delete_message(chat_id=call.from_user.id, message_id=call.message.message_id)
-            deincrement_stars(user_id, stars)
-            add_withdrawal(user_id, stars)
-            if stars == 400:
-                for admin in admins_id:
-                    button_refs = InlineKeyboardBuilder()
-                    button_refs.button(text="👤 Рефераллы", callback_data=f"refferals:{user_id}")
-                    markup_adminser = button_refs.as_markup()
-                    await bot.send_message(admin, f"<b>❗️❗️❗️\n⚠️ Пользователь {user_id} | @{username} запросил вывод Telegram Premium на 1 месяц</b>", parse_mode='HTML', reply_markup=markup_adminser)
-            elif stars == 1100:
-                for admin in admins_id:
-                    button_refs = InlineKeyboardBuilder()
-                    button_refs.button(text="👤 Рефераллы", callback_data=f"refferals:{user_id}")
-                    markup_adminser = button_refs.as_markup()                    
-                    await bot.send_message(admin, f"<b>❗️❗️❗️\n⚠️ Пользователь {user_id} | @{username} запросил вывод Telegram Premium на 3 месяца</b>", parse_mode='HTML', reply_markup=markup_adminser)
-            else:
-                for admin in admins_id:
-                    button_refs = InlineKeyboardBuilder()
-                    button_refs.button(text="👤 Рефераллы", callback_data=f"refferals:{user_id}")
-                    markup_adminser = button_refs.as_markup()
-                    await bot.send_message(admin, f"<b>⚠️ Пользователь {user_id} | @{username} запросил вывод {stars}⭐️</b>", parse_mode='HTML', reply_markup=markup_adminser)
-            if stars != 400 and stars != 1100:
-                success, id_v = add_withdrawale(username, user_id, stars)
-                status = get_status_withdrawal(user_id)
-                pizda = await bot.send_message(channel_viplat_id, f"<b>✅ Запрос на вывод №{id_v}</b>\n\n👤 Пользователь: @{username} | ID {user_id}\n💫 Количество: <code>{stars}</code>⭐️ [{emoji}]\n\n🔄 Статус: <b>{status}</b>", disable_web_page_preview=True, parse_mode='HTML')
-                builder_channel = InlineKeyboardBuilder()
-                builder_channel.button(text="✅ Отправить", callback_data=f"paid:{id_v}:{pizda.message_id}:{user_id}:{username}:{stars}:{emoji}")
-                builder_channel.button(text="❌ Отклонить", callback_data=f"denied:{id_v}:{pizda.message_id}:{user_id}:{username}:{stars}:{emoji}")
-                builder_channel.button(text="👤 Профиль", url=f"tg://user?id={user_id}")
-                markup_channel = builder_channel.adjust(2, 1).as_markup()
-                await bot.edit_message_text(chat_id=pizda.chat.id, message_id=pizda.message_id, text=f"<b>✅ Запрос на вывод №{id_v}</b>\n\n👤 Пользователь: @{username} | ID {user_id}\n💫 Количество: <code>{stars}</code>⭐️ [{emoji}]\n\n🔄 Статус: <b>{status}</b>", parse_mode='HTML', reply_markup=markup_channel, disable_web_page_preview=True)
-                await bot.send_message(user_id, f"<b>✅ Вы успешно отправили заявку на вывод {stars}⭐️</b>", parse_mode='HTML', reply_markup=markup_back)
-            elif stars == 400:
-                level_premium = 1
-                success, id_v = add_withdrawale(username, user_id, stars)
-                status = get_status_withdrawal(user_id)
-                pizda = await bot.send_message(channel_viplat_id, f"<b>✅ Запрос на вывод №{id_v}</b>\n\n👤 Пользователь: @{username} | ID {user_id}\n🎁 Telegram Premium: 1 месяц\n\n🔄 Статус: <b>{status}</b>", disable_web_page_preview=True, parse_mode='HTML')
-                builder_channel = InlineKeyboardBuilder()
-                builder_channel.button(text="✅ Отправить", callback_data=f"premium_paid:{id_v}:{pizda.message_id}:{user_id}:{username}:{level_premium}")
-                builder_channel.button(text="❌ Отклонить", callback_data=f"premium_denied:{id_v}:{pizda.message_id}:{user_id}:{username}:{level_premium}")
-                builder_channel.button(text="👤 Профиль", url=f"tg://user?id={user_id}")
-                markup_channel = builder_channel.adjust(2, 1).as_markup()
-                await bot.edit_message_text(chat_id=pizda.chat.id, message_id=pizda.message_id, text=f"<b>✅ Запрос на вывод №{id_v}</b>\n\n👤 Пользователь: @{username} | ID {user_id}\n🎁 Telegram Premium: 1 месяц\n\n🔄 Статус: <b>{status}</b>", disable_web_page_preview=True, parse_mode='HTML', reply_markup=markup_channel)
-                await bot.send_message(user_id, f"<b>✅ Вы успешно отправили заявку на вывод 🎁 Telegram Premium: 1 месяц</b>", parse_mode='HTML', reply_markup=markup_back)
-            elif stars == 1100:
-                level_premium = 3
-                success, id_v = add_withdrawale(username, user_id, stars)
-                status = get_status_withdrawal(user_id)
-                pizda = await bot.send_message(channel_viplat_id, f"<b>✅ Запрос на вывод №{id_v}</b>\n\n👤 Пользователь: @{username} | ID {user_id}\n🎁 Telegram Premium: 3 месяца\n\n🔄 Статус: <b>{status}</b>", disable_web_page_preview=True, parse_mode='HTML')
-                builder_channel = InlineKeyboardBuilder()
-                builder_channel.button(text="✅ Отправить", callback_data=f"premium_paid:{id_v}:{pizda.message_id}:{user_id}:{username}:{level_premium}")
-                builder_channel.button(text="❌ Отклонить", callback_data=f"premium_denied:{id_v}:{pizda.message_id}:{user_id}:{username}:{level_premium}")
-                builder_channel.button(text="👤 Профиль", url=f"tg://user?id={user_id}")
-                markup_channel = builder_channel.adjust(2, 1).as_markup()
-                await bot.edit_message_text(chat_id=pizda.chat.id, message_id=pizda.message_id, text=f"<b>✅ Запрос на вывод №{id_v}</b>\n\n👤 Пользователь: @{username} | ID {user_id}\n🎁 Telegram Premium: 3 месяца\n\n🔄 Статус: <b>{status}</b>", disable_web_page_preview=True, parse_mode='HTML', reply_markup=markup_channel)
-                await bot.send_message(user_id, f"<b>✅ Вы успешно отправили заявку на вывод 🎁 Telegram Premium: 3 месяца</b>", parse_mode='HTML', reply_markup=markup_back)
+            level_premium = PREMIUM_LEVELS[kind]
+            period = '1 месяц' if level_premium == 1 else '3 месяца'
+            admin_text = f"<b>❗️❗️❗️\n⚠️ Пользователь {user_id} | @{username} запросил вывод Telegram Premium на {period}</b>"
+            amount_line = f"🎁 Telegram Premium: {period}"
+            user_text = f"<b>✅ Вы успешно отправили заявку на вывод 🎁 Telegram Premium: {period}</b>"
+            context = {'level': level_premium}
+
+        for admin in admins_id:
+            button_refs = InlineKeyboardBuilder()
+            button_refs.button(text="👤 Рефераллы", callback_data=f"refferals:{user_id}")
+            await bot.send_message(admin, admin_text, parse_mode='HTML', reply_markup=button_refs.as_markup())
+
+        text = f"<b>✅ Запрос на вывод №{id_v}</b>\n\n👤 Пользователь: @{username} | ID {user_id}\n{amount_line}\n\n🔄 Статус: <b>{request['status']}</b>"
+        pizda = await bot.send_message(channel_viplat_id, text, disable_web_page_preview=True, parse_mode='HTML')
+        set_withdrawal_message(id_v, pizda.message_id)
+        token = create_callback_context({'id_v': id_v, 'message_id': pizda.message_id, 'user_id': user_id, 'username': username, **context})
+        builder_channel = InlineKeyboardBuilder()
+        builder_channel.button(text="✅ Отправить", callback_data=PayoutCallback(action='paid', token=token).pack())
+        builder_channel.button(text="❌ Отклонить", callback_data=PayoutCallback(action='denied', token=token).pack())
+        builder_channel.button(text="👤 Профиль", url=f"tg://user?id={user_id}")
+        markup_channel = builder_channel.adjust(2, 1).as_markup()
+        await bot.edit_message_text(chat_id=pizda.chat.id, message_id=pizda.message_id, text=text, parse_mode='HTML', reply_markup=markup_channel, disable_web_page_preview=True)
+        await bot.send_message(user_id, user_text, parse_mode='HTML', reply_markup=markup_back)
     except ValueError:
         await bot.answer_callback_query(call.id, "❌ Неверный формат суммы вывода.", show_alert=True)
     except Exception as e:
         logging.error(f"Ошибка при обработке вывода: {e}")
         await bot.answer_callback_query(call.id, "❌ Произошла ошибка при обработке вашего запроса на вывод.", show_alert=True)
 
-@router.callback_query(F.data.startswith('refferals'))
+@callbacks.route('refferals')
 async def handle_refferals_callback(call: CallbackQuery, bot: Bot):
     if call.from_user.id not in admins_id:
         return
@@ -1106,7 +1741,7 @@ async def handle_refferals_callback(call: CallbackQuery, bot: Bot):
         await call.answer("Неверный формат callback_data", show_alert=True)
         return
 
-    refferals = get_user_refferals_list_and_username(user_id)
+    refferals = await get_user_refferals_list_and_username(user_id)
     
     base_data = [
         ("🆔 ID Пользователя", f"<code>{user_id}</code>"),
@@ -1154,37 +1789,23 @@ async def handle_refferals_callback(call: CallbackQuery, bot: Bot):
         print(f"Error: {e}")
         await call.answer(error_msg, show_alert=True)
 
-@router.callback_query(F.data.startswith('premium_paid'))
-async def handle_premium_paid_callback(call: CallbackQuery, bot: Bot):
+@callbacks.route(factory=PremiumPaidCallback)
+async def handle_premium_paid_callback(call: CallbackQuery, bot: Bot, callback_data: PremiumPaidCallback):
     if call.from_user.id in admins_id:
-        id_v = int(call.data.split(":")[1])
-        mesag_id = int(call.data.split(":")[2])
-        us_id = int(call.data.split(":")[3])
-        us_name = call.data.split(":")[4]
-        level_premium = int(call.data.split(":")[5])
-        if level_premium == 1:
-            await bot.edit_message_text(chat_id=channel_viplat_id, message_id=mesag_id, text=f"<b>✅ Запрос на вывод №{id_v}</b>\n\n👤 Пользователь: @{us_name} | ID: {us_id}\n🎁 Telegram Premium: 1 месяц\n\n🔄 Статус: <b>Подарок отправлен 🎁</b>\n\n<b><a href='{channel_osn}'>Основной канал</a></b> | <b><a href='{chater}'>Чат</a></b> | <b><a href='{'https://t.me/' + (await bot.me()).username}'>Бот</a></b>", parse_mode='HTML', disable_web_page_preview=True)
-        elif level_premium == 2:
-            await bot.edit_message_text(chat_id=channel_viplat_id, message_id=mesag_id, text=f"<b>✅ Запрос на вывод №{id_v}</b>\n\n👤 Пользователь: @{us_name} | ID: {us_id}\n🎁 Telegram Premium: 3 месяца\n\n🔄 Статус: <b>Подарок отправлен 🎁</b>\n\n<b><a href='{channel_osn}'>Основной канал</a></b> | <b><a href='{chater}'>Чат</a></b> | <b><a href='{'https://t.me/' + (await bot.me()).username}'>Бот</a></b>", parse_mode='HTML', disable_web_page_preview=True)
+        if not await resolve_payout(bot, 'paid', callback_data.model_dump()):
+            await bot.answer_callback_query(call.id, "⚠️ Заявка уже обработана.")
     else:
         await bot.answer_callback_query(call.id, "⚠️ Вы не администратор.")
 
-@router.callback_query(F.data.startswith('premium_denied'))
-async def handle_premium_denied_callback(call: CallbackQuery, bot: Bot):
+@callbacks.route(factory=PremiumDeniedCallback)
+async def handle_premium_denied_callback(call: CallbackQuery, bot: Bot, callback_data: PremiumDeniedCallback):
     if call.from_user.id in admins_id:
-        id_v = int(call.data.split(":")[1])
-        mesag_id = int(call.data.split(":")[2])
-        us_id = int(call.data.split(":")[3])
-        us_name = call.data.split(":")[4]
-        level_premium = int(call.data.split(":")[5])
-        if level_premium == 1:
-            await bot.edit_message_text(chat_id=channel_viplat_id, message_id=mesag_id, text=f"<b>✅ Запрос на вывод №{id_v}</b>\n\n👤 Пользователь: @{us_name} | ID: {us_id}\n🎁 Telegram Premium: 1 месяц\n\n🔄 Статус: <b>Отказано 🚫</b>\n\n<b><a href='{channel_osn}'>Основной канал</a></b> | <b><a href='{chater}'>Чат</a></b> | <b><a href='{'https://t.me/' + (await bot.me()).username}'>Бот</a></b>", parse_mode='HTML', disable_web_page_preview=True)
-        elif level_premium == 2:
-             await bot.edit_message_text(chat_id=channel_viplat_id, message_id=mesag_id, text=f"<b>✅ Запрос на вывод №{id_v}</b>\n\n👤 Пользователь: @{us_name} | ID: {us_id}\n🎁 Telegram Premium: 3 месяца\n\n🔄 Статус: <b>Отказано 🚫</b>\n\n<b><a href='{channel_osn}'>Основной канал</a></b> | <b><a href='{chater}'>Чат</a></b> | <b><a href='{'https://t.me/' + (await bot.me()).username}'>Бот</a></b>", parse_mode='HTML', disable_web_page_preview=True)
+        if not await resolve_payout(bot, 'denied', callback_data.model_dump()):
+            await bot.answer_callback_query(call.id, "⚠️ Заявка уже обработана.")
     else:
         await bot.answer_callback_query(call.id, "⚠️ Вы не администратор.")
 
-@router.callback_query(F.data.startswith('play_game_with_bet'))
+@callbacks.route('play_game_with_bet')
 async def handle_game_callback(call: CallbackQuery, bot: Bot):
     user_id = call.from_user.id
     try:
@@ -1193,6 +1814,7 @@ async def handle_game_callback(call: CallbackQuery, bot: Bot):
 
         if balance >= bet:
             deincrement_stars(user_id, bet)
+            activity.track('bet', Money.of(bet).milli)
 
             if random.random() < 0.30:
                 coefficients = [0, 0.5, 1, 1.5, 2, 3, 5, 10]
@@ -1202,65 +1824,39 @@ async def handle_game_callback(call: CallbackQuery, bot: Bot):
 
                 if coefficient > 0:
                     await bot.answer_callback_query(call.id, f"🎉 ОГРОМНАЯ ПОБЕДА! Вы выиграли: {winnings:.2f}", show_alert=True)
-                    chat = await bot.get_chat(user_id)
-                    first_name = chat.first_name
+                    first_name = html.escape(profiles.first_name(user_id))
                     bot_url = "https://t.me/" + (await bot.me()).username
-                    await bot.send_message(
+                    await notifier.push(
+                        bot,
                         id_channel_game,
-                        f"<b>🎉 Поздравляем! 🏆</b>\n\nПользователь {first_name}(ID: <code>{user_id}</code>)\n"
-                        f"<i>выиграл</i> <b>{winnings:.2f}</b>⭐️ на ставке <b>{bet:.2f}</b>⭐️ 🎲\n\n"
-                        f"Коэффициент: <i>{coefficient}</i>✨\n\n"
-                        f"<b>🎉 Потрясающий выигрыш! 🏆✨ 🎉</b>\n\n🎯 Не упусти свой шанс! <a href='{bot_url}'>Испытать удачу!🍀</a>",
-                        disable_web_page_preview=True,
-                        parse_mode='HTML'
+                        'win',
+                        text=(
+                            f"<b>🎉 Поздравляем! 🏆</b>\n\nПользователь {first_name}(ID: <code>{user_id}</code>)\n"
+                            f"<i>выиграл</i> <b>{winnings:.2f}</b>⭐️ на ставке <b>{bet:.2f}</b>⭐️ 🎲\n\n"
+                            f"Коэффициент: <i>{coefficient}</i>✨\n\n"
+                            f"<b>🎉 Потрясающий выигрыш! 🏆✨ 🎉</b>\n\n🎯 Не упусти свой шанс! <a href='{bot_url}'>Испытать удачу!🍀</a>"
+                        ),
+                        line=f"🏆 {first_name}: <b>{winnings:.2f}</b>⭐️ (x{coefficient})",
+                        stars=winnings,
+                        footer=f"🎯 Не упусти свой шанс! <a href='{bot_url}'>Испытать удачу!🍀</a>"
                     )
                     increment_stars(user_id, winnings)
                     new_balance = get_balance_user(user_id)
 
-                    builder_game = InlineKeyboardBuilder()
-                    builder_game.button(text="Ставка 0.5⭐️", callback_data="play_game_with_bet:0.5")
-                    builder_game.button(text="Ставка 1⭐️", callback_data="play_game_with_bet:1")
-                    builder_game.button(text="Ставка 2⭐️", callback_data="play_game_with_bet:2")
-                    builder_game.button(text="Ставка 3⭐️", callback_data="play_game_with_bet:3")
-                    builder_game.button(text="Ставка 4⭐️", callback_data="play_game_with_bet:4")
-                    builder_game.button(text="Ставка 5⭐️", callback_data="play_game_with_bet:5")
-                    builder_game.button(text="Назад в меню мини-игр", callback_data="mini_games")
-                    markup_game = builder_game.adjust(3, 3, 1).as_markup()
-
-                    input_photo_game = FSInputFile("photos/mini_game.jpg")
-                    await bot.delete_message(chat_id=user_id, message_id=call.message.message_id)
-                    await bot.send_photo(user_id, photo=input_photo_game, caption=f"<b>💰 У тебя на счету:</b> {new_balance}⭐️\n\n🔔 Ты выбрал игру 'Испытать удачу'. Выбери ставку и попытайся победить! 🍀\n\n📊 Онлайн статистика выигрышей: {channel_link}", parse_mode='HTML', reply_markup=markup_game)
+                    markup_game = ui.bet_menu
+
+                    await show_screen(bot, call, "photos/mini_game.jpg", ui.bet_caption(new_balance), markup_game)
                 else:
                     await bot.answer_callback_query(call.id, f"😔 Удача была близко, но коэффициент 0.\nВы ничего не выиграли.", show_alert=True)
                     new_balance = get_balance_user(user_id)
-                    builder_game = InlineKeyboardBuilder()
-                    builder_game.button(text="Ставка 0.5⭐️", callback_data="play_game_with_bet:0.5")
-                    builder_game.button(text="Ставка 1⭐️", callback_data="play_game_with_bet:1")
-                    builder_game.button(text="Ставка 2⭐️", callback_data="play_game_with_bet:2")
-                    builder_game.button(text="Ставка 3⭐️", callback_data="play_game_with_bet:3")
-                    builder_game.button(text="Ставка 4⭐️", callback_data="play_game_with_bet:4")
-                    builder_game.button(text="Ставка 5⭐️", callback_data="play_game_with_bet:5")
-                    builder_game.button(text="Назад в меню мини-игр", callback_data="mini_games")
-                    markup_game = builder_game.adjust(3, 3, 1).as_markup()
-                    input_photo_game_lose = FSInputFile("photos/mini_game.jpg")
-                    await bot.delete_message(chat_id=user_id, message_id=call.message.message_id)
-                    await bot.send_photo(user_id, photo=input_photo_game_lose, caption=f"<b>💰 У тебя на счету:</b> {new_balance}⭐️\n\n🔔 Ты выбрал игру 'Испытать удачу'. Выбери ставку и попытайся победить! 🍀\n\n📊 Онлайн статистика выигрышей: {channel_link}", parse_mode='HTML', reply_markup=markup_game)
+                    markup_game = ui.bet_menu
+                    await show_screen(bot, call, "photos/mini_game.jpg", ui.bet_caption(new_balance), markup_game)
 
             else:
                 await bot.answer_callback_query(call.id, f"😔 К сожалению, сегодня удача не на вашей стороне.", show_alert=True)
                 new_balance = get_balance_user(user_id)
-                builder_game = InlineKeyboardBuilder()
-                builder_game.button(text="Ставка 0.5⭐️", callback_data="play_game_with_bet:0.5")
-                builder_game.button(text="Ставка 1⭐️", callback_data="play_game_with_bet:1")
-                builder_game.button(text="Ставка 2⭐️", callback_data="play_game_with_bet:2")
-                builder_game.button(text="Ставка 3⭐️", callback_data="play_game_with_bet:3")
-                builder_game.button(text="Ставка 4⭐️", callback_data="play_game_with_bet:4")
-                builder_game.button(text="Ставка 5⭐️", callback_data="play_game_with_bet:5")
-                builder_game.button(text="Назад в меню мини-игр", callback_data="mini_games")
-                markup_game = builder_game.adjust(3, 3, 1).as_markup()
-                input_photo_game_no_luck = FSInputFile("photos/mini_game.jpg")
-                await bot.delete_message(chat_id=user_id, message_id=call.message.message_id)
-                await bot.send_photo(user_id, photo=input_photo_game_no_luck, caption=f"<b>💰 У тебя на счету:</b> {new_balance}⭐️\n\n🔔 Ты выбрал игру 'Испытать удачу'. Выбери ставку и попытайся победить! 🍀\n\n📊 Онлайн статистика выигрышей: {channel_link}", parse_mode='HTML', reply_markup=markup_game)
+                markup_game = ui.bet_menu
+                await show_screen(bot, call, "photos/mini_game.jpg", ui.bet_caption(new_balance), markup_game)
         else:
             await bot.answer_callback_query(call.id, "😞 У тебя недостаточно звезд для этой ставки.", show_alert=True)
     except ValueError:
@@ -1270,21 +1866,18 @@ async def handle_game_callback(call: CallbackQuery, bot: Bot):
         await bot.answer_callback_query(call.id, "❌ Произошла ошибка в игре.", show_alert=True)
 
 
-@router.callback_query(F.data.startswith('task_check'))
-async def handle_task_callback(call: CallbackQuery, bot: Bot):
+@callbacks.route(factory=TaskCheckCallback)
+async def handle_task_callback(call: CallbackQuery, bot: Bot, callback_data: TaskCheckCallback):
     try:
-        _, reward, task_id_str, chat_id = call.data.split(":")
-        task_id = int(task_id_str)
+        task_id, chat_id = callback_data.task_id, callback_data.chat_id
         user_id = call.from_user.id
-        reward = float(reward)
-        completed_task = get_completed_tasks_for_user(user_id)
-        if task_id in completed_task:
+        if task_catalog.is_completed(user_id, task_id):
             await bot.answer_callback_query(call.id, "❌ Задание уже выполнено.", show_alert=True)
             return
 
         try:
-            all_stars = str(sum_all_stars())
-            withdrawed = str(sum_all_withdrawn())
+            all_stars = sum_all_stars()
+            withdrawed = sum_all_withdrawn()
         except Exception as e:
             logging.error(f"Ошибка при получении статистики: {e}")
             all_stars = "Ошибка"
@@ -1297,49 +1890,24 @@ async def handle_task_callback(call: CallbackQuery, bot: Bot):
                     return
             except Exception as e:
                 print(f"error in check subs in tasks: {e}")
-        await bot.answer_callback_query(call.id, f"✅ Задание выполнено. Начислено: {reward}⭐️")
-        increment_current_completed(task_id)
-        complete_task_for_user(user_id, task_id)
-        increment_stars(user_id, reward)
+        # Лимит, отметка, счётчик и награда — одна транзакция; награда берётся из задания, а не из callback
+        success, task = task_catalog.complete(user_id, task_id)
+        if not success:
+            await bot.answer_callback_query(call.id, task, show_alert=True)
+            return
+        await bot.answer_callback_query(call.id, f"✅ Задание выполнено. Начислено: {task['reward']}⭐️")
         await bot.delete_message(chat_id=user_id, message_id=call.message.message_id)
 
-        builder_start = InlineKeyboardBuilder()
-        buttons = [
-            ('✨ Фармить звёзды', 'click_star'),
-            ('🎮 Мини-игры', 'mini_games'),
-            ('🔗 Получить ссылку', 'earn_stars'),
-            ('🔄 Обменять звёзды', 'withdraw_stars_menu'),
-            ('👤 Профиль', 'my_balance'),
-            ('📝 Задания', 'tasks'),
-            ('📘 Гайды | FAQ', 'faq'),
-            ('🚀 Буст', 'donate'),
-            ('🏆 Топ', 'leaders')
-        ]
-        for text, callback_data in buttons:
-            builder_start.button(text=text, callback_data=callback_data)
-        if beta_url and beta_name:
-            builder_start.button(text=beta_name, url=beta_url)
-        builder_start.adjust(1, 1, 2, 2, 2, 2, 1)
-        markup_start = builder_start.as_markup()
+        markup_start = ui.main_menu
 
-        photo = FSInputFile("photos/start.jpg")
-        await bot.send_photo(
+        sent = await bot.send_photo(
             chat_id=user_id,
-            photo=photo,
-            caption=(
-                f"<b>✨ Добро пожаловать в главное меню ✨</b>\n\n"
-                f"<b>🌟 Всего заработано: <code>{all_stars[:all_stars.find('.') + 2] if '.' in all_stars else all_stars}</code>⭐️</b>\n"
-                f"<b>♻️ Всего обменяли: <code>{withdrawed[:withdrawed.find('.') + 2] if '.' in withdrawed else withdrawed}</code>⭐️</b>\n\n"
-                "<b>Как заработать звёзды?</b>\n"
-                "<blockquote>🔸 <i>Кликай, собирай ежедневные награды и вводи промокоды</i>\n"
-                "— всё это доступно в разделе «Профиль».\n"
-                "🔸 <i>Выполняй задания и приглашай друзей</i>\n"
-                "🔸 <i>Испытай удачу в увлекательных мини-играх</i>\n"
-                "— всё это доступно в главном меню.</blockquote>"
-            ),
+            photo=_cached_photo("photos/start.jpg"),
+            caption=ui.main_caption(all_stars, withdrawed),
             parse_mode='HTML',
             reply_markup=markup_start
         )
+        _remember_photo("photos/start.jpg", sent)
         # await bot.send_message(user_id, f"<b>✨ Добро пожаловать на ферму звёзд! ✨</b>\n\n🏦 <b>Всего заработано:</b> {all_stars[:all_stars.find('.') + 2] if '.' in all_stars else all_stars}⭐️\n💸 <b>Всего выведено:</b> {withdrawed[:withdrawed.find('.') + 2] if '.' in withdrawed else withdrawed}⭐️\n\nТы присоединился к проекту, где звезды Telegram можно зарабатывать абсолютно бесплатно! ⭐️\n<b>Чем больше друзей — тем больше звёзд!</b>\n\n<b>🚀 Как приглашать друзей?</b>\n• Поделись ссылкой с друзьями в ЛС 👥\n• Размести её в своём Telegram-канале 📢\n• Напиши в группах и комментариях 🗨️\n• Распространяй в соцсетях (TikTok, Instagram, WhatsApp и др.) 🌍", parse_mode='HTML', reply_markup=markup_start)
     except ValueError:
         await bot.answer_callback_query(call.id, "Ошибка обработки данных задания.")
@@ -1347,7 +1915,7 @@ async def handle_task_callback(call: CallbackQuery, bot: Bot):
         logging.error(f"Ошибка в handle_task: {e}")
         await bot.answer_callback_query(call.id, "Произошла ошибка при обработке задания.")
 
-@router.callback_query(F.data == 'click_star')
+@callbacks.route('click_star')
 async def click_star_callback(call: CallbackQuery, bot: Bot, state: FSMContext):
     user_id = call.from_user.id
     current_time = time.time()
@@ -1393,7 +1961,7 @@ async def click_star_callback(call: CallbackQuery, bot: Bot, state: FSMContext):
             random.shuffle(options)
             markup_captcha = InlineKeyboardBuilder()
             for option in options:
-                markup_captcha.button(text=option, callback_data=f'veg_{option}')
+                markup_captcha.button(text=option, callback_data=f'veg:{option}')
             markup_captcha.adjust(3)
             await bot.send_message(user_id, f"<b>Ответ на капчу: {correct_vegetable}</b>", reply_markup=markup_captcha.as_markup(), parse_mode='HTML')
             await state.update_data(captcha_correct_answer=correct_vegetable)
@@ -1404,10 +1972,10 @@ async def click_star_callback(call: CallbackQuery, bot: Bot, state: FSMContext):
         logging.error(f"Ошибка при обработке клика: {e}, type: {type(e)}")
         await bot.answer_callback_query(call.id, "⚠️ Произошла ошибка при начислении звезд за клик.", show_alert=True)
 
-@router.callback_query(F.data.startswith('veg_'))
+@callbacks.route('veg', legacy=('veg_',))
 async def handle_captcha_click(call: CallbackQuery, bot: Bot, state: FSMContext):
     user_id = call.from_user.id
-    user_answer = call.data.split('_')[1]
+    user_answer = call.data[len('veg:'):]
     
     data = await state.get_data()
     correct_answer = data.get('captcha_correct_answer')
@@ -1434,18 +2002,18 @@ async def handle_captcha_click(call: CallbackQuery, bot: Bot, state: FSMContext)
     else:
         await bot.answer_callback_query(call.id, "❌ Неправильно!", show_alert=True)
 
-@router.callback_query(F.data == "users_check")
+@callbacks.route("users_check")
 async def users_check_callback(call: CallbackQuery, bot: Bot, state: FSMContext):
     await bot.send_message(call.from_user.id, "Введите ID пользователя:")
     await state.set_state(AdminState.USERS_CHECK)
 
-@router.callback_query(F.data == "add_stars")
+@callbacks.route("add_stars")
 async def admin_add_stars_callback(call: CallbackQuery, bot: Bot, state: FSMContext):
     await bot.send_message(call.from_user.id, "Для выдачи звезд необходимо написать ID:Количество звезд.\nПример: 123:5")
     await state.set_state(AdminState.ADD_STARS)
 
 
-@router.callback_query(F.data == "remove_stars")
+@callbacks.route("remove_stars")
 async def admin_remove_stars_callback(call: CallbackQuery, bot: Bot, state: FSMContext):
     await bot.send_message(call.from_user.id, "Для снятия звезд необходимо написать ID:Количество звезд.\nПример: 123:5")
     await state.set_state(AdminState.REMOVE_STARS)
@@ -1461,7 +2029,7 @@ async def admin_remove_stars_process(message: types.Message, bot: Bot, state: FS
         logging.error(f"Ошибка при снятии звезд: {e}")
         await bot.send_message(message.from_user.id, "Ошибка при обработке данных. Убедитесь, что введены ID и количество звезд в формате: 123:5")
 
-@router.callback_query(F.data == "subgram-task")
+@callbacks.route("subgram-task")
 async def subgram_task_callback(call: CallbackQuery, bot: Bot):
     try:
         user = call.from_user
@@ -1483,7 +2051,7 @@ async def subgram_task_callback(call: CallbackQuery, bot: Bot):
         logging.error(f"Ошибка при выполнении задания: {e}")
         await bot.answer_callback_query(call.id, "⚠️ Произошла ошибка. Пожалуйста, повторите попытку.", show_alert=True)
 
-@router.callback_query(F.data.startswith("subgram-op"))
+@callbacks.route('subgram-op')
 async def subgram_op_callback(call: CallbackQuery, bot: Bot):
     try:
         user = call.from_user
@@ -1491,10 +2059,7 @@ async def subgram_op_callback(call: CallbackQuery, bot: Bot):
         ref_id = None
 
         if len(call.data.split(":")) > 1:
-            try:
-                ref_id = int(call.data.split(":")[1])
-            except ValueError:
-                logging.warning(f"Invalid ref_id format: {call.data}")
+            ref_id = parse_start_ref(call.data.split(":")[1])
 
         response = await request_op(
             user_id=user_id,
@@ -1515,15 +2080,11 @@ async def subgram_op_callback(call: CallbackQuery, bot: Bot):
 
         if not user_exists(user_id):
             try:
-                urls_utm = get_urls_utm()
-                for url in urls_utm:
-                    url_title = url.split('=')[1]
-                    if ref_id == url_title:
-                        users_add_utm_op(url)
-                        ref_id = None
-                        break
-                add_user(user_id, user.username, ref_id)
-                await handle_referral_bonus(ref_id, user_id, bot)
+                if isinstance(ref_id, str):
+                    track_utm(ref_id, 'subscribed')
+                    track_utm(ref_id, 'registered')
+                    ref_id = None
+                await register_user(user_id, user.username, ref_id, bot)
             except Exception as e:
                 logging.error(f"User registration error: {e}")
 
@@ -1533,152 +2094,85 @@ async def subgram_op_callback(call: CallbackQuery, bot: Bot):
         logging.error(f"Subgram op error: {e}", exc_info=True)
         await bot.answer_callback_query(call.id, "⚠️ Произошла ошибка при проверке подписки", show_alert=True)
 
-async def handle_referral_bonus(ref_id: Optional[int], new_user_id: int, bot: Bot):
-    if not ref_id or not user_exists(ref_id):
-        return
-
-    try:
-        increment_referrals(ref_id)
-        c_refs = get_user_referrals_count(ref_id)
-        if c_refs < 50:
-            nac = 0.7 * 2 if user_in_booster(ref_id) else 0.7
-            increment_stars(ref_id, nac)
-        elif 50 <= c_refs < 250:
-            nac = 1 * 2 if user_in_booster(ref_id) else 1
-            increment_stars(ref_id, nac)
-        else:
-            nac = 1.5 * 2 if user_in_booster(ref_id) else 1.5
-            increment_stars(ref_id, nac)
-        new_ref_link = f"https://t.me/{(await bot.me()).username}?start={ref_id}"
-        await bot.send_message(
-                ref_id,
-                f"🎉 Пользователь <code>{new_user_id}</code> запустил бота по вашей ссылке!\n"
-                f"Вы получили +{nac}⭐️ за реферала.\n"
-                f"Поделитесь ссылкой ещё раз:\n<code>{new_ref_link}</code>",
-                parse_mode='HTML'
-        )
-    except Exception as e:
-        logging.error(f"Referral bonus error: {e}")
+async def register_user(user_id: int, username: Optional[str], ref_id: Optional[int], bot: Bot) -> bool:
+    """Регистрация и награда пригласившему — одна транзакция в register_user_with_referral;
+    уведомление пригласившему уходит уже после коммита."""
+    registered, reward = register_user_with_referral(user_id, username, ref_id)
+    if reward is not None:
+        try:
+            await notify_referral(bot, ref_id, user_id, float(reward))
+        except Exception as e:
+            logging.error(f"Referral notify error: {e}")
+    return registered
 
 async def send_main_menu(user_id: int, bot: Bot):
     try:
         total_stars = sum_all_stars()
         total_withdrawn = sum_all_withdrawn()
-        stars_str = f"{total_stars:.2f}" if isinstance(total_stars, float) else str(total_stars)
-        withdrawn_str = f"{total_withdrawn:.2f}" if isinstance(total_withdrawn, float) else str(total_withdrawn)
-
-        builder = InlineKeyboardBuilder()
-        builder.add(
-            *[
-                InlineKeyboardButton(text='✨ Фармить звёзды', callback_data='click_star'),
-                InlineKeyboardButton(text='🎮 Мини-игры', callback_data='mini_games'),
-                InlineKeyboardButton(text='🔗 Получить ссылку', callback_data='earn_stars'),
-                InlineKeyboardButton(text='🔄 Обменять звёзды', callback_data='withdraw_stars_menu'),
-                InlineKeyboardButton(text='👤 Профиль', callback_data='my_balance'),
-                InlineKeyboardButton(text='📝 Задания', callback_data='tasks'),
-                InlineKeyboardButton(text='📘 Гайды | FAQ', callback_data='faq'),
-                InlineKeyboardButton(text='🚀 Буст', callback_data='donate'),
-                InlineKeyboardButton(text='🏆 Топ', callback_data='leaders')
-            ]
-        )
-        
-        if beta_url and beta_name:
-            builder.add(InlineKeyboardButton(text=beta_name, url=beta_url))
-            
-        builder.adjust(1, 1, 2, 2, 2, 1)
-
-        photo = FSInputFile("photos/start.jpg")
-        await bot.send_photo(
+        sent = await bot.send_photo(
             chat_id=user_id,
-            photo=photo,
-            caption=(
-                "<b>✨ Добро пожаловать в главное меню ✨</b>\n\n"
-                f"<b>🌟 Всего заработано: <code>{stars_str}</code>⭐️</b>\n"
-                f"<b>♻️ Всего обменяли: <code>{withdrawn_str}</code>⭐️</b>\n\n"
-                "<b>Как заработать звёзды?</b>\n"
-                "<blockquote>🔸 Кликай, собирай ежедневные награды и вводи промокоды\n"
-                "— всё это доступно в разделе «Профиль».\n"
-                "🔸 Выполняй задания и приглашай друзей\n"
-                "🔸 Испытай удачу в мини-играх\n"
-                "— всё это доступно в главном меню.</blockquote>"
-            ),
+            photo=_cached_photo("photos/start.jpg"),
+            caption=ui.main_caption(total_stars, total_withdrawn),
             parse_mode='HTML',
-            reply_markup=builder.as_markup()
+            reply_markup=ui.main_menu
         )
+        _remember_photo("photos/start.jpg", sent)
 
     except Exception as e:
         logging.error(f"Main menu send error: {e}")
 
-@router.callback_query(F.data == "mailing")
+@callbacks.route("mailing")
 async def admin_mailing_callback(call: CallbackQuery, bot: Bot, state: FSMContext):
     await bot.send_message(call.from_user.id, "Введите текст рассылки:")
     await state.set_state(AdminState.MAILING)
 
 
-@router.callback_query(F.data == "add_promo_code")
+@callbacks.route("add_promo_code")
 async def admin_add_promo_code_callback(call: CallbackQuery, bot: Bot, state: FSMContext):
     await bot.send_message(call.from_user.id, "Введите промокод:награда:макс. пользований")
     await state.set_state(AdminState.ADD_PROMO_CODE)
 
 
-@router.callback_query(F.data == "remove_promo_code")
+@callbacks.route("remove_promo_code")
 async def admin_remove_promo_code_callback(call: CallbackQuery, bot: Bot, state: FSMContext):
     await bot.send_message(call.from_user.id, "Введите промокод:")
     await state.set_state(AdminState.REMOVE_PROMO_CODE)
 
 
-@router.callback_query(F.data == "add_task")
+@callbacks.route("add_task")
 async def admin_add_task_callback(call: CallbackQuery, bot: Bot, state: FSMContext):
     await bot.send_message(call.from_user.id, "Введите текст задания:")
     await state.set_state(AdminState.ADD_TASK)
 
-@router.callback_query(F.data == "top_balance")
+@callbacks.route("top_balance")
 async def admin_top_balance_callback(call: CallbackQuery, bot: Bot, state: FSMContext):
-    top_users_data = get_top_balance()
+    top_users_data = await get_top_balance()
     text_balance = "<b>🏆 Топ-50 по балансу:</b>\n\n"
     for index, user_data in enumerate(top_users_data):
         username = user_data[0]
-        balance = user_data[1]
-        if isinstance(balance, float):
-            balance_formatted = f"{balance:.2f}" 
-        else:
-            balance_formatted = str(balance)
+        balance_formatted = user_data[1].format(2)
         text_balance += f"<b>{index + 1}. @{username}</b> - <code>{balance_formatted}</code> ⭐️\n"
     await bot.send_message(call.from_user.id, text_balance, parse_mode='HTML')
 
 
-@router.callback_query(F.data == "remove_task")
+@callbacks.route("remove_task")
 async def admin_remove_task_callback(call: CallbackQuery, bot: Bot, state: FSMContext):
     await bot.send_message(call.from_user.id, "Введите ID задания:")
     await state.set_state(AdminState.REMOVE_TASK)
 
 
-@router.callback_query(F.data == "add_channel")
+@callbacks.route("add_channel")
 async def admin_add_channel_callback(call: CallbackQuery, bot: Bot, state: FSMContext):
     await bot.send_message(call.from_user.id, "Введите ID канала:")
     await state.set_state(AdminState.ADD_CHANNEL)
 
 
-@router.callback_query(F.data == "remove_channel")
+@callbacks.route("remove_channel")
 async def admin_remove_channel_callback(call: CallbackQuery, bot: Bot, state: FSMContext):
     await bot.send_message(call.from_user.id, "Введите ID канала:")
     await state.set_state(AdminState.REMOVE_CHANNEL)
 
 
-@router.callback_query(F.data.startswith("paid"))
-async def paid_callback(call: CallbackQuery, bot: Bot):
-    if call.from_user.id in admins_id:
-        id_v = int(call.data.split(":")[1])
-        mesag_id = int(call.data.split(":")[2])
-        us_id = int(call.data.split(":")[3])
-        us_name = call.data.split(":")[4]
-        strs = int(call.data.split(":")[5])
-        emoji = call.data.split(":")[6]
-        await bot.edit_message_text(chat_id=channel_viplat_id, message_id=mesag_id, text=f"<b>✅ Запрос на вывод №{id_v}</b>\n\n👤 Пользователь: @{us_name} | ID: {us_id}\n💫 Количество: <code>{strs}</code>⭐️ [{emoji}]\n\n🔄 Статус: <b>Подарок отправлен 🎁</b>\n\n<b><a href='{channel_osn}'>Основной канал</a></b> | <b><a href='{chater}'>Чат</a></b> | <b><a href='{'https://t.me/' + (await bot.me()).username}'>Бот</a></b>", parse_mode='HTML', disable_web_page_preview=True)
-    else:
-        await bot.answer_callback_query(call.id, "⚠️ Вы не администратор.")
-
-
 async def safe_edit_message(bot, chat_id, message_id, new_text, reply_markup=None):
     try:
         await bot.edit_message_text(
@@ -1694,67 +2188,254 @@ async def safe_edit_message(bot, chat_id, message_id, new_text, reply_markup=Non
         if "message is not modified" not in str(e):
             raise
 
-@router.callback_query(F.data.startswith("denied"))
-async def denied_callback(call: CallbackQuery, bot: Bot):
+# Причины отказа: код в callback_data -> (текст кнопки, текст в заявке)
+PAYOUT_REASONS = {
+    "narkutka": ("🎰 Накрутка", "🎰 Накрутка"),
+    "usloviya": ("🎫 Не выполнены условия вывода", "🎫 Отсутствует подписка на канал/чат"),
+    "black_list": ("❌ Черный список", "❌ Черный список"),
+    "bagous": ("⚠️ Багаюз", "⚠️ Багаюз")
+}
+
+PREMIUM_LEVELS = {'premium1': 1, 'premium2': 3}
+
+def withdrawal_context(row) -> Dict[str, Any]:
+    """Данные заявки для payout_text из строки withdrawales (см. WITHDRAWAL_COLUMNS)."""
+    id_v, username, user_id, stars, _, kind, emoji, message_id, _ = row
+    context = {'id_v': id_v, 'message_id': message_id, 'user_id': user_id, 'username': username}
+    if kind in PREMIUM_LEVELS:
+        context['level'] = PREMIUM_LEVELS[kind]
+    else:
+        context.update(stars=str(stars), emoji=emoji)
+    return context
+
+def payout_status_line(action: str, reason: str = '') -> str:
+    if action == 'paid':
+        return f"🔄 Статус: <b>{WITHDRAWAL_PAID}</b>"
+    if action == 'balk':
+        return f"🔄 Статус: <b>{WITHDRAWAL_DENIED}</b>\n⚠️Причина: {PAYOUT_REASONS.get(reason, ('', 'Неизвестная причина'))[1]} \u200B"
+    return f"🔄 Статус: <b>{WITHDRAWAL_DENIED}</b>"
+
+async def payout_text(bot: Bot, context: Dict[str, Any], status: str) -> str:
+    if context.get('level'):
+        amount_line = f"🎁 Telegram Premium: {'1 месяц' if context['level'] == 1 else '3 месяца'}"
+    else:
+        amount_line = f"💫 Количество: <code>{context['stars']}</code>⭐️ [{context['emoji']}]"
+    return (
+        f"<b>✅ Запрос на вывод №{context['id_v']}</b>\n\n"
+        f"👤 Пользователь: @{context['username']} | ID: {context['user_id']}\n"
+        f"{amount_line}\n\n"
+        f"{status}\n\n"
+        f"<b><a href='{channel_osn}'>Основной канал</a></b> | "
+        f"<b><a href='{chater}'>Чат</a></b> | "
+        f"<b><a href='{'https://t.me/' + (await bot.me()).username}'>Бот</a></b>"
+    )
+
+async def resolve_payout(bot: Bot, action: str, context: Dict[str, Any], token: Optional[str] = None, reason: str = ''):
+    """Обновляет заявку в канале выплат по решению админа (paid / denied / balk).
+
+    context — данные заявки из callback_contexts (или из кнопок старого формата).
+    Токен удаляется, как только по заявке больше нечего нажимать. Возвращает False, если заявку
+    уже обработали (например, пачкой из очереди): тогда пост перерисовывается с текущим статусом."""
+    markup = None
+    if action != 'balk' and not set_withdrawal_status(context['id_v'], WITHDRAWAL_PAID if action == 'paid' else WITHDRAWAL_DENIED):
+        status = get_status_withdrawal(context['id_v'])
+        if status is not None:
+            text = await payout_text(bot, context, payout_status_line('paid' if status == WITHDRAWAL_PAID else 'denied'))
+            await safe_edit_message(bot, channel_viplat_id, int(context['message_id']), text, None)
+        if token:
+            delete_callback_context(token)
+        return False
+    if action == 'denied':
+        if not context.get('level'):
+            token = token or create_callback_context(context)
+            markup = InlineKeyboardMarkup(inline_keyboard=[
+                [InlineKeyboardButton(text=button, callback_data=PayoutCallback(action='balk', token=token, reason=code).pack())]
+                for code, (button, _) in PAYOUT_REASONS.items()
+            ])
+
+    text = await payout_text(bot, context, payout_status_line(action, reason))
+    await safe_edit_message(bot, channel_viplat_id, int(context['message_id']), text, markup)
+    if markup is None and token:
+        delete_callback_context(token)
+    return True
+
+@callbacks.route(factory=PayoutCallback)
+async def payout_callback(call: CallbackQuery, bot: Bot, callback_data: PayoutCallback):
+    if call.from_user.id not in admins_id:
+        await bot.answer_callback_query(call.id, "⚠️ Вы не администратор.")
+        return
+    context = get_callback_context(callback_data.token)
+    if context is None:
+        await bot.answer_callback_query(call.id, "⚠️ Заявка уже обработана.")
+        return
+    if not await resolve_payout(bot, callback_data.action, context, callback_data.token, callback_data.reason):
+        await bot.answer_callback_query(call.id, "⚠️ Заявка уже обработана.")
+
+# Кнопки старого формата (все данные заявки в callback_data) в уже отправленных сообщениях
+@callbacks.route(factory=PaidCallback)
+async def paid_callback(call: CallbackQuery, bot: Bot, callback_data: PaidCallback):
     if call.from_user.id in admins_id:
-        data = call.data.split(":")
-        id_v, mesag_id, us_id, us_name, strs, emoji = map(str, data[1:7])
-
-        reason_markup = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="🎰 Накрутка", callback_data=f"balk:{id_v}:{mesag_id}:{us_id}:{us_name}:{strs}:{emoji}:narkutka")],
-            [InlineKeyboardButton(text="🎫 Не выполнены условия вывода", callback_data=f"balk:{id_v}:{mesag_id}:{us_id}:{us_name}:{strs}:{emoji}:usloviya")],
-            [InlineKeyboardButton(text="❌ Черный список", callback_data=f"balk:{id_v}:{mesag_id}:{us_id}:{us_name}:{strs}:{emoji}:black_list")],
-            [InlineKeyboardButton(text="⚠️ Багаюз", callback_data=f"balk:{id_v}:{mesag_id}:{us_id}:{us_name}:{strs}:{emoji}:bagous")]
-        ])
-
-        text = (
-            f"<b>✅ Запрос на вывод №{id_v}</b>\n\n"
-            f"👤 Пользователь: @{us_name} | ID: {us_id}\n"
-            f"💫 Количество: <code>{strs}</code>⭐️ [{emoji}]\n\n"
-            f"🔄 Статус: <b>Отказано 🚫</b>\n\n"
-            f"<b><a href='{channel_osn}'>Основной канал</a></b> | "
-            f"<b><a href='{chater}'>Чат</a></b> | "
-            f"<b><a href='{'https://t.me/' + (await bot.me()).username}'>Бот</a></b>"
-        )
+        if not await resolve_payout(bot, 'paid', callback_data.model_dump()):
+            await bot.answer_callback_query(call.id, "⚠️ Заявка уже обработана.")
+    else:
+        await bot.answer_callback_query(call.id, "⚠️ Вы не администратор.")
 
-        await safe_edit_message(bot, channel_viplat_id, int(mesag_id), text, reason_markup)
+@callbacks.route(factory=DeniedCallback)
+async def denied_callback(call: CallbackQuery, bot: Bot, callback_data: DeniedCallback):
+    if call.from_user.id in admins_id:
+        if not await resolve_payout(bot, 'denied', callback_data.model_dump()):
+            await bot.answer_callback_query(call.id, "⚠️ Заявка уже обработана.")
     else:
         await bot.answer_callback_query(call.id, "⚠️ Вы не администратор.")
 
-@router.callback_query(F.data.startswith("balk"))
-async def denied_reason_callback(call: CallbackQuery, bot: Bot):
-    # print(1)
+@callbacks.route(factory=BalkCallback)
+async def denied_reason_callback(call: CallbackQuery, bot: Bot, callback_data: BalkCallback):
     if call.from_user.id in admins_id:
-        # print("called")
-        data = call.data.split(":")
-        id_v, mesag_id, us_id, us_name, strs, emoji, reason = map(str, data[1:8])
-
-        reasons = {
-            "narkutka": "🎰 Накрутка",
-            "usloviya": "🎫 Отсутствует подписка на канал/чат",
-            "black_list": "❌ Черный список",
-            "bagous": "⚠️ Багаюз"
-        }
+        await resolve_payout(bot, 'balk', callback_data.model_dump(), reason=callback_data.reason)
+    else:
+        await bot.answer_callback_query(call.id, "⚠️ Вы не администратор.")
 
-        reason_text = reasons.get(reason, "Неизвестная причина")
-
-        text = (
-            f"<b>✅ Запрос на вывод №{id_v}</b>\n\n"
-            f"👤 Пользователь: @{us_name} | ID: {us_id}\n"
-            f"💫 Количество: <code>{strs}</code>⭐️ [{emoji}]\n\n"
-            f"🔄 Статус: <b>Отказано 🚫</b>\n"
-            f"⚠️Причина: {reason_text} \u200B\n\n"
-            f"<b><a href='{channel_osn}'>Основной канал</a></b> | "
-            f"<b><a href='{chater}'>Чат</a></b> | "
-            f"<b><a href='{'https://t.me/' + (await bot.me()).username}'>Бот</a></b>"
-        )
 
-        await safe_edit_message(bot, channel_viplat_id, int(mesag_id), text, None)
+class CsvExportFile(InputFile):
+    """CSV, который собирается прямо во время загрузки из генератора строк: в памяти только текущий кусок."""
+    def __init__(self, header: List[str], rows, filename: str, chunk_size: int = 64 * 1024):
+        super().__init__(filename=filename, chunk_size=chunk_size)
+        self.header = header
+        self.rows = rows
+
+    async def read(self, bot: Bot):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        # BOM, чтобы Excel открыл кириллицу в статусах
+        buffer.write('\ufeff')
+        writer.writerow(self.header)
+        for row in self.rows:
+            writer.writerow(row)
+            if buffer.tell() >= self.chunk_size:
+                yield buffer.getvalue().encode('utf-8')
+                buffer.seek(0)
+                buffer.truncate()
+        if buffer.tell():
+            yield buffer.getvalue().encode('utf-8')
+
+def withdrawals_csv_rows(rows):
+    for id_v, username, user_id, stars, status, kind, emoji, _, created_at in rows:
+        created = datetime.fromtimestamp(created_at).strftime('%Y-%m-%d %H:%M:%S') if created_at else ''
+        yield (id_v, username, user_id, stars, kind or 'stars', emoji or '', status, created)
+
+def review_amount(row) -> str:
+    kind, stars, emoji = row[5], row[3], row[6]
+    if kind in PREMIUM_LEVELS:
+        return f"🎁 Premium {PREMIUM_LEVELS[kind]} мес."
+    return f"{stars}⭐️ [{emoji}]" if emoji else f"{stars}⭐️"
+
+async def show_review_page(bot: Bot, chat_id: int, state: FSMContext, after: int = 0, message_id: Optional[int] = None):
+    """Страница очереди заявок с отметками выбранных. Без message_id отправляет новое сообщение."""
+    selected = set((await state.get_data()).get('review_selected', []))
+    rows = get_pending_withdrawals(after, REVIEW_PAGE_SIZE)
+    total = count_pending_withdrawals()
+
+    lines = [f"<b>📋 Заявки на вывод в ожидании: {total}</b>", f"Выбрано: <b>{len(selected)}</b>", ""]
+    builder = InlineKeyboardBuilder()
+    for row in rows:
+        mark = '✅' if row[0] in selected else '⬜️'
+        lines.append(f"{mark} №{row[0]} — @{row[1]} | <code>{row[2]}</code> | {review_amount(row)}")
+        builder.button(text=f"{mark} №{row[0]}", callback_data=ReviewCallback(action='toggle', after=after, wid=row[0]).pack())
+    if not rows:
+        lines.append("<i>Заявок на этой странице нет</i>")
+
+    sizes = [2] * ((len(rows) + 1) // 2)
+    nav = 0
+    if after:
+        builder.button(text="⏮ В начало", callback_data=ReviewCallback(action='page').pack())
+        nav += 1
+    if len(rows) == REVIEW_PAGE_SIZE:
+        builder.button(text="Далее ➡️", callback_data=ReviewCallback(action='page', after=rows[-1][0]).pack())
+        nav += 1
+    if nav:
+        sizes.append(nav)
+    builder.button(text="☑️ Выбрать страницу", callback_data=ReviewCallback(action='all', after=after).pack())
+    builder.button(text="🧹 Сбросить выбор", callback_data=ReviewCallback(action='clear', after=after).pack())
+    builder.button(text=f"✅ Отправить ({len(selected)})", callback_data=ReviewCallback(action='paid', after=after).pack())
+    builder.button(text=f"❌ Отклонить ({len(selected)})", callback_data=ReviewCallback(action='deny', after=after).pack())
+    builder.button(text="📄 Выгрузить CSV", callback_data=ReviewCallback(action='export').pack())
+    builder.button(text="⭐️ Админ-Панель", callback_data="adminpanelka")
+    markup = builder.adjust(*sizes, 2, 2, 1, 1).as_markup()
+
+    text = "\n".join(lines)
+    if message_id is None:
+        await bot.send_message(chat_id, text, parse_mode='HTML', reply_markup=markup)
     else:
+        await safe_edit_message(bot, chat_id, message_id, text, markup)
+
+async def apply_review(bot: Bot, call: CallbackQuery, state: FSMContext, action: str, reason: str = ''):
+    """Решение по всем выбранным заявкам: статусы меняются одной транзакцией, посты в канале правятся очередью."""
+    selected = (await state.get_data()).get('review_selected', [])
+    if not selected:
+        await bot.answer_callback_query(call.id, "⚠️ Ничего не выбрано.")
+        return False
+    rows = set_withdrawals_status(selected, WITHDRAWAL_PAID if action == 'paid' else WITHDRAWAL_DENIED)
+    status = payout_status_line('balk' if reason else action, reason)
+    for row in rows:
+        context = withdrawal_context(row)
+        if context['message_id'] is not None:
+            channel_edits.push(bot, channel_viplat_id, context['message_id'], await payout_text(bot, context, status))
+    await state.update_data(review_selected=[])
+    skipped = len(selected) - len(rows)
+    await bot.answer_callback_query(
+        call.id,
+        f"{'✅ Отправлено' if action == 'paid' else '❌ Отклонено'}: {len(rows)}"
+        + (f"\nУже были обработаны: {skipped}" if skipped else "")
+        + f"\nПосты в канале обновятся примерно за {max(1, round(channel_edits.eta / 60))} мин.",
+        show_alert=True
+    )
+    logging.info(f"[REVIEW] Админ {call.from_user.id}: {action} {len(rows)} заявок")
+    return True
+
+@callbacks.route(factory=ReviewCallback)
+async def review_callback(call: CallbackQuery, bot: Bot, state: FSMContext, callback_data: ReviewCallback):
+    if call.from_user.id not in admins_id:
         await bot.answer_callback_query(call.id, "⚠️ Вы не администратор.")
+        return
+    action, after = callback_data.action, callback_data.after
+    chat_id, message_id = call.message.chat.id, call.message.message_id
+
+    if action == 'export':
+        document = CsvExportFile(
+            ['id', 'username', 'user_id', 'stars', 'kind', 'emoji', 'status', 'created_at'],
+            withdrawals_csv_rows(iter_withdrawals(WITHDRAWAL_PENDING)),
+            filename=f"withdrawals_{datetime.now():%Y%m%d_%H%M}.csv"
+        )
+        await bot.answer_callback_query(call.id)
+        await bot.send_document(chat_id, document=document, caption="📄 Заявки на вывод в ожидании")
+        return
+    if action == 'deny':
+        builder = InlineKeyboardBuilder()
+        for code, (button, _) in PAYOUT_REASONS.items():
+            builder.button(text=button, callback_data=ReviewCallback(action='denied', after=after, reason=code).pack())
+        builder.button(text="Без причины", callback_data=ReviewCallback(action='denied', after=after).pack())
+        builder.button(text="⬅️ Назад", callback_data=ReviewCallback(action='page', after=after).pack())
+        await bot.edit_message_reply_markup(chat_id=chat_id, message_id=message_id, reply_markup=builder.adjust(1).as_markup())
+        return
+
+    if action == 'toggle':
+        selected = set((await state.get_data()).get('review_selected', []))
+        selected ^= {callback_data.wid}
+        await state.update_data(review_selected=sorted(selected))
+    elif action == 'all':
+        selected = set((await state.get_data()).get('review_selected', []))
+        selected.update(row[0] for row in get_pending_withdrawals(after, REVIEW_PAGE_SIZE))
+        await state.update_data(review_selected=sorted(selected))
+    elif action == 'clear':
+        await state.update_data(review_selected=[])
+    elif action in ('paid', 'denied'):
+        if not await apply_review(bot, call, state, action, callback_data.reason):
+            return
+        after = 0
+    await show_review_page(bot, chat_id, state, after, message_id)
 
 
-@router.callback_query(F.data == "donate")
+@callbacks.route("donate")
 async def donate_callback(call: CallbackQuery, bot: Bot):
     user_id = call.from_user.id
     banned = get_banned_user(user_id)
@@ -1822,7 +2503,7 @@ async def successful_payment_handler(message: Message, bot: Bot):
         logging.error(f"Ошибка при обработке успешного платежа: {e}")
         await bot.send_message(user_id, "<b>Произошла ошибка при обработке платежа. Пожалуйста, свяжитесь с администратором.</b>", parse_mode='HTML')
 
-@router.callback_query(F.data == "info_added_channels")
+@callbacks.route("info_added_channels")
 async def info_added_channels_callback(call: CallbackQuery, bot: Bot):
     text = "⚙️ <b>В данный момент добавлены следующие каналы:</b>\n\n"
     if len(required_subscription) == 0:
@@ -1836,7 +2517,7 @@ async def info_added_channels_callback(call: CallbackQuery, bot: Bot):
     await bot.send_message(call.from_user.id, text, parse_mode='HTML')
 
 
-@router.callback_query(F.data.startswith("check_subs"))
+@callbacks.route('check_subs')
 async def check_subs_callback(call: CallbackQuery, bot: Bot):
     user_id = call.from_user.id
     refferal_id = None
@@ -1847,27 +2528,8 @@ async def check_subs_callback(call: CallbackQuery, bot: Bot):
 
     if await check_subscription(user_id, required_subscription, bot, refferal_id=refferal_id):
         if not user_exists(user_id):
-            add_user(user_id, call.from_user.username, refferal_id)
+            await register_user(user_id, call.from_user.username, refferal_id, bot)
             if refferal_id is not None:
-                c_refs = get_user_referrals_count(refferal_id)
-                if c_refs < 50:
-                    nac = 0.7 * 2 if user_in_booster(refferal_id) else 0.7
-                    increment_stars(refferal_id, nac)
-                elif 50 <= c_refs < 250:
-                    nac = 1 * 2 if user_in_booster(refferal_id) else 1
-                    increment_stars(refferal_id, nac)
-                else:
-                    nac = 1.5 * 2 if user_in_booster(refferal_id) else 1.5
-                    increment_stars(refferal_id, nac)
-                increment_referrals(refferal_id)
-                new_ref_link = f"https://t.me/{ (await bot.me()).username }?start={refferal_id}"
-                await bot.send_message(
-                    refferal_id,
-                    f"🎉 Пользователь <code>{user_id}</code> запустил бота по вашей ссылке!\n"
-                    f"Вы получили +{nac}⭐️ за реферала.\n"
-                    f"Поделитесь ссылкой ещё раз:\n<code>{new_ref_link}</code>",
-                    parse_mode='HTML'
-                )
                 await bot.answer_callback_query(call.id, "🎉 Спасибо за подписку!")
                 builder_new_markup = InlineKeyboardBuilder()
                 builder_new_markup.button(text="⬅️ В главное меню", callback_data="back_main")
@@ -1883,28 +2545,14 @@ async def check_subs_callback(call: CallbackQuery, bot: Bot):
         await bot.answer_callback_query(call.id, "❌ Подписка не найдена")
 
 
-@router.callback_query(F.data == "mini_games")
+@callbacks.route("mini_games")
 async def mini_games_callback(call: CallbackQuery, bot: Bot):
     user_id = call.from_user.id
     banned = get_banned_user(user_id)
     if banned == 1:
         await bot.answer_callback_query(call.id, "🚫 Вы заблокированы в боте!", show_alert=True)
         return
-    try:
-        await bot.delete_message(chat_id=call.from_user.id, message_id=call.message.message_id)
-    except Exception as e:
-        logging.error(f"Ошибка при удалении сообщения: {e}")
-    builder_games = InlineKeyboardBuilder()
-    builder_games.button(text="[🔥] Кража звезд 💰", callback_data="theft_game")
-    builder_games.button(text="[🔥] КНБ ✊✌️🖐", callback_data="knb_game")
-    builder_games.button(text="Лотерея 🎰", callback_data="lottery_game")
-    builder_games.button(text="Все или ничего 🎲", callback_data="play_game")
-    builder_games.button(text="⬅️ В главное меню", callback_data="back_main")
-    markup_games = builder_games.adjust(1, 1, 2, 1).as_markup()
-
-    with open('photos/mini_game.jpg', 'rb') as photo:
-        input_photo_minigames = FSInputFile("photos/mini_game.jpg")
-        await bot.send_photo(call.from_user.id, photo=input_photo_minigames, caption="<b>🎮 Добро пожаловать в мини-игры!</b> Выбери игру, чтобы начать:\n\n<b>1️⃣ Испытать удачу</b> — попробуй победить с разными ставками!\n<b>2️⃣ Лотерея</b> — купи билет и выиграй много звезд!\n<b>3️⃣ КНБ</b> — камень ножницы бумага\n<b>4️⃣ Кража звёзд</b> — укради звёзды у своих друзей!", reply_markup=markup_games, parse_mode='HTML')
+    await show_screen(bot, call, "photos/mini_game.jpg", "<b>🎮 Добро пожаловать в мини-игры!</b> Выбери игру, чтобы начать:\n\n<b>1️⃣ Испытать удачу</b> — попробуй победить с разными ставками!\n<b>2️⃣ Лотерея</b> — купи билет и выиграй много звезд!\n<b>3️⃣ КНБ</b> — камень ножницы бумага\n<b>4️⃣ Кража звёзд</b> — укради звёзды у своих друзей!", ui.mini_games)
 
 def generate_password(length: int) -> str:
     characters = string.ascii_letters + string.digits
@@ -1923,7 +2571,7 @@ async def send_progress_bar(bot, chat_id, message_id):
         )
         await asyncio.sleep(0.5)
 
-@router.callback_query(F.data == "theft_game")
+@callbacks.route("theft_game")
 async def theft_game_starter(call: CallbackQuery, bot: Bot, state: FSMContext):
 
     user_id = call.from_user.id
@@ -1961,12 +2609,11 @@ async def theft_game_starter(call: CallbackQuery, bot: Bot, state: FSMContext):
 @router.message(TheftGame.waiting_username)
 async def theft_game_username(message: Message, bot: Bot, state: FSMContext):
     username = message.text.lstrip('@')
-    if username == message.from_user.username:
+    user_id = get_id_from_username(username)
+    if user_id == message.from_user.id:
         await bot.send_message(message.from_user.id, "🚫 Вы не можете играть сам с собой.")
         await state.clear()
         return
-
-    user_id = get_id_from_username(username)
     if user_id is None:
         await bot.send_message(message.from_user.id, "🚫 Пользователь не найден.")
         await state.clear()
@@ -2031,13 +2678,16 @@ async def theft_game_username(message: Message, bot: Bot, state: FSMContext):
             parse_mode='HTML'
         )
 
-        await bot.send_message(
-            chat_id=id_channel_game,
+        await notifier.push(
+            bot,
+            id_channel_game,
+            'theft',
             text=(
                 f"<b>🥷🏻Среди нас появился вор!</b>"
                 f"👣 @{message.from_user.username} успешно украл {stolen_amount}💰 у @{username}!"
             ),
-            parse_mode='HTML'
+            line=f"👣 @{message.from_user.username} → @{username}: {stolen_amount}💰",
+            stars=stolen_amount
         )
         await state.clear()
     else:
@@ -2054,7 +2704,7 @@ async def theft_game_username(message: Message, bot: Bot, state: FSMContext):
         )
         await state.clear()
 
-@router.callback_query(F.data == "knb_game")
+@callbacks.route("knb_game")
 async def knb_game_starter(call: CallbackQuery, bot: Bot, state: FSMContext):
     try:
         await bot.delete_message(chat_id=call.from_user.id, message_id=call.message.message_id)
@@ -2076,14 +2726,14 @@ async def knb_game_username(message: Message, bot: Bot, state: FSMContext):
         await bot.send_message(message.from_user.id , "🚫 У вас баланс меньше или равно 0.")
     if username.startswith('@'):
         username = username[1:]
-    if username == (message.from_user.username):
+    user_id = get_id_from_username(username)
+    if user_id == message.from_user.id:
         await bot.send_message(message.from_user.id, "🚫 Вы не можете играть сам с собой.")
         return
-    user_id = get_id_from_username(username)
     if user_id is None:
         await bot.send_message(message.from_user.id, "🚫 Пользователь не найден.")
         return
-    await state.update_data(username=username)
+    await state.update_data(username=username, user_id=user_id)
     await bot.delete_message(chat_id=message.from_user.id, message_id=message.message_id)
     builder_knb = InlineKeyboardBuilder()
     builder_knb.button(text="Назад в меню мини-игр", callback_data="mini_games")
@@ -2096,10 +2746,11 @@ async def knb_game_username(message: Message, bot: Bot, state: FSMContext):
 async def knb_game_stake(message: Message, bot: Bot, state: FSMContext):
     try:
         stake = float(message.text)
+        if not math.isfinite(stake):
+            raise ValueError(message.text)
         balance_user1 = get_balance_user(message.from_user.id)
-        username = await state.get_data()
-        username = username['username']
-        user_id = get_id_from_username(username)
+        data = await state.get_data()
+        username, user_id = data['username'], data['user_id']
         balance_user2 = get_balance_user(user_id)
         if balance_user1 < stake:
             await bot.send_message(message.from_user.id, "🚫 У вас недостаточно звёзд.")
@@ -2109,54 +2760,57 @@ async def knb_game_stake(message: Message, bot: Bot, state: FSMContext):
             return
         elif stake < 0:
             await bot.send_message(message.from_user.id, "🚫 Ставка не может быть отрицательной.")
+            return
     except ValueError:
         await bot.send_message(message.from_user.id, "🚫 Пожалуйста, введите число.")
         return
     await state.update_data(stake=stake)
     await bot.delete_message(chat_id=message.from_user.id, message_id=message.message_id)
-    id = create_knb(message.from_user.id, user_id, bet=stake)
+    id = knb.create(message.from_user.id, user_id, stake, message.from_user.username, username)['id']
     input_photo_minigames = FSInputFile("photos/mini_game.jpg")
     await bot.send_photo(message.from_user.id, photo=input_photo_minigames, caption=f"<b>🕹 Вы вошли в мини-игру КНБ!</b>\n\n<blockquote><b>👤 Выбран игрок: <code>{username}</code> | <code>{user_id}</code>\n💰 Ставка: <code>{stake}</code></b></blockquote>\n\n<i>Ожидайте, пока пользователь примет игру.</i>", parse_mode='HTML')
     player_builder = InlineKeyboardBuilder()
-    player_builder.button(text="✅ Принять игру", callback_data=f"accept_knb:{id}:{stake}:{message.from_user.id}")
-    player_builder.button(text="❌ Отказаться", callback_data=f"decline_knb:{id}:{message.from_user.id}")
+    player_builder.button(text="✅ Принять игру", callback_data=f"accept_knb:{id}")
+    player_builder.button(text="❌ Отказаться", callback_data=f"decline_knb:{id}")
     player_markup = player_builder.adjust(1, 1).as_markup()
-    await bot.send_message(user_id, f"🕹 Вас пригласили в мини-игру КНБ!\n\n<blockquote><b>🆔 Игры: {id}\n👤 Пригласил игрок: <code>{message.from_user.first_name}</code> | <code>{message.from_user.id}</code>\n💰 Ставка: <code>{stake}</code></b></blockquote>", parse_mode='HTML', reply_markup=player_markup)
+    await bot.send_message(user_id, f"🕹 Вас пригласили в мини-игру КНБ!\n\n<blockquote><b>🆔 Игры: {id}\n👤 Пригласил игрок: <code>{message.from_user.first_name}</code> | <code>{message.from_user.id}</code>\n💰 Ставка: <code>{stake}</code>\n⌛️ Приглашение действует {KNB_GAME_TTL // 60} мин.</b></blockquote>", parse_mode='HTML', reply_markup=player_markup)
 
-@router.callback_query(F.data.startswith("accept_knb:"))
+@callbacks.route('accept_knb')
 async def accept_knb_callback(call: CallbackQuery, bot: Bot):
-    id_game = call.data.split(':')[1]
-    stake = call.data.split(':')[2]
-    use_id = call.data.split(':')[3]
+    id_game = int(call.data.split(':')[1])
+    success, game = knb.accept(id_game, call.from_user.id, call.from_user.username)
+    if not success:
+        await bot.answer_callback_query(call.id, game, show_alert=True)
+        return
+    use_id = game['first']
+    stake = game['bet']
     await bot.delete_message(chat_id=call.from_user.id, message_id=call.message.message_id)
     await bot.answer_callback_query(call.id, "✅ Вы приняли игру.")
     await bot.send_message(call.from_user.id, "⌛️ Ожидайте, пока пользователь сделает свой ход.")
 
-    deincrement_stars(use_id, stake)
-    deincrement_stars(call.from_user.id, stake)
     markup_choice = InlineKeyboardBuilder()
-    markup_choice.button(text="[✊] Камень", callback_data=f"stone_knb:{id_game}:first_player")
-    markup_choice.button(text="[✌️] Ножницы", callback_data=f"scissors_knb:{id_game}:first_player")
-    markup_choice.button(text="[✋] Бумага", callback_data=f"paper_knb:{id_game}:first_player")
+    markup_choice.button(text="[✊] Камень", callback_data=KnbFirstMoveCallback(move="stone", game_id=id_game).pack())
+    markup_choice.button(text="[✌️] Ножницы", callback_data=KnbFirstMoveCallback(move="scissors", game_id=id_game).pack())
+    markup_choice.button(text="[✋] Бумага", callback_data=KnbFirstMoveCallback(move="paper", game_id=id_game).pack())
     markup = markup_choice.adjust(3).as_markup()
     await bot.send_message(use_id, f"<b>✅ Пользователь {call.from_user.first_name} принял игру.</b>\n\n<blockquote><b>💰 Ставка: {stake}</b></blockquote>", parse_mode='HTML', reply_markup=markup)
 
-@router.callback_query(F.data.split(":")[2] == "first_player")
-async def handle_first_player_choice(call: CallbackQuery, bot: Bot):
-    data_parts = call.data.split(":")
-    choice_type = data_parts[0].split("_")[0]
-    game_id = data_parts[1]
-    
-    change_choice(game_id, "first_player", choice_type)
-    
-    game = get_knb_game(game_id)
-    second_player_id = game[2]
-    stake = game[6]
+@callbacks.route(factory=KnbFirstMoveCallback)
+async def handle_first_player_choice(call: CallbackQuery, bot: Bot, callback_data: KnbFirstMoveCallback):
+    choice_type = callback_data.move
+    game_id = callback_data.game_id
+
+    success, game = knb.move_first(game_id, call.from_user.id, choice_type)
+    if not success:
+        await bot.answer_callback_query(call.id, game, show_alert=True)
+        return
+    second_player_id = game['second']
+    stake = game['bet']
     
     markup_choice = InlineKeyboardBuilder()
-    markup_choice.button(text="✊ Камень", callback_data=f"stone_knb:{game_id}:second_player")
-    markup_choice.button(text="✌️ Ножницы", callback_data=f"scissors_knb:{game_id}:second_player")
-    markup_choice.button(text="✋ Бумага", callback_data=f"paper_knb:{game_id}:second_player")
+    markup_choice.button(text="✊ Камень", callback_data=KnbSecondMoveCallback(move="stone", game_id=game_id).pack())
+    markup_choice.button(text="✌️ Ножницы", callback_data=KnbSecondMoveCallback(move="scissors", game_id=game_id).pack())
+    markup_choice.button(text="✋ Бумага", callback_data=KnbSecondMoveCallback(move="paper", game_id=game_id).pack())
     markup = markup_choice.adjust(3).as_markup()
     await bot.send_message(
         second_player_id,
@@ -2198,98 +2852,66 @@ async def stats_command(message: Message, bot: Bot):
             await message.reply(f"<b>👤 Статистика: {message.from_user.id} | {message.from_user.first_name}</b>\n\n<blockquote><i>💫 Количество кликов: {clicks}</i>\n<i>👥 Общее Количество рефераллов: {refs}</i>\n<i>👥 Количество рефералов за неделю: {refs_week}</i>\n<i>⭐️ Выведено звёзд: {withdrawed:.2f}</i></blockquote>", parse_mode='HTML')
 
 
-@router.callback_query(F.data.split(":")[2] == "second_player")
-async def handle_second_player_choice(call: CallbackQuery, bot: Bot):
-    data_parts = call.data.split(":")
-    choice_type = data_parts[0].split("_")[0]
-    game_id = data_parts[1]
-    
-    change_choice(game_id, "second_player", choice_type)
-    
+KNB_MOVE_NAMES = {"stone": "[✊] Камень", "scissors": "[✌️] Ножницы", "paper": "[✋] Бумага"}
+
+@callbacks.route(factory=KnbSecondMoveCallback)
+async def handle_second_player_choice(call: CallbackQuery, bot: Bot, callback_data: KnbSecondMoveCallback):
+    # Итог, выплата и запись результата — одна транзакция в knb.settle
+    success, game = knb.settle(callback_data.game_id, call.from_user.id, callback_data.move)
+    if not success:
+        await bot.answer_callback_query(call.id, game, show_alert=True)
+        return
     await bot.delete_message(chat_id=call.from_user.id, message_id=call.message.message_id)
     await bot.answer_callback_query(call.id, "✅ Вы выбрали свой ход.")
-    winner_text = ""
-
-    game = get_knb_game(game_id)
-    first_player_id = game[1]
-    second_player_id = game[2]
-    choice_1 = game[3]
-    # print(choice_1)
-    choice_2 = game[4]
-    # print(choice_2)
-    stake = game[6]
-    result = set_result(game_id, choice_1, choice_2)
-    # print(result)
-    if result == "Ничья":
+
+    stake = game['bet']
+    # В игре хранятся username на момент создания; имя для текста берётся из кеша профилей
+    players = {}
+    for player_id, username in ((game['first'], game['first_name']), (game['second'], game['second_name'])):
+        name = html.escape(profiles.first_name(player_id))
+        players[player_id] = f"<a href='https://t.me/{username}'>{name}</a>" if username else name
+    if game['result'] == KNB_DRAW:
         winner_text = "Ничья! 🟰"
-        increment_stars(first_player_id, stake)
-        increment_stars(second_player_id, stake)
     else:
-        winner_id = first_player_id if result == "Первый игрок победил!" else second_player_id
-        # print(winner_id)
-        increment_stars(winner_id, stake * 2)
-        winner = await bot.get_chat(winner_id)
-        winner_text = f"Победу одержал @{winner.username}"
-        # print(winner_text)
-
-    if choice_1 == "stone":
-        choice_1 = "[✊] Камень"
-    elif choice_1 == "scissors":
-        choice_1 = "[✌️] Ножницы"
-    elif choice_1 == "paper":
-        choice_1 = "[✋] Бумага"
-    
-    if choice_2 == "stone":
-        choice_2 = "[✊] Камень"
-    elif choice_2 == "scissors":
-        choice_2 = "[✌️] Ножницы"
-    elif choice_2 == "paper":
-        choice_2 = "[✋] Бумага"
-    
-    
-    for player_id in [first_player_id, second_player_id]:
-        builder_knb = InlineKeyboardBuilder()
-        builder_knb.button(text="Назад в меню мини-игр", callback_data="mini_games")
-        markup_knb = builder_knb.as_markup()
-        first_player = await bot.get_chat(first_player_id)
-        second_player = await bot.get_chat(second_player_id)
-        await bot.send_message(
-            player_id,
-            f"<b>🎉 Игра завершена!</b>\n"
-            f"<blockquote>➖➖➖➖➖➖➖\n"
-            f"<b><a href='https://t.me/{first_player.username}'>👤 Игрок 1</a>: {choice_1}\n"
-            f"<a href='https://t.me/{second_player.username}'>👤 Игрок 2</a>: {choice_2}</b>\n"
-            f"➖➖➖➖➖➖➖\n"
-            f"<b>🏆 Результат игры: {winner_text}</b>\n"
-            f"<b>💰 Ставка: <code>{stake}</code></b></blockquote>",
-            parse_mode='HTML',
-            disable_web_page_preview=True,
-            reply_markup=markup_knb
-        )
-    await bot.send_message(
+        winner_text = f"Победу одержал {players[game['winner_id']]}"
+    choice_1 = KNB_MOVE_NAMES[game['choice_first']]
+    choice_2 = KNB_MOVE_NAMES[game['choice_second']]
+
+    text = (
+        f"<b>🎉 Игра завершена!</b>\n"
+        f"<blockquote>➖➖➖➖➖➖➖\n"
+        f"<b>👤 Игрок 1 {players[game['first']]}: {choice_1}\n"
+        f"👤 Игрок 2 {players[game['second']]}: {choice_2}</b>\n"
+        f"➖➖➖➖➖➖➖\n"
+        f"<b>🏆 Результат игры: {winner_text}</b>\n"
+        f"<b>💰 Ставка: <code>{stake}</code></b></blockquote>"
+    )
+    builder_knb = InlineKeyboardBuilder()
+    builder_knb.button(text="Назад в меню мини-игр", callback_data="mini_games")
+    markup_knb = builder_knb.as_markup()
+    for player_id in (game['first'], game['second']):
+        await bot.send_message(player_id, text, parse_mode='HTML', disable_web_page_preview=True, reply_markup=markup_knb)
+    await notifier.push(
+            bot,
             id_channel_game,
-            f"<b>🎉 Игра завершена!</b>\n"
-            f"<blockquote>➖➖➖➖➖➖➖\n"
-                f"<b><a href='https://t.me/{first_player.username}'>👤 Игрок 1</a>: {choice_1}\n"
-            f"<a href='https://t.me/{second_player.username}'>👤 Игрок 2</a>: {choice_2}</b>\n"
-            f"➖➖➖➖➖➖➖\n"
-            f"<b>🏆 Результат игры: {winner_text}</b>\n"
-            f"<b>💰 Ставка: <code>{stake}</code></b></blockquote>",
-            parse_mode='HTML',
-            disable_web_page_preview=True
+            'knb',
+            text=text,
+            line=f"{choice_1} vs {choice_2} — {winner_text}, ставка {stake}"
         )
 
 
-@router.callback_query(F.data.startswith("decline_knb:"))
+@callbacks.route('decline_knb')
 async def decline_knb_callback(call: CallbackQuery, bot: Bot):
-    id_game = call.data.split(':')[1]
-    use_id = call.data.split(':')[2]
-    delete_knb(id_game)
+    id_game = int(call.data.split(':')[1])
+    game = knb.get(id_game)
     await bot.delete_message(chat_id=call.from_user.id, message_id=call.message.message_id)
+    if game is None or not knb.decline(id_game, call.from_user.id):
+        await bot.answer_callback_query(call.id, "⚠️ Игра не найдена или уже началась.")
+        return
     await bot.answer_callback_query(call.id, "🚫 Вы отказались от игры.")
-    await bot.send_message(use_id, "❌ Пользователь отказался от игры.")
+    await bot.send_message(game['first'], "❌ Пользователь отказался от игры.")
 
-@router.callback_query(F.data == "lottery_game")
+@callbacks.route("lottery_game")
 async def lottery_game_callback(call: CallbackQuery, bot: Bot):
     lot_id = get_id_lottery_enabled()
     if lot_id != "Нет.":
@@ -2302,60 +2924,43 @@ async def lottery_game_callback(call: CallbackQuery, bot: Bot):
         ticket_cash = get_ticket_cash_in_lottery()
         await bot.delete_message(chat_id=call.from_user.id, message_id=call.message.message_id)
         lottery_game = InlineKeyboardBuilder()
-        lottery_game.button(text="🎫 Купить билет", callback_data=f"buy_ticket:{lot_id}:{ticket_cash}")
+        lottery_game.button(text="🎫 Купить билет", callback_data=BuyTicketCallback(lot_id=lot_id, price=str(ticket_cash)).pack())
         lottery_game.button(text="Назад в меню мини-игр", callback_data="mini_games")
         markup_lottery_game = lottery_game.adjust(1, 1).as_markup()
         await bot.send_message(call.from_user.id, f"<b>🎉 Вы вошли в лотерею №{lot_id}\n\n💰 Текущий джекпот: {all_cash}\n💵 Стоимость одного билета: {ticket_cash}</b>", parse_mode='HTML', reply_markup=markup_lottery_game)
     else:
         await bot.answer_callback_query(call.id, "😇 В данный момент лотерея не проводится.")
 
-@router.callback_query(F.data.startswith("buy_ticket:"))
-async def buy_ticket_callback(call: CallbackQuery, bot: Bot):
-    lot_id = call.data.split(':')[1]
+@callbacks.route(factory=BuyTicketCallback)
+async def buy_ticket_callback(call: CallbackQuery, bot: Bot, callback_data: BuyTicketCallback):
+    lot_id = callback_data.lot_id
     count_tickets_user = get_count_tickets_by_user(lot_id, call.from_user.id)
     if count_tickets_user > 0:
         await bot.answer_callback_query(call.id, "🎉 Вы уже купили билет в данную лотерею.")
         return
-    ticket_cash = call.data.split(':')[2]
+    ticket_cash = Money.of(callback_data.price)
     money_user = get_balance_user(call.from_user.id)
-    if float(ticket_cash) > money_user:
+    if ticket_cash > money_user:
         await bot.answer_callback_query(call.id, "❌ У вас недостаточно звезд.")
         return
     await bot.delete_message(chat_id=call.from_user.id, message_id=call.message.message_id)
     add_lottery_entry(lot_id, call.from_user.id, call.from_user.username, ticket_cash)
-    deincrement_stars(call.from_user.id, float(ticket_cash))
-    lottery_back = InlineKeyboardBuilder()
-    lottery_back.button(text="Назад в меню мини-игр", callback_data="mini_games")
-    markup_lottery_back = lottery_back.adjust(1).as_markup()
-    await bot.send_message(call.from_user.id, f"<b>🎫 Вы купили билет в лотерею №{lot_id}</b>", parse_mode='HTML', reply_markup=markup_lottery_back)
+    deincrement_stars(call.from_user.id, ticket_cash)
+    await bot.send_message(call.from_user.id, f"<b>🎫 Вы купили билет в лотерею №{lot_id}</b>", parse_mode='HTML', reply_markup=ui.back_mini_games)
 
-@router.callback_query(F.data == "play_game")
+@callbacks.route("play_game")
 async def play_game_callback(call: CallbackQuery, bot: Bot):
-    builder_game = InlineKeyboardBuilder()
-    builder_game.button(text="Ставка 0.5⭐️", callback_data="play_game_with_bet:0.5")
-    builder_game.button(text="Ставка 1⭐️", callback_data="play_game_with_bet:1")
-    builder_game.button(text="Ставка 2⭐️", callback_data="play_game_with_bet:2")
-    builder_game.button(text="Ставка 3⭐️", callback_data="play_game_with_bet:3")
-    builder_game.button(text="Ставка 4⭐️", callback_data="play_game_with_bet:4")
-    builder_game.button(text="Ставка 5⭐️", callback_data="play_game_with_bet:5")
-    builder_game.button(text="Назад в меню мини-игр", callback_data="mini_games")
-    markup_game = builder_game.adjust(3, 3, 1).as_markup()
+    markup_game = ui.bet_menu
 
-    try:
-        await bot.delete_message(chat_id=call.from_user.id, message_id=call.message.message_id)
-    except Exception as e:
-        logging.error(f"Ошибка при удалении сообщения: {e}")
     try:
         balance = get_balance_user(call.from_user.id)
-        with open('photos/mini_game.jpg', 'rb') as photo:
-            input_photo_playgame = FSInputFile("photos/mini_game.jpg")
-            await bot.send_photo(call.from_user.id, photo=input_photo_playgame, caption=f"<b>💰 У тебя на счету:</b> {balance} ⭐️\n\n🔔 Ты выбрал игру 'Испытать удачу'. Выбери ставку и попытайся победить! 🍀\n\n📊 Онлайн статистика выигрышей: {channel_link}", parse_mode='HTML', reply_markup=markup_game)
+        await show_screen(bot, call, "photos/mini_game.jpg", ui.bet_caption(balance), markup_game)
     except Exception as e:
         logging.error(f"Ошибка при получении баланса: {e}")
         await bot.send_message(call.from_user.id, f"<b>⚠️ Ошибка при получении баланса.</b>\n\n🔔 Ты выбрал игру 'Испытать удачу'. Выбери ставку и попытайся победить! 🍀\n\n📊 Онлайн статистика выигрышей: {channel_link}", parse_mode='HTML', reply_markup=markup_game)
 
 
-@router.callback_query(F.data == "giftday")
+@callbacks.route("giftday")
 async def giftday_callback(call: CallbackQuery, bot: Bot):
     user_id = call.from_user.id
     try:
@@ -2376,7 +2981,7 @@ async def giftday_callback(call: CallbackQuery, bot: Bot):
         await bot.answer_callback_query(call.id, "⚠️ Произошла ошибка при получении ежедневного подарка.", show_alert=True)
 
 
-@router.callback_query(F.data == "leaders")
+@callbacks.route("leaders")
 async def leaders_callback(call: CallbackQuery, bot: Bot):
     user_id = call.from_user.id
     banned = get_banned_user(user_id)
@@ -2386,7 +2991,7 @@ async def leaders_callback(call: CallbackQuery, bot: Bot):
     await show_leaderboard(call.message, 'day', bot)
 
 
-@router.callback_query(F.data == "week")
+@callbacks.route("week")
 async def week_callback(call: CallbackQuery, bot: Bot):
     user_id = call.from_user.id
     banned = get_banned_user(user_id)
@@ -2396,7 +3001,7 @@ async def week_callback(call: CallbackQuery, bot: Bot):
     await show_leaderboard(call.message, 'week', bot)
 
 
-@router.callback_query(F.data == "month")
+@callbacks.route("month")
 async def month_callback(call: CallbackQuery, bot: Bot):
     user_id = call.from_user.id
     banned = get_banned_user(user_id)
@@ -2418,7 +3023,7 @@ def extract_chat_info(link: str) -> str:
 # FLYER API - CALLBACK ОБРАБОТЧИКИ
 # ============================================
 
-@router.callback_query(F.data == 'flyer-task-check')
+@callbacks.route('flyer-task-check')
 async def flyer_task_check_callback(call: types.CallbackQuery, bot: Bot):
     """
     Проверка выполнения заданий Flyer
@@ -2522,7 +3127,7 @@ async def flyer_task_check_callback(call: types.CallbackQuery, bot: Bot):
         )
 
 
-@router.callback_query(F.data == 'get_flyer_tasks')
+@callbacks.route('get_flyer_tasks')
 async def get_flyer_tasks_callback(call: CallbackQuery, bot: Bot):
     """
     Обработчик для получения заданий от Flyer
@@ -2558,90 +3163,54 @@ async def get_flyer_tasks_callback(call: CallbackQuery, bot: Bot):
         await send_main_menu(user_id, bot)
 
 
-@router.callback_query(F.data == "tasks")
+@callbacks.route("tasks")
 async def tasks_callback(call: CallbackQuery, bot: Bot):
     user_id = call.from_user.id
     banned = get_banned_user(user_id)
     if banned == 1:
         await bot.answer_callback_query(call.id, "🚫 Вы заблокированы в боте!", show_alert=True)
         return
-    builder_back = InlineKeyboardBuilder()
-    builder_back.button(text="⬅️ В главное меню", callback_data="back_main")
-    markup_back = builder_back.as_markup()
+    markup_back = ui.back_main
 
     try:
-        await bot.delete_message(chat_id=call.from_user.id, message_id=call.message.message_id)
-    except Exception as e:
-        logging.error(f"Ошибка при удалении сообщения: {e}")
-    
-    try:
-        tasks = await request_task(call.from_user.id, call.from_user.id, call.from_user.first_name, call.from_user.language_code, bot)
+        tasks = await request_task(call.from_user.id, call.from_user.id, call.from_user.first_name, call.from_user.language_code, bot, call)
         # completed = get_completed_tasks_for_user(call.from_user.id)
         if tasks == 'ok':
-            await bot.send_message(call.from_user.id, "<b>🎯 На данный момент нет доступных заданий!\n\nВозвращайся позже!</b>", parse_mode='HTML', reply_markup=markup_back)
+            await show_screen(bot, call, None, "<b>🎯 На данный момент нет доступных заданий!\n\nВозвращайся позже!</b>", markup_back)
             return
 
     except Exception as e:
         logging.error(f"Ошибка при обработке заданий: {e}")
-        await bot.send_message(call.from_user.id, "<b>⚠️ Ошибка при получении списка заданий.</b>", parse_mode='HTML', reply_markup=markup_back)
+        await show_screen(bot, call, None, "<b>⚠️ Ошибка при получении списка заданий.</b>", markup_back)
 
 
-@router.callback_query(F.data == "withdraw_stars_menu")
+@callbacks.route("withdraw_stars_menu")
 async def withdraw_stars_menu_callback(call: CallbackQuery, bot: Bot):
     user_id = call.from_user.id
     banned = get_banned_user(user_id)
     if banned == 1:
         await bot.answer_callback_query(call.id, "🚫 Вы заблокированы в боте!", show_alert=True)
         return
-    try:
-        await bot.delete_message(chat_id=call.from_user.id, message_id=call.message.message_id)
-    except Exception as e:
-        logging.error(f"Ошибка при удалении сообщения: {e}")
 
-    builder_stars = InlineKeyboardBuilder()
-    builder_stars.button(text="15 ⭐️(🧸)", callback_data="withdraw:15:🧸")
-    builder_stars.button(text="15 ⭐️(💝)", callback_data="withdraw:15:💝")
-    builder_stars.button(text="25 ⭐️(🌹)", callback_data="withdraw:25:🌹")
-    builder_stars.button(text="25 ⭐️(🎁)", callback_data="withdraw:25:🎁")
-    builder_stars.button(text="50 ⭐️(🍾)", callback_data="withdraw:50:🍾")
-    builder_stars.button(text="50 ⭐️(🚀)", callback_data="withdraw:50:🚀")
-    builder_stars.button(text="50 ⭐️(💐)", callback_data="withdraw:50:💐")
-    builder_stars.button(text="50 ⭐️(🎂)", callback_data="withdraw:50:🎂")
-    builder_stars.button(text="100 ⭐️(🏆)", callback_data="withdraw:100:🏆")
-    builder_stars.button(text="100 ⭐️(💍)", callback_data="withdraw:100:💍")
-    builder_stars.button(text="100 ⭐️(💎)", callback_data="withdraw:100:💎")
-    builder_stars.button(text="Telegram Premium 1мес. (400 ⭐️)", callback_data="withdraw:premium1")
-    builder_stars.button(text="Telegram Premium 3мес. (1100 ⭐️)", callback_data="withdraw:premium2")
-    builder_stars.button(text="⬅️ В главное меню", callback_data="back_main")
-    markup_stars = builder_stars.adjust(2, 2, 2, 2, 2, 1, 1, 1).as_markup()
+    markup_stars = ui.withdraw_menu
 
     try:
         balance = str(get_balance_user(call.from_user.id))
-        with open('photos/withdraw_stars.jpg', 'rb') as photo:
-            input_photo_withdraw = FSInputFile("photos/withdraw_stars.jpg")
-            await bot.send_photo(call.from_user.id, photo=input_photo_withdraw, caption=f'<b>🔸 У тебя на счету: {balance[:balance.find(".") + 2]}⭐️</b>\n\n<b>❗️ Важно!</b> Для получения выплаты (подарка) нужно быть подписанным на:\n<a href="{channel_osn}">Основной канал</a> | <a href="{chater}">Чат</a> | <a href="{channel_viplat}">Канал выплат</a>\n\n<blockquote>‼️ Если не будет подписки в момент отправки подарка - выплата будет удалена, звёзды не возвращаются!</blockquote>\n\n<b>Выбери количество звёзд, которое хочешь обменять, из доступных вариантов ниже:</b>', parse_mode='HTML', reply_markup=markup_stars)
+        await show_screen(bot, call, "photos/withdraw_stars.jpg", ui.withdraw_caption(balance), markup_stars)
     except Exception as e:
         logging.error(f"Ошибка при отображении меню вывода: {e}")
-        await bot.send_message(call.from_user.id, "<b>⚠️ Ошибка при отображении меню вывода.</b>", parse_mode='HTML', reply_markup=markup_stars)
+        await show_screen(bot, call, None, "<b>⚠️ Ошибка при отображении меню вывода.</b>", markup_stars)
 
 
-@router.callback_query(F.data == "my_balance")
+@callbacks.route("my_balance")
 async def my_balance_callback(call: CallbackQuery, bot: Bot):
     user_id = call.from_user.id
     banned = get_banned_user(user_id)
     if banned == 1:
         await bot.answer_callback_query(call.id, "🚫 Вы заблокированы в боте!", show_alert=True)
         return
-    try:
-        await bot.delete_message(chat_id=call.from_user.id, message_id=call.message.message_id)
-    except Exception as e:
-        logging.error(f"Ошибка при удалении сообщения: {e}")
 
-    builder_profile = InlineKeyboardBuilder()
-    builder_profile.button(text='🎁 Ежедневка', callback_data='giftday')
-    builder_profile.button(text="🎫 Промокод", callback_data="promocode")
-    builder_profile.button(text="⬅️ В главное меню", callback_data="back_main")
-    markup_profile = builder_profile.adjust(2, 1).as_markup()
+    markup_profile = ui.profile
 
     # Экранирование с помощью стандартной библиотеки
     nickname = html.escape(call.from_user.first_name)
@@ -2651,39 +3220,24 @@ async def my_balance_callback(call: CallbackQuery, bot: Bot):
         balance = float(get_balance_user(call.from_user.id))
         count_refs = get_user_referrals_count(call.from_user.id)
         
-        with open('photos/profile.jpg', 'rb') as photo:
-            input_photo_profile = FSInputFile("photos/profile.jpg")
-            if user_in_booster(call.from_user.id):
-                time_until = get_time_until_boost(call.from_user.id)
-                time_until_str = html.escape(datetime.fromtimestamp(time_until).strftime("%d"))
-                caption = (
-                    f"<b>✨ Профиль\n──────────────\n👤 Имя: {nickname}\n🆔 ID: <code>{user_id}</code>\n"
-                    f"──────────────\n💰 Баланс:</b> {html.escape(f'{balance:.2f}')}⭐️\n"
-                    f"<b>👥 Рефералов:</b> {html.escape(str(count_refs))}\n"
-                    f"<b>──────────────</b>\n<b>⏳ Дней до окончания буста</b>: {time_until_str}\n"
-                    f"<b>──────────────</b>\n⬇️ <i>Используй кнопки ниже для действий.</i>"
-                )
-                await bot.send_photo(
-                    call.from_user.id,
-                    photo=input_photo_profile,
-                    caption=caption,
-                    parse_mode='HTML',
-                    reply_markup=markup_profile
-                )
-            else:
-                caption = (
-                    f"<b>✨ Профиль\n──────────────\n👤 Имя: {nickname}\n🆔 ID: <code>{user_id}</code>\n"
-                    f"──────────────\n💰 Баланс:</b> {html.escape(f'{balance:.2f}')}⭐️\n"
-                    f"<b>👥 Рефералов:</b> {html.escape(str(count_refs))}\n"
-                    f"<b>──────────────</b>\n⬇️ <i>Используй кнопки ниже для действий.</i>"
-                )
-                await bot.send_photo(
-                    call.from_user.id,
-                    photo=input_photo_profile,
-                    caption=caption,
-                    parse_mode='HTML',
-                    reply_markup=markup_profile
-                )
+        if user_in_booster(call.from_user.id):
+            time_until = get_time_until_boost(call.from_user.id)
+            time_until_str = html.escape(datetime.fromtimestamp(time_until).strftime("%d"))
+            caption = (
+                f"<b>✨ Профиль\n──────────────\n👤 Имя: {nickname}\n🆔 ID: <code>{user_id}</code>\n"
+                f"──────────────\n💰 Баланс:</b> {html.escape(f'{balance:.2f}')}⭐️\n"
+                f"<b>👥 Рефералов:</b> {html.escape(str(count_refs))}\n"
+                f"<b>──────────────</b>\n<b>⏳ Дней до окончания буста</b>: {time_until_str}\n"
+                f"<b>──────────────</b>\n⬇️ <i>Используй кнопки ниже для действий.</i>"
+            )
+        else:
+            caption = (
+                f"<b>✨ Профиль\n──────────────\n👤 Имя: {nickname}\n🆔 ID: <code>{user_id}</code>\n"
+                f"──────────────\n💰 Баланс:</b> {html.escape(f'{balance:.2f}')}⭐️\n"
+                f"<b>👥 Рефералов:</b> {html.escape(str(count_refs))}\n"
+                f"<b>──────────────</b>\n⬇️ <i>Используй кнопки ниже для действий.</i>"
+            )
+        await show_screen(bot, call, "photos/profile.jpg", caption, markup_profile)
     except Exception as e:
         logging.error(f"Ошибка при отображении профиля: {e}")
         error_message = (
@@ -2691,14 +3245,9 @@ async def my_balance_callback(call: CallbackQuery, bot: Bot):
             f"<b>⚠️ Ошибка при получении данных профиля.\n"
             f"Пропишите /start для перезагрузки статистики</b>"
         )
-        await bot.send_message(
-            call.from_user.id,
-            error_message,
-            parse_mode='HTML',
-            reply_markup=markup_profile
-        )
+        await show_screen(bot, call, None, error_message, markup_profile)
 
-@router.callback_query(F.data == "promocode")
+@callbacks.route("promocode")
 async def promocode_callback_query(call: CallbackQuery, bot: Bot, state: FSMContext):
     await bot.delete_message(call.from_user.id, call.message.message_id)
     with open('photos/promocode.jpg', 'rb') as photo:
@@ -2707,23 +3256,17 @@ async def promocode_callback_query(call: CallbackQuery, bot: Bot, state: FSMCont
     await state.set_state(AdminState.PROMOCODE_INPUT)
 
 
-@router.callback_query(F.data == "faq")
+@callbacks.route("faq")
 async def faq_callback(call: CallbackQuery, bot: Bot):
     user_id = call.from_user.id
     banned = get_banned_user(user_id)
     if banned == 1:
         await bot.answer_callback_query(call.id, "🚫 Вы заблокированы в боте!", show_alert=True)
         return
-    try:
-        await bot.delete_message(chat_id=call.from_user.id, message_id=call.message.message_id)
-    except Exception as e:
-        logging.error(f"Ошибка при удалении сообщения: {e}")
     
-    builder_back = InlineKeyboardBuilder()
-    builder_back.button(text="⬅️ В главное меню", callback_data="back_main")
-    markup_back = builder_back.as_markup()
+    markup_back = ui.back_main
 
-    await bot.send_message(call.from_user.id, f"""<b>❓ Часто задаваемые вопросы (FAQ):
+    await show_screen(bot, call, None, f"""<b>❓ Часто задаваемые вопросы (FAQ):
 ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━</b>
                          
 <blockquote><b>🫡 Ответы на часто задаваемые вопросы
@@ -2744,20 +3287,16 @@ async def faq_callback(call: CallbackQuery, bot: Bot):
 — Ссылку на пост с выплатой
 — Ваш ID из бота
 ✨ Удачи и приятного фарма звёзд! 🌟</blockquote>
-""", parse_mode='HTML', reply_markup=markup_back, disable_web_page_preview=True)
+""", markup_back, disable_web_page_preview=True)
 
 
-@router.callback_query(F.data == "earn_stars")
+@callbacks.route("earn_stars")
 async def earn_stars_callback(call: CallbackQuery, bot: Bot):
     user_id = call.from_user.id
     banned = get_banned_user(user_id)
     if banned == 1:
         await bot.answer_callback_query(call.id, "🚫 Вы заблокированы в боте!", show_alert=True)
         return
-    try:
-        await bot.delete_message(chat_id=call.from_user.id, message_id=call.message.message_id)
-    except Exception as e:
-        logging.error(f"Ошибка при удалении сообщения: {e}")
 
     ref_link = f"https://t.me/{ (await bot.me()).username }?start={call.from_user.id}"
     builder_earn = InlineKeyboardBuilder()
@@ -2788,45 +3327,20 @@ async def earn_stars_callback(call: CallbackQuery, bot: Bot):
     </blockquote>
     """
 
-    with open("photos/get_url.jpg", "rb") as photo:
-        input_photo_earn = FSInputFile("photos/get_url.jpg")
-        await bot.send_photo(call.from_user.id, photo=input_photo_earn, caption=f'<b>🎉 Приглашай друзей и получай звёзды! ⭐️\n\n🚀 Как использовать свою реферальную ссылку?\n</b><i>• Отправь её друзьям в личные сообщения 👥\n• Поделись ссылкой в своём Telegram-канале 📢\n• Оставь её в комментариях или чатах 🗨️\n• Распространяй ссылку в соцсетях: TikTok, Instagram, WhatsApp и других 🌍</i>\n\n<b>💎 Что ты получишь?</b>\nЗа каждого друга, который перейдет по твоей ссылке, ты получаешь +<b>{stars * 2 if user_is_booster else stars}⭐️</b>!\n{blockquote_text}\n\n<b>🔗 Твоя реферальная ссылка:\n<code>{ref_link}</code>\n\nДелись и зарабатывай уже сейчас! 🚀</b>', parse_mode='HTML', reply_markup=markup_earn)
+    await show_screen(bot, call, "photos/get_url.jpg", f'<b>🎉 Приглашай друзей и получай звёзды! ⭐️\n\n🚀 Как использовать свою реферальную ссылку?\n</b><i>• Отправь её друзьям в личные сообщения 👥\n• Поделись ссылкой в своём Telegram-канале 📢\n• Оставь её в комментариях или чатах 🗨️\n• Распространяй ссылку в соцсетях: TikTok, Instagram, WhatsApp и других 🌍</i>\n\n<b>💎 Что ты получишь?</b>\nЗа каждого друга, который перейдет по твоей ссылке, ты получаешь +<b>{stars * 2 if user_is_booster else stars}⭐️</b>!\n{blockquote_text}\n\n<b>🔗 Твоя реферальная ссылка:\n<code>{ref_link}</code>\n\nДелись и зарабатывай уже сейчас! 🚀</b>', markup_earn)
 
-@router.callback_query(F.data == "back_main")
+@callbacks.route("back_main")
 async def back_main_callback(call: CallbackQuery, bot: Bot):
-    try:
-        await bot.delete_message(chat_id=call.from_user.id, message_id=call.message.message_id)
-    except Exception as e:
-        logging.error(f"Ошибка при удалении сообщения: {e}")
 
-    builder_start = InlineKeyboardBuilder()
-    buttons = [
-        ('✨ Фармить звёзды', 'click_star'),
-        ('🎮 Мини-игры', 'mini_games'),
-        ('🔗 Получить ссылку', 'earn_stars'),
-        ('🔄 Обменять звёзды', 'withdraw_stars_menu'),
-        ('👤 Профиль', 'my_balance'),
-        ('📝 Задания', 'tasks'),
-        ('📘 Гайды | FAQ', 'faq'),
-        ('🚀 Буст', 'donate'),
-        ('🏆 Топ', 'leaders')
-    ]
-    for text, callback_data in buttons:
-        builder_start.button(text=text, callback_data=callback_data)
-    if beta_url and beta_name:
-        builder_start.button(text=beta_name, url=beta_url)
-    builder_start.adjust(1, 1, 2, 2, 2, 2, 1)
-    markup_start = builder_start.as_markup()
+    markup_start = ui.main_menu
 
     try:
-        all_stars = str(sum_all_stars())
-        withdrawed = str(sum_all_withdrawn())
-        with open('photos/start.jpg', 'rb') as photo:
-            input_photo_back_main = FSInputFile("photos/start.jpg")
-            await bot.send_photo(call.from_user.id, photo=input_photo_back_main, caption=f"<b>✨ Добро пожаловать в главное меню ✨</b>\n\n<b>🌟 Всего заработано: <code>{all_stars[:all_stars.find('.') + 2] if '.' in all_stars else all_stars}</code>⭐️</b>\n<b>♻️ Всего обменяли: <code>{withdrawed[:withdrawed.find('.') + 2] if '.' in withdrawed else withdrawed}</code>⭐️</b>\n\n<b>Как заработать звёзды?</b>\n<blockquote>🔸 <i>Кликай, собирай ежедневные награды и вводи промокоды</i>\n— всё это доступно в разделе «Профиль».\n🔸 <i>Выполняй задания и приглашай друзей</i>\n🔸 <i>Испытай удачу в увлекательных мини-играх</i>\n— всё это доступно в главном меню.</blockquote>", parse_mode='HTML', reply_markup=markup_start)
+        all_stars = sum_all_stars()
+        withdrawed = sum_all_withdrawn()
+        await show_screen(bot, call, "photos/start.jpg", ui.main_caption(all_stars, withdrawed), markup_start)
     except Exception as e:
         logging.error(f"Ошибка при отображении главного меню: {e}")
-        await bot.send_message(call.from_user.id, "<b>⚠️ Ошибка при отображении главного меню.</b>", parse_mode='HTML', reply_markup=markup_start)
+        await show_screen(bot, call, None, "<b>⚠️ Ошибка при отображении главного меню.</b>", markup_start)
 
 @router.message(AdminState.USERS_CHECK)
 async def users_check_handler(message: Message, state: FSMContext, bot: Bot):
@@ -2879,7 +3393,7 @@ async def users_check_handler(message: Message, state: FSMContext, bot: Bot):
     finally:
         await state.clear()
 
-@router.callback_query(F.data.startswith('delete_user:'))
+@callbacks.route('delete_user')
 async def delete_user_callback(call: CallbackQuery, bot: Bot):
     try:
         user_id = int(call.data.split(":")[1])
@@ -2888,7 +3402,7 @@ async def delete_user_callback(call: CallbackQuery, bot: Bot):
     except ValueError:
         await bot.answer_callback_query(call.id, "⚠️ Ошибка при удалении пользователя!", show_alert=True)
 
-@router.callback_query(F.data.startswith('block_user:'))
+@callbacks.route('block_user')
 async def block_user_callback(call: CallbackQuery, bot: Bot):
     try:
         user_id = int(call.data.split(":")[1])
@@ -2901,7 +3415,7 @@ async def block_user_callback(call: CallbackQuery, bot: Bot):
     except ValueError:
         await bot.answer_callback_query(call.id, "⚠️ Ошибка при блокировке пользователя!", show_alert=True)
 
-@router.callback_query(F.data.startswith('unblock_user:'))
+@callbacks.route('unblock_user')
 async def unblock_user_callback(call: CallbackQuery, bot: Bot):
     try:
         user_id = int(call.data.split(":")[1])
@@ -3140,7 +3654,7 @@ async def broadcast(
 async def mailing_handler(message: types.Message, state: FSMContext):
     text = message.text or message.caption or ""
     photo_file_id = message.photo[-1].file_id if message.photo else None
-    users = get_users_ids()
+    users = await get_users_ids()
 
     buttons = re.findall(r"\{([^{}]+)\}:([^{}]+)", text)
     keyboard = None
@@ -3309,7 +3823,7 @@ async def promocode_handler(message: Message, state: FSMContext, bot: Bot):
 
     promocode_text = message.text
     try:
-        success, result = use_promocode(promocode_text, message.from_user.id)
+        success, result = await promo_redeems.redeem(promocode_text, message.from_user.id)
         if success:
             await message.reply(f"<b>✅ Промокод успешно активирован!\nВам начислено {result} ⭐️</b>", parse_mode='HTML', reply_markup=markup_back)
             await send_main_menu(user_id, bot)
@@ -3431,8 +3945,8 @@ async def show_leaderboard(message: Message, period, bot: Bot):
         logging.error(f"Ошибка при удалении сообщения: {e}")
 
     try:
-        top_referrals = get_top_referrals_formatted(period)
-        user_rank = get_user_referral_rank_formatted(user_id, period)
+        top_referrals = await get_top_referrals_formatted(period)
+        user_rank = await get_user_referral_rank_formatted(user_id, period)
         builder = InlineKeyboardBuilder()
         if period == "day":
             builder.button(text="📅 Топ за месяц", callback_data="month")
@@ -3485,17 +3999,113 @@ async def set_bot_commands(bot: Bot):
 async def on_startup(bot: Bot):
     await set_bot_commands(bot)
 
-async def main():    
-    bot = Bot(token=TOKEN)
-    dp = Dispatcher()
-    dp.message.middleware(AntiFloodMiddleware(limit=1))
-    dp.callback_query.middleware(AntiFloodMiddleware(limit=1))
+_activity_task: Optional[asyncio.Task] = None
+
+async def _flush_activity_forever():
+    while True:
+        await asyncio.sleep(ACTIVITY_FLUSH_INTERVAL)
+        flush_activity()
+
+def flush_activity():
+    try:
+        activity.flush()
+    except Exception as e:
+        logging.error(f"[ACTIVITY] Ошибка при записи счётчиков активности: {e}")
+
+async def start_activity_flusher():
+    """Фоновая запись корзин активности; у каждого процесса-воркера свои счётчики."""
+    global _activity_task
+    if _activity_task is None or _activity_task.done():
+        _activity_task = asyncio.create_task(_flush_activity_forever())
+
+async def stop_activity_flusher():
+    if _activity_task is not None:
+        _activity_task.cancel()
+    flush_activity()
+
+def create_dispatcher() -> Dispatcher:
+    fsm_storage = SQLiteStorage(FSM_STATE_TTLS, FSM_DEFAULT_TTL, flush_interval=FSM_FLUSH_INTERVAL)
+    dp = Dispatcher(storage=fsm_storage)
+    dp.message.outer_middleware(antiflood)
+    dp.callback_query.outer_middleware(antiflood)
+    dp.message.outer_middleware(user_lanes)
+    dp.callback_query.outer_middleware(user_lanes)
+    dp.message.outer_middleware(profiles)
+    dp.callback_query.outer_middleware(profiles)
+    dp.callback_query.outer_middleware(callbacks)
     dp.startup.register(on_startup)
+    dp.startup.register(start_activity_flusher)
+    dp.shutdown.register(notifier.flush_all)
+    dp.shutdown.register(channel_edits.close)
+    dp.shutdown.register(profiles.flush)
+    dp.shutdown.register(promo_redeems.flush)
+    dp.shutdown.register(flush_utm)
+    dp.shutdown.register(stop_activity_flusher)
+    dp.shutdown.register(analytics.close)
+    dp.shutdown.register(fsm_storage.close)
+    dp.shutdown.register(save_hot_state)
     dp.include_router(router)
+    return dp
+
+BOOST_EXPIRY_MAX_SLEEP = 60 # бусты, выданные в других процессах, попадают в кучу при синхронизации
+
+def schedule_boost_expiry(scheduler: AsyncIOScheduler):
+    """Ставит снятие бустов ровно на время ближайшего истечения (но не реже раза в минуту)."""
+    async def expire():
+        try:
+            check_expired_boosts()
+        except Exception as e:
+            logging.error(f"Ошибка при снятии истёкших бустов: {e}")
+        run_at = time.time() + BOOST_EXPIRY_MAX_SLEEP
+        next_expiry = next_boost_expiry()
+        if next_expiry is not None:
+            run_at = min(run_at, next_expiry)
+        scheduler.add_job(expire, 'date', run_date=datetime.fromtimestamp(max(run_at, time.time())), id='boost_expiry', replace_existing=True, misfire_grace_time=None)
+    scheduler.add_job(expire, 'date', run_date=datetime.now(), id='boost_expiry', replace_existing=True, misfire_grace_time=None)
+
+async def expire_knb_games():
+    """Возврат ставок по брошенным играм КНБ и уведомление игроков."""
+    refunded = knb.expire()
+    if not refunded:
+        return
+    bot = Bot(token=TOKEN)
+    try:
+        for game in refunded:
+            for player_id in (game['first'], game['second']):
+                try:
+                    await bot.send_message(player_id, f"<b>⌛️ Игра КНБ №{game['id']} не доиграна вовремя.</b>\n\n<blockquote><b>💰 Ставка <code>{game['bet']}</code> возвращена на баланс.</b></blockquote>", parse_mode='HTML')
+                except Exception as e:
+                    logging.error(f"[KNB] Не удалось уведомить {player_id} о возврате ставки: {e}")
+    finally:
+        await bot.session.close()
+    logging.info(f"[KNB] Возвращены ставки по {len(refunded)} брошенным играм")
+
+def start_scheduler() -> AsyncIOScheduler:
     scheduler = AsyncIOScheduler()
-    scheduler.add_job(check_expired_boosts, 'interval', hours=24)
+    schedule_boost_expiry(scheduler)
+    scheduler.add_job(expire_knb_games, 'interval', minutes=1)
+    scheduler.add_job(prune_change_logs, 'interval', hours=24)
+    scheduler.add_job(save_hot_state, 'interval', hours=1)
+    scheduler.add_job(delete_stale_callback_contexts, 'interval', hours=24, args=(CALLBACK_CONTEXT_TTL,))
     scheduler.start()
+    return scheduler
+
+async def main():    
+    bot = Bot(token=TOKEN)
+    dp = create_dispatcher()
+    start_scheduler()
     await dp.start_polling(bot)
 
 if __name__ == '__main__':
-    asyncio.run(main())
\ No newline at end of file
+    if WORKERS > 0:
+        from workers import run_cluster
+        run_cluster(
+            WORKERS,
+            create_dispatcher,
+            allowed_updates=router.resolve_used_update_types(),
+            rate=API_RATE_LIMIT,
+            burst=API_RATE_BURST,
+            on_admin_worker=start_scheduler
+        )
+    else:
+        asyncio.run(main())
@@ -0,0 +1,151 @@
+import math
+from decimal import ROUND_HALF_UP, Decimal, InvalidOperation
+from numbers import Real
+from typing import Union
+
+
+class Money:
+    """Сумма в звёздах, хранящаяся целым числом милли-звёзд (1⭐️ = 1000).
+
+    В базе лежит milli, наружу Money ведёт себя как число: складывается и сравнивается
+    с Money и обычными числами, умножается и делится на коэффициенты (с округлением до милли-звезды),
+    форматируется как float ({:.2f}). str() — без лишних нулей: 12, 0.7, 1.125."""
+
+    __slots__ = ('milli',)
+    SCALE = 1000
+
+    def __init__(self, milli: int = 0):
+        self.milli = int(milli)
+
+    @staticmethod
+    def _decimal(value) -> Decimal:
+        # inf, nan и мусорные строки — ValueError, как у float(), а не InvalidOperation
+        try:
+            number = Decimal(str(value))
+        except InvalidOperation:
+            raise ValueError(f"Некорректная сумма: {value!r}") from None
+        if not number.is_finite():
+            raise ValueError(f"Некорректная сумма: {value!r}")
+        return number
+
+    @classmethod
+    def of(cls, value: Union['Money', Real, str, None]) -> 'Money':
+        if isinstance(value, Money):
+            return value
+        if value is None:
+            return cls(0)
+        if isinstance(value, int):
+            return cls(value * cls.SCALE)
+        # Через Decimal(str()), чтобы 0.7 * 2 = 1.4000000000000001 не превращалось в 1400.0000001
+        return cls(int((cls._decimal(value) * cls.SCALE).quantize(Decimal(1), rounding=ROUND_HALF_UP)))
+
+    @property
+    def stars(self) -> float:
+        return self.milli / self.SCALE
+
+    def format(self, digits: int = 3) -> str:
+        """Звёзды с не более чем digits знаками после точки (лишнее отбрасывается, нули в конце убираются)."""
+        step = 10 ** (3 - digits)
+        milli = abs(self.milli) // step * step
+        whole, frac = divmod(milli, self.SCALE)
+        sign = '-' if self.milli < 0 and milli else ''
+        if not frac:
+            return f"{sign}{whole}"
+        return f"{sign}{whole}.{frac:03d}".rstrip('0')
+
+    def _other(self, other) -> int:
+        return Money.of(other).milli
+
+    def __add__(self, other):
+        if not isinstance(other, (Money, Real)):
+            return NotImplemented
+        return Money(self.milli + self._other(other))
+
+    __radd__ = __add__
+
+    def __sub__(self, other):
+        if not isinstance(other, (Money, Real)):
+            return NotImplemented
+        return Money(self.milli - self._other(other))
+
+    def __rsub__(self, other):
+        if not isinstance(other, Real):
+            return NotImplemented
+        return Money(self._other(other) - self.milli)
+
+    def __mul__(self, factor):
+        if not isinstance(factor, Real):
+            return NotImplemented
+        return Money(int((self.milli * self._decimal(factor)).quantize(Decimal(1), rounding=ROUND_HALF_UP)))
+
+    __rmul__ = __mul__
+
+    def __truediv__(self, divisor):
+        if isinstance(divisor, Money):
+            return self.milli / divisor.milli
+        if not isinstance(divisor, Real):
+            return NotImplemented
+        return Money(int((self.milli / self._decimal(divisor)).quantize(Decimal(1), rounding=ROUND_HALF_UP)))
+
+    def __neg__(self):
+        return Money(-self.milli)
+
+    def __abs__(self):
+        return Money(abs(self.milli))
+
+    def __bool__(self):
+        return self.milli != 0
+
+    def __float__(self):
+        return self.stars
+
+    def __int__(self):
+        return int(self.milli / self.SCALE)
+
+    def __round__(self, digits=None):
+        return round(self.stars, digits)
+
+    def _compare(self, other):
+        if not isinstance(other, (Money, Real)):
+            return NotImplemented
+        if isinstance(other, float) and not math.isfinite(other):
+            # С бесконечностью и nan сравниваем как float: Money(5) < inf, все сравнения с nan ложны
+            return -other
+        return self.milli - self._other(other)
+
+    def __eq__(self, other):
+        diff = self._compare(other)
+        return diff if diff is NotImplemented else diff == 0
+
+    def __lt__(self, other):
+        diff = self._compare(other)
+        return diff if diff is NotImplemented else diff < 0
+
+    def __le__(self, other):
+        diff = self._compare(other)
+        return diff if diff is NotImplemented else diff <= 0
+
+    def __gt__(self, other):
+        diff = self._compare(other)
+        return diff if diff is NotImplemented else diff > 0
+
+    def __ge__(self, other):
+        diff = self._compare(other)
+        return diff if diff is NotImplemented else diff >= 0
+
+    def __hash__(self):
+        return hash(self.stars)
+
+    def __str__(self):
+        return self.format()
+
+    def __format__(self, spec):
+        return format(self.stars, spec) if spec else str(self)
+
+    def __repr__(self):
+        return f"Money({self.format()})"
+
+
+def to_milli(value) -> int:
+    """Сумма в звёздах (Money, число или строка) -> целые милли-звёзды для записи в базу."""
+    return Money.of(value).milli
@@ -0,0 +1,90 @@
+import asyncio
+import logging
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Iterator, Optional
+
+
+class ReadLimitExceeded(sqlite3.OperationalError):
+    """Запрос вернул больше строк, чем разрешено для одного вызова."""
+
+
+class ReadCursor:
+    """Курсор read-only соединения с лимитом строк на весь вызов ReadPool.run."""
+
+    FETCH_SIZE = 1000
+
+    def __init__(self, cursor: sqlite3.Cursor, max_rows: int):
+        self.cursor = cursor
+        self.max_rows = max_rows
+        self.rows = 0
+
+    def iterate(self, sql: str, params=()) -> Iterator[tuple]:
+        self.cursor.execute(sql, params)
+        while True:
+            chunk = self.cursor.fetchmany(self.FETCH_SIZE)
+            if not chunk:
+                return
+            self.rows += len(chunk)
+            if self.rows > self.max_rows:
+                raise ReadLimitExceeded(f"больше {self.max_rows} строк")
+            yield from chunk
+
+    def fetchall(self, sql: str, params=()) -> list:
+        return list(self.iterate(sql, params))
+
+    def fetchone(self, sql: str, params=()) -> Optional[tuple]:
+        return next(self.iterate(sql, params), None)
+
+
+class ReadPool:
+    """Read-only соединения к базе на своих потоках для тяжёлых админских и аналитических запросов.
+
+    Соединения открываются с mode=ro и PRAGMA query_only, так что взять блокировку записи не могут,
+    а в WAL читатель работает со снимком и не мешает писателю. Запросы выполняются на size
+    потоках, event loop с пользовательским трафиком их не ждёт. Каждый вызов ограничен по времени
+    (timeout, прерывается через progress handler) и по числу прочитанных строк (max_rows)."""
+
+    PROGRESS_STEPS = 10000
+
+    def __init__(self, path: str, size: int = 2, timeout: float = 30.0, max_rows: int = 100000):
+        self.path = path
+        self.timeout = timeout
+        self.max_rows = max_rows
+        self.local = threading.local()
+        self.executor = ThreadPoolExecutor(size, thread_name_prefix='db-ro')
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(f'file:{self.path}?mode=ro', uri=True)
+            conn.execute('PRAGMA query_only = ON')
+            self.local.conn = conn
+        return conn
+
+    def _call(self, fn: Callable[..., Any], args: tuple, timeout: float, max_rows: int) -> Any:
+        conn = self._connection()
+        deadline = time.monotonic() + timeout
+        conn.set_progress_handler(lambda: time.monotonic() > deadline, self.PROGRESS_STEPS)
+        started = time.monotonic()
+        try:
+            return fn(ReadCursor(conn.cursor(), max_rows), *args)
+        except sqlite3.OperationalError as e:
+            if str(e) == 'interrupted':
+                raise sqlite3.OperationalError(f"{fn.__name__}: запрос дольше {timeout} сек прерван") from e
+            raise
+        finally:
+            conn.set_progress_handler(None, 0)
+            elapsed = time.monotonic() - started
+            if elapsed > 1:
+                logging.info(f"[DB-RO] {fn.__name__}: {elapsed:.2f} сек")
+
+    async def run(self, fn: Callable[..., Any], *args, timeout: Optional[float] = None, max_rows: Optional[int] = None) -> Any:
+        """Выполняет fn(ReadCursor, *args) на потоке пула."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self._call, fn, args, timeout or self.timeout, max_rows or self.max_rows)
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -14,6 +14,52 @@ GIFT_AMOUNT = 1.0 # ежедневый гифт
 DAILY_COOLDOWN = 24 * 60 * 60 # не трогать
 DELAY_TIME = 160 # не трогать
 
+#Сводные уведомления рефералам и в канал мини-игр
+DIGEST_WINDOW = 5 # сколько секунд тишины ждать перед отправкой сводки
+DIGEST_MAX_LATENCY = 60 # максимальная задержка уведомления в секундах
+
+#Антифлуд: минимальный интервал между действиями пользователя, сек (0 — без ограничения)
+FLOOD_LIMITS = {
+    'click': 1, # кнопка «Фармить звёзды»
+    'navigation': 0.3, # остальные кнопки
+    'message': 0.5, # сообщения
+    'admin': 0, # администраторы
+}
+USER_LANE_LIMIT = 3 # сколько апдейтов одного пользователя может ждать обработки, лишние отбрасываются
+PROFILE_FLUSH_INTERVAL = 5 # как часто изменившиеся профили (имя, username, язык) пишутся в базу, сек
+PROFILE_CACHE_SIZE = 100000 # сколько профилей держать в памяти
+PROFILE_CACHE_TTL = 60 * 60 # через сколько секунд профиль из кеша перечитывается из базы
+PROMO_BATCH_INTERVAL = 0.05 # сколько секунд копить активации промокодов перед записью одной транзакцией
+PROMO_BATCH_SIZE = 500 # при стольких активациях в очереди пачка пишется сразу
+UTM_FLUSH_INTERVAL = 10 # как часто счётчики UTM-кампаний пишутся в базу, сек
+ACTIVITY_FLUSH_INTERVAL = 30 # как часто события активности (клики, регистрации, ставки...) сворачиваются в корзины статистики, сек
+
+#FSM-состояния (капча, игры, админ-мастера): время жизни брошенного диалога, сек
+FSM_DEFAULT_TTL = 60 * 60
+FSM_STATE_TTLS = {
+    'CaptchaState': 10 * 60,
+    'CaptchaClick': 10 * 60,
+    'KNBGame': 15 * 60,
+    'TheftGame': 15 * 60,
+    'AdminState:PROMOCODE_INPUT': 15 * 60,
+    'AdminState': 24 * 60 * 60,
+    'LotteryState': 24 * 60 * 60,
+    'AddUtmState': 24 * 60 * 60,
+}
+FSM_FLUSH_INTERVAL = 1 # как часто изменения состояний пишутся в базу, сек
+
+#Многопроцессный режим: число воркеров для пользователей (0 — всё в одном процессе)
+WORKERS = 0
+API_RATE_LIMIT = 25 # сообщений в секунду на всех воркеров вместе
+API_RATE_BURST = 30
+
+#Сколько хранятся контексты кнопок, по которым так и не нажали, сек
+CALLBACK_CONTEXT_TTL = 30 * 24 * 60 * 60
+
+#Очередь заявок на вывод в админке
+REVIEW_PAGE_SIZE = 20
+CHANNEL_EDIT_INTERVAL = 3 # секунд между правками постов канала выплат (Telegram пропускает ~20 в минуту на канал)
+
 #основной канал
 channel_osn = "https://t.me/FuntikStars"
 #чат
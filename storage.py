@@ -0,0 +1,134 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import time
+from typing import Any, Dict, Optional, Tuple
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+
+from database import connect_db
+
+
+class SQLiteStorage(BaseStorage):
+    """FSM-хранилище в SQLite (таблица fsm_storage той же базы, что и у бота).
+
+    Состояния переживают перезапуск и видны всем процессам, работающим с базой.
+    У каждого состояния свой TTL (по имени группы или полному имени состояния), брошенные
+    диалоги истекают лениво при чтении и пачкой при сбросе на диск. Запись идёт через кеш:
+    изменения копятся в памяти и раз в flush_interval секунд одной транзакцией уходят в базу.
+    При нескольких процессах апдейты одного пользователя должны попадать в один и тот же
+    процесс — тогда кеш и отложенная запись не расходятся с базой."""
+
+    def __init__(self, ttls: Dict[str, float], default_ttl: float, flush_interval: float = 1.0, batch_size: int = 500):
+        self.ttls = ttls
+        self.default_ttl = default_ttl
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        # key -> (state, data, expires_at)
+        self.cache: Dict[str, Tuple[Optional[str], Dict[str, Any], float]] = {}
+        self.dirty: set = set()
+        self._flush_task: Optional[asyncio.Task] = None
+        self._conn = connect_db()
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS fsm_storage (
+                key TEXT PRIMARY KEY,
+                state TEXT DEFAULT NULL,
+                data TEXT DEFAULT NULL,
+                expires_at REAL NOT NULL
+            )
+        ''')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS idx_fsm_storage_expires ON fsm_storage(expires_at)')
+        self._conn.commit()
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        return f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id or 0}:{key.destiny}"
+
+    def _ttl(self, state: Optional[str]) -> float:
+        if state is None:
+            return self.default_ttl
+        if state in self.ttls:
+            return self.ttls[state]
+        return self.ttls.get(state.split(':', 1)[0], self.default_ttl)
+
+    def _load(self, key: str) -> Tuple[Optional[str], Dict[str, Any], float]:
+        record = self.cache.get(key)
+        if record is None:
+            row = self._conn.execute('SELECT state, data, expires_at FROM fsm_storage WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                # Пустые ключи не кешируем, иначе кеш рос бы на каждого пользователя
+                return (None, {}, 0.0)
+            record = (row[0], json.loads(row[1]) if row[1] else {}, row[2])
+            self.cache[key] = record
+        if record[2] and record[2] < time.time():
+            # Истёкшее состояние: забываем его, удаление уйдёт в базу при следующем сбросе
+            record = (None, {}, 0.0)
+            self.cache[key] = record
+            self.dirty.add(key)
+        return record
+
+    def _store(self, key: str, state: Optional[str], data: Dict[str, Any]):
+        expires_at = time.time() + self._ttl(state) if state is not None or data else 0.0
+        self.cache[key] = (state, data, expires_at)
+        self.dirty.add(key)
+        if len(self.dirty) >= self.batch_size:
+            self.flush()
+        elif self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_interval)
+        self.flush()
+
+    def flush(self):
+        """Пишет накопленные изменения одной транзакцией и чистит истёкшие записи."""
+        if not self.dirty:
+            return
+        upserts, deletes = [], []
+        for key in self.dirty:
+            state, data, expires_at = self.cache.get(key, (None, {}, 0.0))
+            if state is None and not data:
+                deletes.append((key,))
+                self.cache.pop(key, None)
+            else:
+                upserts.append((key, state, json.dumps(data, ensure_ascii=False), expires_at))
+        self.dirty.clear()
+        now = time.time()
+        for key in [key for key, record in self.cache.items() if record[2] and record[2] < now]:
+            del self.cache[key]
+        try:
+            with self._conn:
+                if upserts:
+                    self._conn.executemany('''
+                        INSERT INTO fsm_storage (key, state, data, expires_at) VALUES (?, ?, ?, ?)
+                        ON CONFLICT(key) DO UPDATE SET state = excluded.state, data = excluded.data, expires_at = excluded.expires_at
+                    ''', upserts)
+                if deletes:
+                    self._conn.executemany('DELETE FROM fsm_storage WHERE key = ?', deletes)
+                self._conn.execute('DELETE FROM fsm_storage WHERE expires_at < ?', (now,))
+        except sqlite3.Error as e:
+            logging.error(f"Ошибка при сохранении FSM-состояний: {e}")
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        skey = self._key(key)
+        _, data, _ = self._load(skey)
+        self._store(skey, state.state if isinstance(state, State) else state, data)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return self._load(self._key(key))[0]
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        skey = self._key(key)
+        state, _, _ = self._load(skey)
+        self._store(skey, state, data.copy())
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return self._load(self._key(key))[1].copy()
+
+    async def close(self) -> None:
+        if self._flush_task is not None and not self._flush_task.done():
+            self._flush_task.cancel()
+        self.flush()
+        self._conn.close()
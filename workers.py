@@ -0,0 +1,163 @@
+import asyncio
+import logging
+import multiprocessing
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from aiogram import Bot, Dispatcher
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import GetUpdates
+
+from settings import TOKEN, admins_id
+
+ADMIN_WORKER = 0
+
+# Типы апдейтов, у которых есть отправитель: по нему выбирается воркер
+USER_EVENTS = (
+    'message', 'edited_message', 'callback_query', 'pre_checkout_query',
+    'inline_query', 'chosen_inline_result', 'shipping_query',
+    'my_chat_member', 'chat_member', 'chat_join_request'
+)
+
+
+class SharedRateLimiter(BaseRequestMiddleware):
+    """Token bucket исходящих сообщений, общий для всех процессов бота.
+
+    Состояние (токены и время последнего пополнения) лежит в shared memory, поэтому
+    воркеры вместе не превышают rate сообщений в секунду. Ограничиваются только методы,
+    которые что-то отправляют или редактируют; ответы на колбэки и служебные запросы идут без очереди."""
+
+    LIMITED_PREFIXES = ('send', 'copy', 'forward', 'edit')
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.lock = multiprocessing.Lock()
+        self.tokens = multiprocessing.Value('d', burst, lock=False)
+        self.stamp = multiprocessing.Value('d', time.time(), lock=False)
+
+    def _take(self) -> float:
+        """Берёт токен. Возвращает 0 при успехе, иначе сколько секунд подождать."""
+        with self.lock:
+            now = time.time()
+            tokens = min(self.burst, self.tokens.value + (now - self.stamp.value) * self.rate)
+            self.stamp.value = now
+            if tokens >= 1:
+                self.tokens.value = tokens - 1
+                return 0
+            self.tokens.value = tokens
+            return (1 - tokens) / self.rate
+
+    async def __call__(self, make_request, bot: Bot, method):
+        if method.__api_method__.startswith(self.LIMITED_PREFIXES):
+            wait = self._take()
+            while wait:
+                await asyncio.sleep(wait)
+                wait = self._take()
+        return await make_request(bot, method)
+
+
+def route(update: Dict[str, Any], workers: int) -> int:
+    """Номер воркера для апдейта: админы и апдейты без отправителя — в ADMIN_WORKER,
+    остальные — по id пользователя, чтобы апдейты одного пользователя шли в один процесс по порядку."""
+    for event_type in USER_EVENTS:
+        event = update.get(event_type)
+        if event:
+            sender = event.get('from') or event.get('chat') or {}
+            user_id = sender.get('id')
+            if user_id is None or user_id in admins_id:
+                return ADMIN_WORKER
+            return 1 + user_id % workers
+    return ADMIN_WORKER
+
+
+async def _serve(index: int, queue, limiter: SharedRateLimiter, create_dispatcher: Callable[[], Dispatcher],
+                 on_admin_worker: Optional[Callable[[], Any]]):
+    bot = Bot(token=TOKEN)
+    bot.session.middleware(limiter)
+    dp = create_dispatcher()
+    if index == ADMIN_WORKER and on_admin_worker is not None:
+        on_admin_worker()
+    await dp.emit_startup(bot=bot, dispatcher=dp)
+    loop = asyncio.get_running_loop()
+    tasks = set()
+    try:
+        while True:
+            update = await loop.run_in_executor(None, queue.get)
+            if update is None:
+                break
+            task = asyncio.create_task(dp.feed_raw_update(bot, update))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+    finally:
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+        try:
+            await dp.emit_shutdown(bot=bot, dispatcher=dp)
+        finally:
+            await bot.session.close()
+
+
+def _worker(index: int, queue, limiter: SharedRateLimiter, create_dispatcher, on_admin_worker):
+    logging.info(f"Воркер {index} запущен")
+    try:
+        asyncio.run(_serve(index, queue, limiter, create_dispatcher, on_admin_worker))
+    except KeyboardInterrupt:
+        pass
+
+
+async def _intake(queues: List, allowed_updates: List[str], polling_timeout: int = 30):
+    """Получает апдейты long polling'ом и раскладывает их по очередям воркеров."""
+    bot = Bot(token=TOKEN)
+    workers = len(queues) - 1
+    offset = None
+    try:
+        while True:
+            try:
+                updates = await bot(GetUpdates(offset=offset, timeout=polling_timeout, allowed_updates=allowed_updates))
+            except TelegramRetryAfter as e:
+                await asyncio.sleep(e.retry_after)
+                continue
+            except Exception as e:
+                logging.error(f"Ошибка при получении апдейтов: {e}")
+                await asyncio.sleep(1)
+                continue
+            for update in updates:
+                raw = update.model_dump(mode='json', by_alias=True, exclude_none=True)
+                queues[route(raw, workers)].put(raw)
+                offset = update.update_id + 1
+    finally:
+        await bot.session.close()
+
+
+def run_cluster(workers: int, create_dispatcher: Callable[[], Dispatcher], allowed_updates: List[str],
+                rate: float, burst: float, on_admin_worker: Optional[Callable[[], Any]] = None):
+    """Многопроцессный режим: процесс-приёмщик и workers пользовательских воркеров плюс админский.
+
+    Процессы запускаются через fork до создания event loop, поэтому хендлеры и настройки
+    наследуются от главного модуля. Планировщик и прочие фоновые задачи (on_admin_worker)
+    работают только в админском воркере, там же выполняются рассылки и команды админов."""
+    context = multiprocessing.get_context('fork')
+    limiter = SharedRateLimiter(rate, burst)
+    queues = [context.Queue() for _ in range(workers + 1)]
+    processes = [
+        context.Process(
+            target=_worker,
+            args=(index, queue, limiter, create_dispatcher, on_admin_worker),
+            name=f"bot-worker-{index}",
+            daemon=True
+        )
+        for index, queue in enumerate(queues)
+    ]
+    for process in processes:
+        process.start()
+    try:
+        asyncio.run(_intake(queues, allowed_updates))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for queue in queues:
+            queue.put(None)
+        for process in processes:
+            process.join(timeout=30)